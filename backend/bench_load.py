@@ -0,0 +1,351 @@
+import argparse
+import asyncio
+import io
+import json
+import math
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+# Load test of the API against the local fake Gemini client (fake_genai.py), so it costs no quota.
+# Starts uvicorn in a scratch directory, drives each scenario at increasing concurrency and
+# reports p50/p95/p99 latency, throughput and the server's peak RSS. Every run is appended
+# to --results and compared with the previous run of the same scenario and concurrency.
+# Needs the dev requirements: pip install -r backend/requirements-dev.txt
+# Usage: python backend/bench_load.py --concurrency 1,4,16 --requests 40
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ("story", "image", "save", "list")
+
+
+def reference_png() -> bytes:
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.effect_noise((640, 800), 48).convert("RGB").save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    # Nearest rank
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+def read_memory(pid):
+    """
+    (current, peak) RSS in bytes of a process, from /proc (Linux only).
+    """
+    values = {}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("VmRSS", "VmHWM"):
+                    values[key] = int(value.split()[0]) * 1024
+    except OSError:
+        return None, None
+    return values.get("VmRSS"), values.get("VmHWM")
+
+
+def reset_peak_memory(pid):
+    # Resets VmHWM to the current RSS, so each level reports its own peak
+    try:
+        with open(f"/proc/{pid}/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def git_version():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class Server:
+    """
+    uvicorn running backend.main with GEMINI_FAKE=1 in a scratch working directory.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.workdir = tempfile.mkdtemp(prefix="bench_load_")
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.process = None
+        self.log = None
+
+    def start(self):
+        env = {
+            **os.environ,
+            "PYTHONPATH": ROOT + os.pathsep + os.environ.get("PYTHONPATH", ""),
+            "GEMINI_FAKE": "1",
+            "FAKE_GENAI_STORY_LATENCY_MS": f"{self.args.story_latency_ms},{self.args.latency_sigma}",
+            "FAKE_GENAI_IMAGE_LATENCY_MS": f"{self.args.image_latency_ms},{self.args.latency_sigma}",
+            "FAKE_GENAI_ERROR_RATE": str(self.args.error_rate),
+            "FAKE_GENAI_429_RATE": str(self.args.rate_limit_rate),
+            "FAKE_GENAI_SEED": "1"
+        }
+        if not self.args.keep_limits:
+            # Measure the service, not the requests-per-minute limiter
+            env.update(GEMINI_STORY_RPM="0", GEMINI_IMAGE_RPM="0")
+        self.log = open(os.path.join(self.workdir, "server.log"), "w")
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "backend.main:app", "--host", "127.0.0.1", "--port", str(self.port), "--log-level", "warning"],
+            cwd=self.workdir, env=env, stdout=self.log, stderr=subprocess.STDOUT
+        )
+
+        deadline = time.time() + 60
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                break
+            try:
+                if httpx.get(f"{self.url}/api/stories", timeout=1).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.2)
+        self.stop()
+        raise RuntimeError(f"Server did not start, see {os.path.join(self.workdir, 'server.log')}")
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        if self.log is not None:
+            self.log.close()
+
+    def cleanup(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+class Scenarios:
+    """
+    One request of each scenario. Form fields vary per request so the coalescer
+    does not merge concurrent calls into one.
+    """
+
+    def __init__(self, client: httpx.AsyncClient, chapters: int):
+        self.client = client
+        self.chapters = chapters
+        self.reference = reference_png()
+        self.image_url = None
+        self.counter = 0
+
+    def _next(self):
+        self.counter += 1
+        return self.counter
+
+    async def setup(self):
+        response = await self.image()
+        self.image_url = response.json()["image_url"]
+
+    async def story(self):
+        n = self._next()
+        return await self.client.post("/api/generate-story", data={
+            "nome": f"Heroína {n}", "estilo": "Aquarela", "universo": "Floresta encantada", "genero": "Aventura"
+        }, files=[("imagens", ("ref.png", self.reference, "image/png"))])
+
+    async def image(self):
+        n = self._next()
+        return await self.client.post("/api/generate-image", data={
+            "prompt": f"Cena {n}: a heroína atravessa a ponte", "person_name": "Heroína", "universe_context": "Floresta encantada"
+        }, files=[("reference_images", ("ref.png", self.reference, "image/png"))])
+
+    async def save(self):
+        n = self._next()
+        return await self.client.post("/api/save-story", json={
+            "title": f"História de carga {n}",
+            "cover_image_url": self.image_url,
+            "chapters": [
+                {"text": f"Capítulo {i + 1}. Era uma vez uma aventura na floresta encantada. " * 20, "image_url": self.image_url}
+                for i in range(self.chapters)
+            ]
+        })
+
+    async def list(self):
+        return await self.client.get("/api/stories")
+
+
+async def run_level(scenario, concurrency, requests):
+    latencies = []
+    errors = 0
+    remaining = max(requests, concurrency)
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            started = time.perf_counter()
+            try:
+                response = await scenario()
+                ok = response.status_code < 400
+            except httpx.HTTPError:
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - started)
+            else:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors, time.perf_counter() - started
+
+
+def summarize(name, concurrency, latencies, errors, elapsed, memory):
+    current, peak = memory
+    ms = lambda value: round(value * 1000, 1) if value is not None else None
+    return {
+        "scenario": name,
+        "concurrency": concurrency,
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "p50_ms": ms(percentile(latencies, 50)),
+        "p95_ms": ms(percentile(latencies, 95)),
+        "p99_ms": ms(percentile(latencies, 99)),
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "rss_mb": round(current / 1024 ** 2, 1) if current else None,
+        "peak_rss_mb": round(peak / 1024 ** 2, 1) if peak else None
+    }
+
+
+def load_previous(path, settings):
+    """
+    Latest stored result per (scenario, concurrency) among runs with the same settings.
+    """
+    previous = {}
+    if not os.path.exists(path):
+        return previous, None
+    version = None
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                run = json.loads(line)
+            except ValueError:
+                continue
+            if run.get("settings") != settings:
+                continue
+            version = run.get("version")
+            for result in run.get("results", []):
+                previous[(result["scenario"], result["concurrency"])] = result
+    return previous, version
+
+
+def change(current, before):
+    if current is None or not before:
+        return ""
+    return f" ({(current - before) / before * 100:+.0f}%)"
+
+
+def print_result(result, before):
+    before = before or {}
+    print(
+        f"{result['scenario']:>6} c={result['concurrency']:<3} n={result['requests']:<4} err={result['errors']:<3} "
+        f"p50={result['p50_ms']}ms p95={result['p95_ms']}ms{change(result['p95_ms'], before.get('p95_ms'))} "
+        f"p99={result['p99_ms']}ms "
+        f"{result['throughput_rps']} req/s{change(result['throughput_rps'], before.get('throughput_rps'))} "
+        f"peak_rss={result['peak_rss_mb']}MB{change(result['peak_rss_mb'], before.get('peak_rss_mb'))}"
+    )
+
+
+async def benchmark(args, server, previous):
+    results = []
+    timeout = httpx.Timeout(args.timeout)
+    limits = httpx.Limits(max_connections=max(args.concurrency) + 4)
+    async with httpx.AsyncClient(base_url=server.url, timeout=timeout, limits=limits) as client:
+        scenarios = Scenarios(client, args.chapters)
+        if "save" in args.scenarios:
+            await scenarios.setup()
+        for name in args.scenarios:
+            for concurrency in args.concurrency:
+                reset_peak_memory(server.process.pid)
+                latencies, errors, elapsed = await run_level(getattr(scenarios, name), concurrency, args.requests)
+                result = summarize(name, concurrency, latencies, errors, elapsed, read_memory(server.process.pid))
+                print_result(result, previous.get((name, concurrency)))
+                results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="API load test against a fake Gemini backend")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"Comma separated, from {', '.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", default="1,4,16", help="Comma separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=40, help="Requests per scenario and level")
+    parser.add_argument("--chapters", type=int, default=5)
+    parser.add_argument("--story-latency-ms", type=float, default=500)
+    parser.add_argument("--image-latency-ms", type=float, default=1000)
+    parser.add_argument("--latency-sigma", type=float, default=0.3, help="Sigma of the log-normal Gemini latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of Gemini calls failing with 503")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Share of Gemini calls failing with 429")
+    parser.add_argument("--keep-limits", action="store_true", help="Keep the GEMINI_*_RPM limits of the environment")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--results", default=os.path.join(ROOT, "bench_results", "load.jsonl"))
+    parser.add_argument("--no-save", action="store_true", help="Do not append this run to --results")
+    args = parser.parse_args()
+    args.scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    args.concurrency = [int(level) for level in args.concurrency.split(",")]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    # Runs are only compared with runs made with the same settings
+    settings = {
+        "requests": args.requests,
+        "chapters": args.chapters,
+        "story_latency_ms": args.story_latency_ms,
+        "image_latency_ms": args.image_latency_ms,
+        "latency_sigma": args.latency_sigma,
+        "error_rate": args.error_rate,
+        "rate_limit_rate": args.rate_limit_rate,
+        "keep_limits": args.keep_limits
+    }
+    previous, previous_version = load_previous(args.results, settings)
+    if previous_version:
+        print(f"Comparing with the previous run ({previous_version})")
+
+    server = Server(args)
+    server.start()
+    try:
+        results = asyncio.run(benchmark(args, server, previous))
+    finally:
+        server.stop()
+        server.cleanup()
+
+    if not args.no_save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.results)), exist_ok=True)
+        with open(args.results, "a", encoding="utf-8") as f:
+            f.write(json.dumps({
+                "version": git_version(),
+                "timestamp": time.time(),
+                "python": platform.python_version(),
+                "cpus": os.cpu_count(),
+                "settings": settings,
+                "results": results
+            }, ensure_ascii=False) + "\n")
+        print(f"Results appended to {args.results}")
+
+
+if __name__ == "__main__":
+    main()
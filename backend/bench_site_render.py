@@ -0,0 +1,81 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+try:
+    from backend.site_renderer import SiteTemplate, TEMPLATE_PATH, INJECTION_MARKER, atomic_write_json
+except ImportError:
+    from site_renderer import SiteTemplate, TEMPLATE_PATH, INJECTION_MARKER, atomic_write_json
+
+# Benchmark of the story.json + index.html part of a save:
+# the old read-template/replace/write path against the precompiled renderer.
+# Usage: python backend/bench_site_render.py --saves 2000 --chapters 10
+
+
+def sample_story(chapters):
+    return {
+        "title": "A Grande Aventura",
+        "cover_image": "cover_00000000-0000-0000-0000-000000000000.png",
+        "chapters": [
+            {"text": "Era uma vez, em uma terra muito distante... " * 20, "image": f"chap_{i + 1}_image.png"}
+            for i in range(chapters)
+        ],
+        "id": "A_Grande_Aventura_00000000",
+        "created_at": time.time()
+    }
+
+
+def legacy_save(story_path, data):
+    with open(os.path.join(story_path, "story.json"), "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+
+    with open(TEMPLATE_PATH, "r", encoding="utf-8") as t:
+        html_content = t.read()
+    json_str = json.dumps(data, ensure_ascii=False)
+    html_content = html_content.replace(INJECTION_MARKER, f"window.embeddedStory = {json_str};")
+    with open(os.path.join(story_path, "index.html"), "w", encoding="utf-8") as f:
+        f.write(html_content)
+
+
+def rendered_save(template, story_path, data):
+    atomic_write_json(os.path.join(story_path, "story.json"), data)
+    template.render_to(os.path.join(story_path, "index.html"), data)
+
+
+def run(label, save, saves, data, root):
+    folders = []
+    for i in range(saves):
+        path = os.path.join(root, f"{label}_{i}")
+        os.makedirs(path)
+        folders.append(path)
+
+    started = time.perf_counter()
+    for path in folders:
+        save(path, data)
+    elapsed = time.perf_counter() - started
+    print(f"{label:>10}: {saves / elapsed:8.0f} saves/s ({elapsed * 1000 / saves:.3f} ms/save)")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Story site rendering benchmark")
+    parser.add_argument("--saves", type=int, default=1000)
+    parser.add_argument("--chapters", type=int, default=10)
+    args = parser.parse_args()
+
+    data = sample_story(args.chapters)
+    template = SiteTemplate()
+    root = tempfile.mkdtemp(prefix="bench_site_")
+    try:
+        legacy = run("legacy", legacy_save, args.saves, data, root)
+        rendered = run("renderer", lambda path, d: rendered_save(template, path, d), args.saves, data, root)
+        print(f"speedup: {legacy / rendered:.2f}x")
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
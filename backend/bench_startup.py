@@ -0,0 +1,150 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+try:
+    from backend.bench_load import ROOT, free_port, git_version, read_memory, load_previous, change
+except ImportError:
+    from bench_load import ROOT, free_port, git_version, read_memory, load_previous, change
+
+# Cold start benchmark: import time of backend.main (with a `python -X importtime` breakdown
+# of the slowest modules) and time from spawning uvicorn to the first served request.
+# Runs are appended to --results and compared with the previous run.
+# Needs the dev requirements: pip install -r backend/requirements-dev.txt
+# Usage: python backend/bench_startup.py --runs 5
+
+
+def run_python(code, workdir, env, importtime=False):
+    args = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", code]
+    return subprocess.run(args, cwd=workdir, env=env, capture_output=True, text=True, check=True)
+
+
+def measure_import(workdir, env):
+    code = "import time; started = time.perf_counter(); import backend.main; print(time.perf_counter() - started)"
+    output = run_python(code, workdir, env).stdout.strip().splitlines()
+    return float(output[-1]) * 1000
+
+
+def import_breakdown(workdir, env, top):
+    """
+    Slowest modules imported by backend.main, by cumulative time, from `python -X importtime`.
+    Only the first two levels below backend.main, so a package is not listed again with its submodules.
+    """
+    stderr = run_python("import backend.main", workdir, env, importtime=True).stderr
+    modules = []
+    pending = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth == 0:
+            # A module is listed after everything it imported: keep what came before backend.main
+            if name.strip() == "backend.main":
+                modules = pending
+            pending = []
+        elif depth <= 2:
+            pending.append((name.strip(), int(cumulative_us) / 1000, depth))
+    modules.sort(key=lambda module: module[1], reverse=True)
+    return [{"module": name, "cumulative_ms": round(ms, 1), "depth": depth} for name, ms, depth in modules[:top]]
+
+
+def measure_first_request(workdir, env, path):
+    """
+    Milliseconds from spawning uvicorn to the first successful response on `path`,
+    and the server's RSS at that point.
+    """
+    port = free_port()
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "backend.main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        deadline = started + 60
+        while time.perf_counter() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError("Server exited during startup")
+            try:
+                if httpx.get(f"http://127.0.0.1:{port}{path}", timeout=1).status_code == 200:
+                    elapsed = (time.perf_counter() - started) * 1000
+                    return elapsed, read_memory(process.pid)[0]
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.01)
+        raise RuntimeError("Server did not answer within 60s")
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import time and time to first request of the API")
+    parser.add_argument("--runs", type=int, default=5, help="Measurements of each kind (the median is reported)")
+    parser.add_argument("--top", type=int, default=15, help="Slowest modules listed from -X importtime")
+    parser.add_argument("--path", default="/api/stories", help="Endpoint of the first request")
+    parser.add_argument("--results", default=os.path.join(ROOT, "bench_results", "startup.jsonl"))
+    parser.add_argument("--no-save", action="store_true", help="Do not append this run to --results")
+    args = parser.parse_args()
+
+    # Scratch working directory: the app creates its data files relative to it
+    workdir = tempfile.mkdtemp(prefix="bench_startup_")
+    env = {**os.environ, "PYTHONPATH": ROOT + os.pathsep + os.environ.get("PYTHONPATH", "")}
+    try:
+        # The first run warms the bytecode and OS file caches and is not counted
+        measure_import(workdir, env)
+        import_ms = [measure_import(workdir, env) for _ in range(args.runs)]
+        breakdown = import_breakdown(workdir, env, args.top)
+        first_requests = [measure_first_request(workdir, env, args.path) for _ in range(args.runs)]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    rss = [value for _, value in first_requests if value]
+    result = {
+        "import_ms": round(statistics.median(import_ms), 1),
+        "first_request_ms": round(statistics.median(ms for ms, _ in first_requests), 1),
+        "rss_mb": round(statistics.median(rss) / 1024 ** 2, 1) if rss else None
+    }
+    settings = {"runs": args.runs, "path": args.path}
+    previous, previous_version = load_previous(args.results, settings)
+    before = previous.get(("startup", 0), {})
+    if previous_version:
+        print(f"Comparing with the previous run ({previous_version})")
+
+    print("Slowest imports (cumulative):")
+    for module in breakdown:
+        print(f"  {'  ' * (module['depth'] - 1)}{module['module']:<40} {module['cumulative_ms']:8.1f} ms")
+    print(f"import backend.main: {result['import_ms']} ms{change(result['import_ms'], before.get('import_ms'))}")
+    print(f"first request ({args.path}): {result['first_request_ms']} ms{change(result['first_request_ms'], before.get('first_request_ms'))}")
+    print(f"RSS after first request: {result['rss_mb']} MB{change(result['rss_mb'], before.get('rss_mb'))}")
+
+    if not args.no_save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.results)), exist_ok=True)
+        with open(args.results, "a", encoding="utf-8") as f:
+            f.write(json.dumps({
+                "version": git_version(),
+                "timestamp": time.time(),
+                "python": platform.python_version(),
+                "cpus": os.cpu_count(),
+                "settings": settings,
+                # Same layout as bench_load.py results, so load_previous() reads both
+                "results": [{"scenario": "startup", "concurrency": 0, **result}],
+                "imports": breakdown
+            }, ensure_ascii=False) + "\n")
+        print(f"Results appended to {args.results}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import errno
+import fcntl
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+from typing import Dict, Iterable, Set
+
+# Linux ioctl to clone a file's extents (btrfs, XFS, ...): instant copy-on-write copy
+FICLONE = 0x40049409
+CHUNK_SIZE = 1024 * 1024
+
+
+class BlobStore:
+    """
+    Content-addressed storage for saved story images.
+
+    Each image is written once as `root/<2 hex>/<sha256><ext>`. Story folders get a
+    hardlink to the blob (or a reflink, or a plain copy as a last resort), and every
+    story's references are recorded in `root/refs.sqlite3` so unreferenced blobs can
+    be garbage collected.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self._local = threading.local()
+        self.stats = {"stored": 0, "deduplicated": 0, "hardlinks": 0, "reflinks": 0, "copies": 0}
+
+    def prepare(self):
+        """
+        Creates the root directory and the refs database. Called at app startup rather
+        than on construction, so importing the app has no side effects on disk.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS refs (
+                    owner TEXT NOT NULL,
+                    blob TEXT NOT NULL,
+                    PRIMARY KEY (owner, blob)
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS refs_blob ON refs (blob)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(os.path.join(self.root, "refs.sqlite3"), timeout=30)
+            self._local.conn = conn
+        return conn
+
+    def blob_path(self, blob: str) -> str:
+        return os.path.join(self.root, blob[:2], blob)
+
+    @staticmethod
+    def digest_file(path: str) -> str:
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def put_file(self, source_path: str) -> str:
+        """
+        Adds a file to the store (no-op when identical content is already there).
+        Returns the blob name: `<sha256><ext>`.
+        """
+        blob = self.digest_file(source_path) + os.path.splitext(source_path)[1].lower()
+        path = self.blob_path(blob)
+        if os.path.exists(path):
+            self.stats["deduplicated"] += 1
+            return blob
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._materialize(source_path, path)
+        self.stats["stored"] += 1
+        return blob
+
+    def link_to(self, blob: str, dest_path: str):
+        """
+        Makes `dest_path` point at the blob's content without copying when the filesystem allows it.
+        """
+        if os.path.exists(dest_path):
+            os.remove(dest_path)
+        self._materialize(self.blob_path(blob), dest_path)
+
+    def _materialize(self, source: str, dest: str):
+        # 1. hardlink: same inode, no data written
+        try:
+            os.link(source, dest)
+            self.stats["hardlinks"] += 1
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EEXIST):
+                raise
+            if e.errno == errno.EEXIST:
+                return
+
+        # 2. reflink into a temp file, 3. plain copy; then atomic rename into place
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as dst, open(source, "rb") as src:
+                try:
+                    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                    self.stats["reflinks"] += 1
+                except OSError:
+                    shutil.copyfileobj(src, dst, CHUNK_SIZE)
+                    self.stats["copies"] += 1
+            os.replace(tmp_path, dest)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def add_refs(self, owner: str, blobs: Iterable[str]):
+        with self._connect() as conn:
+            conn.executemany("INSERT OR IGNORE INTO refs (owner, blob) VALUES (?, ?)", [(owner, b) for b in set(blobs)])
+
+    def replace_refs(self, owner: str, blobs: Iterable[str]):
+        """
+        Sets the owner's references to exactly `blobs` (after one of its images was replaced,
+        the old blob is left for collect_garbage).
+        """
+        with self._connect() as conn:
+            conn.execute("DELETE FROM refs WHERE owner = ?", (owner,))
+            conn.executemany("INSERT OR IGNORE INTO refs (owner, blob) VALUES (?, ?)", [(owner, b) for b in set(blobs)])
+
+    def release(self, owner: str):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM refs WHERE owner = ?", (owner,))
+
+    def collect_garbage(self, live_owners: Set[str]) -> Dict[str, int]:
+        """
+        Drops references held by owners that no longer exist, then deletes blobs nobody
+        references. Blobs still hardlinked elsewhere (e.g. a temp image) are kept for a later pass.
+        """
+        with self._connect() as conn:
+            owners = [row[0] for row in conn.execute("SELECT DISTINCT owner FROM refs")]
+            stale = [(owner,) for owner in owners if owner not in live_owners]
+            conn.executemany("DELETE FROM refs WHERE owner = ?", stale)
+            referenced = {row[0] for row in conn.execute("SELECT DISTINCT blob FROM refs")}
+
+        removed = 0
+        reclaimed = 0
+        for shard in os.scandir(self.root):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name in referenced or entry.name.endswith(".tmp"):
+                    continue
+                stat = entry.stat()
+                if stat.st_nlink > 1:
+                    continue
+                os.remove(entry.path)
+                removed += 1
+                reclaimed += stat.st_size
+
+        return {"released_owners": len(stale), "removed_blobs": removed, "reclaimed_bytes": reclaimed}
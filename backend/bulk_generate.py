@@ -0,0 +1,352 @@
+import argparse
+import asyncio
+import csv
+import hashlib
+import json
+import mimetypes
+import os
+import time
+from typing import Any, Dict, List
+
+try:
+    from backend import main as server
+    from backend.jobs import JobStore
+    from backend.genai_service import get_client, submit_story_batch, story_batch_results
+except ImportError:
+    import main as server
+    from jobs import JobStore
+    from genai_service import get_client, submit_story_batch, story_batch_results
+
+# Offline generation of many books, outside the web app but into the same library.
+# Reads a CSV or JSONL of books and runs the job stages of the API (story, illustrations,
+# save) as a pipeline: each stage has its own workers and hands books to the next one through
+# a bounded queue, so the text of the next books is generated while earlier ones are illustrated.
+# Progress is checkpointed per book in --state; running the same command again resumes.
+# Usage (from the project root): python backend/bulk_generate.py books.csv [--batch]
+#
+# Columns: nome, estilo, universo, genero, descricao (optional), fotos (photo paths relative
+# to the input file, separated by ";" in CSV, a list in JSONL).
+
+REQUIRED_FIELDS = ("nome", "estilo", "universo", "genero")
+PHOTO_SEPARATOR = ";"
+
+
+def read_books(path: str) -> List[Dict[str, Any]]:
+    """
+    Rows of the input file, with `fotos` as a list of absolute paths.
+    """
+    base_dir = os.path.dirname(os.path.abspath(path))
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        if path.lower().endswith((".jsonl", ".ndjson")):
+            rows = [json.loads(line) for line in f if line.strip()]
+        else:
+            rows = list(csv.DictReader(f))
+
+    books = []
+    for line, row in enumerate(rows, start=1):
+        missing = [field for field in REQUIRED_FIELDS if not str(row.get(field) or "").strip()]
+        if missing:
+            raise ValueError(f"Book {line}: missing {', '.join(missing)}")
+        photos = row.get("fotos") or row.get("photos") or []
+        if isinstance(photos, str):
+            photos = [photo.strip() for photo in photos.split(PHOTO_SEPARATOR) if photo.strip()]
+        if not photos:
+            raise ValueError(f"Book {line}: no reference photos")
+        books.append({
+            "nome": row["nome"].strip(),
+            "estilo": row["estilo"].strip(),
+            "universo": row["universo"].strip(),
+            "genero": row["genero"].strip(),
+            "descricao": (row.get("descricao") or "").strip() or None,
+            "fotos": [os.path.join(base_dir, photo) for photo in photos]
+        })
+    return books
+
+
+def book_id(index: int, params: Dict[str, Any]) -> str:
+    """
+    Position in the input plus a digest of the row, so an edited row is generated again.
+    """
+    digest = hashlib.sha1(json.dumps(params, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+    return f"{index:05d}-{digest[:10]}"
+
+
+def load_references(params: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Reads and normalizes the reference photos of a book, like uploads to the API. Blocking.
+    """
+    images = []
+    for path in params["fotos"]:
+        with open(path, "rb") as f:
+            data = f.read()
+        images.append(server.reference_store.ingest(data, mimetypes.guess_type(path)[0]))
+    return images
+
+
+class BulkGenerator:
+    """
+    Pipeline of the API job stages over bounded queues. Books already done in the state
+    database are skipped; the others enter the pipeline at the first stage they have not completed.
+    """
+
+    def __init__(self, store: JobStore, story_workers: int = 2, image_workers: int = 2, save_workers: int = 1,
+                 queue_size: int = 2, batch_size: int = 0, batch_poll_seconds: float = 30, report_seconds: float = 60):
+        self.store = store
+        self.stages = [
+            ("story", server.job_story_stage, story_workers),
+            ("images", server.job_images_stage, image_workers),
+            ("save", server.job_save_stage, save_workers)
+        ]
+        self.queue_size = queue_size
+        # Story texts through the Gemini batch API (half price, answered within hours)
+        self.batch_size = batch_size
+        self.batch_poll_seconds = batch_poll_seconds
+        self.report_seconds = report_seconds
+        self.counts = {"done": 0, "failed": 0, "skipped": 0}
+        self.total = 0
+        self.started = time.monotonic()
+
+    async def _checkpoint(self, job: Dict[str, Any], **fields):
+        await asyncio.to_thread(self.store.update, job["id"], artifacts=job["artifacts"], **fields)
+
+    async def _fail(self, job: Dict[str, Any], stage: str, error: Exception):
+        print(f"Book {job['id']} ({job['params']['nome']}) failed at stage '{stage}': {error}")
+        self.counts["failed"] += 1
+        await self._checkpoint(job, status="failed", stage=stage, error=str(error))
+
+    async def _run_stage(self, index: int, job: Dict[str, Any]) -> bool:
+        name, handler, _ = self.stages[index]
+        artifacts = job["artifacts"]
+        await asyncio.to_thread(self.store.update, job["id"], status="running", stage=name)
+        try:
+            if name != "save" and job.get("reference_images") is None:
+                job["reference_images"] = await asyncio.to_thread(load_references, job["params"])
+            await handler(job, artifacts, lambda: self._checkpoint(job))
+        except Exception as e:
+            await self._fail(job, name, e)
+            return False
+        artifacts.setdefault("completed_stages", []).append(name)
+        await self._checkpoint(job)
+        return True
+
+    async def _forward(self, queues: List[asyncio.Queue], index: int, job: Dict[str, Any]):
+        """
+        Hands the book to its next stage, or records it as done after the last one.
+        """
+        if index + 1 < len(queues):
+            await queues[index + 1].put(job)
+            return
+        await self._checkpoint(job, status="done", stage=None, error=None)
+        self.counts["done"] += 1
+        print(f"[{self.counts['done'] + self.counts['skipped']}/{self.total}] {job['params']['nome']}: saved as {job['artifacts']['saved']['story_id']}")
+
+    async def _worker(self, queues: List[asyncio.Queue], index: int):
+        while True:
+            job = await queues[index].get()
+            if job is None:
+                return
+            if await self._run_stage(index, job):
+                await self._forward(queues, index, job)
+
+    async def _batch_worker(self, queues: List[asyncio.Queue], resumed: Dict[str, List[Dict[str, Any]]]):
+        """
+        Story stage in batch mode: books are grouped into batch jobs of up to `batch_size`,
+        each job is polled on its own and its books move on as soon as it completes.
+        Batches submitted before an interruption (`resumed`) are polled again, not resubmitted.
+        """
+        polls = [asyncio.create_task(self._poll_batch(queues, name, jobs)) for name, jobs in resumed.items()]
+        pending: List[Dict[str, Any]] = []
+        closed = False
+        while not closed:
+            try:
+                job = await asyncio.wait_for(queues[0].get(), timeout=5 if pending else None)
+            except asyncio.TimeoutError:
+                job = "flush"
+            if job is None:
+                closed = True
+            elif job != "flush":
+                pending.append(job)
+                if len(pending) < self.batch_size:
+                    continue
+            # Input is drained, the batch is full or no book arrived for a while
+            if pending:
+                polls.append(asyncio.create_task(self._submit_batch(queues, pending)))
+                pending = []
+        await asyncio.gather(*polls)
+
+    async def _submit_batch(self, queues: List[asyncio.Queue], jobs: List[Dict[str, Any]]):
+        try:
+            for job in jobs:
+                if job.get("reference_images") is None:
+                    job["reference_images"] = await asyncio.to_thread(load_references, job["params"])
+            requests = [
+                {key: job["params"][key] for key in ("nome", "estilo", "universo", "genero", "descricao")}
+                | {"images": job["reference_images"]}
+                for job in jobs
+            ]
+            name = await asyncio.to_thread(submit_story_batch, requests)
+        except Exception as e:
+            for job in jobs:
+                await self._fail(job, "story", e)
+            return
+        for position, job in enumerate(jobs):
+            job["artifacts"]["batch"] = {"name": name, "index": position}
+            await self._checkpoint(job, status="running", stage="story")
+        await self._poll_batch(queues, name, jobs)
+
+    async def _poll_batch(self, queues: List[asyncio.Queue], name: str, jobs: List[Dict[str, Any]]):
+        try:
+            while True:
+                results = await asyncio.to_thread(story_batch_results, name)
+                if results is not None:
+                    break
+                await asyncio.sleep(self.batch_poll_seconds)
+        except Exception as e:
+            # The batch is dropped: the next run submits these books again
+            for job in jobs:
+                job["artifacts"].pop("batch", None)
+                await self._fail(job, "story", e)
+            return
+
+        for job in jobs:
+            position = job["artifacts"].pop("batch")["index"]
+            result = results[position] if position < len(results) else RuntimeError(f"No result in batch {name}")
+            if isinstance(result, Exception):
+                await self._fail(job, "story", result)
+                continue
+            job["artifacts"]["story"] = result
+            job["artifacts"].setdefault("completed_stages", []).append("story")
+            await self._checkpoint(job)
+            await self._forward(queues, 0, job)
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(self.report_seconds)
+            print(self.progress())
+
+    def progress(self) -> str:
+        elapsed = time.monotonic() - self.started
+        rate = self.counts["done"] / elapsed * 3600 if elapsed else 0
+        return (f"{self.counts['done'] + self.counts['skipped']}/{self.total} done "
+                f"({self.counts['done']} this run, {self.counts['failed']} failed) in {elapsed / 60:.1f} min: {rate:.1f} books/hour")
+
+    def _prepare(self, books: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        State of every book (created for new ones). Blocking.
+        """
+        jobs = []
+        for index, params in enumerate(books):
+            job_id = book_id(index, params)
+            job = self.store.get(job_id)
+            if job is None:
+                self.store.insert(job_id, params)
+                job = self.store.get(job_id)
+            jobs.append(job)
+        return jobs
+
+    async def run(self, books: List[Dict[str, Any]]) -> Dict[str, int]:
+        jobs = await asyncio.to_thread(self._prepare, books)
+        self.total = len(jobs)
+        self.started = time.monotonic()
+        names = [name for name, _, _ in self.stages]
+        queues = [asyncio.Queue(maxsize=self.queue_size) for _ in self.stages]
+
+        # Books waiting for a batch job submitted by an interrupted run
+        resumed: Dict[str, List[Dict[str, Any]]] = {}
+        if self.batch_size:
+            for job in jobs:
+                batch = job["artifacts"].get("batch")
+                if batch and job["status"] != "done":
+                    resumed.setdefault(batch["name"], []).append(job)
+            for batch_jobs in resumed.values():
+                batch_jobs.sort(key=lambda job: job["artifacts"]["batch"]["index"])
+
+        workers = []
+        for index, (name, _, count) in enumerate(self.stages):
+            if index == 0 and self.batch_size:
+                workers.append([asyncio.create_task(self._batch_worker(queues, resumed))])
+            else:
+                workers.append([asyncio.create_task(self._worker(queues, index)) for _ in range(count)])
+
+        waiting = {id(job) for batch_jobs in resumed.values() for job in batch_jobs}
+
+        async def feed():
+            for job in jobs:
+                if job["status"] == "done":
+                    self.counts["skipped"] += 1
+                    continue
+                if id(job) in waiting:
+                    continue
+                completed = job["artifacts"].get("completed_stages", [])
+                first = next((i for i, name in enumerate(names) if name not in completed), None)
+                if first is None:
+                    # Interrupted right after its last stage
+                    await self._forward(queues, len(names) - 1, job)
+                    continue
+                await queues[first].put(job)
+
+        async def close(index):
+            # A stage is over once everything that feeds it is
+            await feeder
+            if index:
+                await asyncio.gather(*workers[index - 1])
+            for _ in workers[index]:
+                await queues[index].put(None)
+
+        feeder = asyncio.create_task(feed())
+        reporter = asyncio.create_task(self._report())
+        try:
+            await asyncio.gather(*(close(index) for index in range(len(self.stages))), *(task for tasks in workers for task in tasks))
+        finally:
+            reporter.cancel()
+        print(self.progress())
+        return self.counts
+
+
+async def run(args):
+    books = read_books(args.input)
+    server.prepare_data()
+    if get_client() is None:
+        raise SystemExit("GEMINI_API_KEY not found. Please configure .env file.")
+    store = JobStore(args.state)
+    store.prepare()
+    generator = BulkGenerator(
+        store,
+        story_workers=args.story_workers,
+        image_workers=args.image_workers,
+        save_workers=args.save_workers,
+        queue_size=args.queue_size,
+        batch_size=args.batch_size if args.batch else 0,
+        batch_poll_seconds=args.batch_poll_seconds,
+        report_seconds=args.report_seconds
+    )
+    try:
+        return await generator.run(books)
+    finally:
+        server.derivative_pool.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate many books offline from a CSV/JSONL file")
+    parser.add_argument("input", help="CSV or JSONL with nome, estilo, universo, genero, descricao, fotos")
+    parser.add_argument("--state", default="bulk_jobs.sqlite3", help="Checkpoint database; rerun with the same one to resume")
+    parser.add_argument("--story-workers", type=int, default=2, help="Books whose text is generated at once")
+    parser.add_argument("--image-workers", type=int, default=2, help="Books illustrated at once")
+    parser.add_argument("--save-workers", type=int, default=1)
+    parser.add_argument("--queue-size", type=int, default=2, help="Books waiting between two stages")
+    parser.add_argument("--batch", action="store_true", help="Generate the texts with the Gemini batch API (half price, slower)")
+    parser.add_argument("--batch-size", type=int, default=50, help="Books per batch job")
+    parser.add_argument("--batch-poll-seconds", type=float, default=30)
+    parser.add_argument("--report-seconds", type=float, default=60, help="Interval of the progress lines")
+    args = parser.parse_args()
+
+    try:
+        counts = asyncio.run(run(args))
+    except KeyboardInterrupt:
+        raise SystemExit("Interrupted; run the same command again to resume")
+    if counts["failed"]:
+        raise SystemExit(f"{counts['failed']} book(s) failed; run the same command again to retry them")
+
+
+if __name__ == "__main__":
+    main()
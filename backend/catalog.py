@@ -0,0 +1,301 @@
+import base64
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    from backend.search import ANALYZER_VERSION, analyze, parse_query, snippet
+except ImportError:
+    from search import ANALYZER_VERSION, analyze, parse_query, snippet
+
+# bm25 weights of the search columns: a hit in the title counts more than one in a chapter
+TITLE_WEIGHT = 5.0
+BODY_WEIGHT = 1.0
+# bm25 costs a few microseconds per matching story and FTS5 cannot pick the best scores without
+# computing all of them: a query ranks the newest RANK_WINDOW matches, plus the newest TITLE_WINDOW
+# stories with every query term in their title (of any age, listed first), and pages inside that
+# window. Unselective queries stay within a few ms; `total` is capped at RANK_WINDOW.
+RANK_WINDOW = 100
+TITLE_WINDOW = 50
+
+
+class StoryCatalog:
+    """
+    SQLite index of saved stories (id, title, cover, creation date), plus an FTS5
+    full-text index of their titles and chapter texts.
+
+    Kept up to date by save_story and by an incremental sync against the story
+    storage (only story.json files whose mtime changed are parsed), so listing
+    and searching the library never touch chapter payloads.
+    """
+
+    def __init__(self, db_path: str, storage):
+        self.db_path = db_path
+        self.storage = storage
+        self._local = threading.local()
+
+    def prepare(self):
+        """
+        Creates (or migrates) the schema. Called at app startup rather than on construction,
+        so importing the app has no side effects on disk.
+        """
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS stories (
+                    id TEXT PRIMARY KEY,
+                    title TEXT NOT NULL,
+                    cover TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    mtime REAL NOT NULL
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS stories_created ON stories (created_at, id)")
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(stories)")}
+            if "cover_variants" not in columns:
+                # Catalogs created before image variants existed
+                conn.execute("ALTER TABLE stories ADD COLUMN cover_variants TEXT NOT NULL DEFAULT '{}'")
+
+            # Texts are analyzed in Python (accent folding, Portuguese stopwords and stemming),
+            # FTS5 only sees space separated terms, one line per chapter. The chapter texts are stored
+            # as is (not indexed) for the result snippets. search_docs maps FTS rowids to story ids.
+            if conn.execute("PRAGMA user_version").fetchone()[0] != ANALYZER_VERSION:
+                conn.execute("DROP TABLE IF EXISTS story_search")
+                conn.execute("DROP TABLE IF EXISTS search_docs")
+                # Created before search existed or by another analyzer: the next sync reindexes everything
+                conn.execute("UPDATE stories SET mtime = -1")
+                conn.execute(f"PRAGMA user_version = {ANALYZER_VERSION}")
+            conn.execute("CREATE TABLE IF NOT EXISTS search_docs (rowid INTEGER PRIMARY KEY, id TEXT NOT NULL UNIQUE)")
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS story_search USING fts5(title, body, chapters UNINDEXED, tokenize = 'unicode61', prefix = '2 3 4')")
+
+    def _connect(self) -> sqlite3.Connection:
+        # One connection per thread (requests are served from a thread pool)
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    def upsert(self, story_id: str, title: str, cover: str, created_at: float, mtime: float,
+               cover_variants: Optional[Dict[str, Any]] = None, texts: Optional[List[str]] = None):
+        """
+        Adds or updates a story. `texts` (the chapter texts) also refreshes its search entry.
+        """
+        with self._connect() as conn:
+            conn.execute(
+                """
+                INSERT INTO stories (id, title, cover, created_at, mtime, cover_variants) VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET title = excluded.title, cover = excluded.cover,
+                    created_at = excluded.created_at, mtime = excluded.mtime, cover_variants = excluded.cover_variants
+                """,
+                (story_id, title, cover, created_at, mtime, json.dumps(cover_variants or {}))
+            )
+            if texts is not None:
+                conn.execute("INSERT OR IGNORE INTO search_docs (id) VALUES (?)", (story_id,))
+                rowid = conn.execute("SELECT rowid FROM search_docs WHERE id = ?", (story_id,)).fetchone()[0]
+                conn.execute("DELETE FROM story_search WHERE rowid = ?", (rowid,))
+                conn.execute(
+                    "INSERT INTO story_search (rowid, title, body, chapters) VALUES (?, ?, ?, ?)",
+                    (
+                        rowid,
+                        " ".join(analyze(title, keep_stopwords=True)),
+                        "\n".join(" ".join(analyze(text)) for text in texts),
+                        json.dumps(texts, ensure_ascii=False)
+                    )
+                )
+
+    def delete(self, story_id: str):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM stories WHERE id = ?", (story_id,))
+            row = conn.execute("SELECT rowid FROM search_docs WHERE id = ?", (story_id,)).fetchone()
+            if row is not None:
+                conn.execute("DELETE FROM story_search WHERE rowid = ?", (row[0],))
+                conn.execute("DELETE FROM search_docs WHERE rowid = ?", (row[0],))
+
+    def sync(self, force: bool = False) -> Dict[str, int]:
+        """
+        Brings the index in line with the stories in storage.
+        `force` re-reads every story.json (full rebuild of the search index).
+        """
+        started = time.monotonic()
+        with self._connect() as conn:
+            known = {row["id"]: row["mtime"] for row in conn.execute("SELECT id, mtime FROM stories")}
+
+        seen = set()
+        updated = 0
+        for story_id, mtime in self.storage.scan("story.json"):
+            seen.add(story_id)
+            if known.get(story_id) == mtime and not force:
+                continue
+            try:
+                data = json.loads(self.storage.read_bytes(f"{story_id}/story.json"))
+                cover = data.get("cover_image", "")
+                self.upsert(
+                    story_id,
+                    data["title"],
+                    cover,
+                    data.get("created_at", mtime),
+                    mtime,
+                    data.get("variants", {}).get(cover),
+                    [chap.get("text", "") for chap in data.get("chapters", [])]
+                )
+                updated += 1
+            except Exception as e:
+                print(f"Warning: could not index story {story_id}: {e}")
+
+        removed = [story_id for story_id in known if story_id not in seen]
+        for story_id in removed:
+            self.delete(story_id)
+
+        return {
+            "indexed": len(seen),
+            "updated": updated,
+            "removed": len(removed),
+            "elapsed_ms": round((time.monotonic() - started) * 1000, 1)
+        }
+
+    @staticmethod
+    def encode_cursor(created_at: float, story_id: str) -> str:
+        raw = json.dumps([created_at, story_id]).encode("utf-8")
+        return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+    @staticmethod
+    def decode_cursor(cursor: str) -> Tuple[float, str]:
+        try:
+            raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+            created_at, story_id = json.loads(raw)
+            return float(created_at), str(story_id)
+        except Exception:
+            raise ValueError("Invalid cursor")
+
+    def page(self, limit: int = 50, cursor: Optional[str] = None, order: str = "desc") -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        Keyset pagination over (created_at, id): each page is an index range scan,
+        whatever the size of the library. Returns (stories, next_cursor).
+        """
+        descending = order != "asc"
+        op, direction = ("<", "DESC") if descending else (">", "ASC")
+
+        query = "SELECT id, title, cover, created_at, cover_variants FROM stories"
+        args: list = []
+        if cursor:
+            created_at, story_id = self.decode_cursor(cursor)
+            query += f" WHERE (created_at, id) {op} (?, ?)"
+            args += [created_at, story_id]
+        query += f" ORDER BY created_at {direction}, id {direction} LIMIT ?"
+        args.append(limit + 1)
+
+        with self._connect() as conn:
+            rows = [dict(row) for row in conn.execute(query, args)]
+        for row in rows:
+            row["cover_variants"] = json.loads(row["cover_variants"])
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = self.encode_cursor(rows[-1]["created_at"], rows[-1]["id"])
+        return rows, next_cursor
+
+    @staticmethod
+    def encode_search_cursor(tier: int, score: float, rowid: int) -> str:
+        raw = json.dumps([tier, score, rowid]).encode("utf-8")
+        return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+    @staticmethod
+    def decode_search_cursor(cursor: str) -> Tuple[int, float, int]:
+        try:
+            raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+            tier, score, rowid = json.loads(raw)
+            return int(tier), float(score), int(rowid)
+        except Exception:
+            raise ValueError("Invalid cursor")
+
+    @staticmethod
+    def _score_newest(conn: sqlite3.Connection, match: str, window: int) -> List[Tuple[int, float]]:
+        """
+        (rowid, bm25) of the newest `window` matches. search_docs rowids grow with each new story
+        and FTS5 walks matches in rowid order, so bm25 is only computed for the rows returned.
+        """
+        return conn.execute(
+            f"""
+            SELECT rowid, bm25(story_search, {TITLE_WEIGHT}, {BODY_WEIGHT}) FROM story_search
+            WHERE story_search MATCH ? ORDER BY rowid DESC LIMIT ?
+            """,
+            (match, window)
+        ).fetchall()
+
+    def search(self, query: str, limit: int = 20, offset: int = 0,
+               cursor: Optional[str] = None) -> Tuple[List[Dict[str, Any]], int, Optional[Dict[str, Any]], Optional[str]]:
+        """
+        Stories matching every term of `query`, best first within the rank window (see RANK_WINDOW):
+        stories with the whole query in their title, then the others, each by bm25. Each story
+        carries the snippet of its best matching chapter. Pages follow a keyset cursor on
+        (tier, score, rowid); `offset` is still accepted for the first page.
+        Returns (stories, total number of matches up to RANK_WINDOW, parsed query, next_cursor).
+        """
+        parsed = parse_query(query)
+        if parsed is None:
+            return [], 0, None, None
+
+        with self._connect() as conn:
+            ranked = {}
+            title_window = RANK_WINDOW
+            if parsed["match"] != parsed["title_match"]:
+                ranked = {rowid: (1, score, rowid) for rowid, score in self._score_newest(conn, parsed["match"], RANK_WINDOW)}
+                title_window = TITLE_WINDOW
+            for rowid, score in self._score_newest(conn, parsed["title_match"], title_window):
+                ranked[rowid] = (0, score, rowid)
+            window = sorted(ranked.values())[:RANK_WINDOW]
+            total = len(window)
+
+            if cursor:
+                after = self.decode_search_cursor(cursor)
+                window = [key for key in window if key > after]
+            else:
+                window = window[offset:]
+            hits = window[:limit]
+            next_cursor = self.encode_search_cursor(*hits[-1]) if len(window) > limit else None
+
+            placeholders = ",".join("?" * len(hits))
+            rowids = [rowid for _, _, rowid in hits]
+            stories = {
+                row["rowid"]: dict(row) for row in conn.execute(
+                    f"""
+                    SELECT d.rowid, s.id, s.title, s.cover, s.created_at, s.cover_variants
+                    FROM search_docs d JOIN stories s ON s.id = d.id
+                    WHERE d.rowid IN ({placeholders})
+                    """,
+                    rowids
+                )
+            }
+            texts = {
+                row["rowid"]: (row["body"], row["chapters"]) for row in conn.execute(
+                    f"SELECT rowid, body, chapters FROM story_search WHERE rowid IN ({placeholders})", rowids
+                )
+            }
+
+        rows = []
+        for _, score, rowid in hits:
+            row = stories.get(rowid)
+            if row is None:
+                continue
+            del row["rowid"]
+            row["cover_variants"] = json.loads(row["cover_variants"])
+            # bm25() is negative, lower is better
+            row["score"] = round(-score, 4)
+            body, chapters = texts.get(rowid, ("", "[]"))
+            row["snippet"] = snippet(json.loads(chapters), parsed, analyzed=body)
+            rows.append(row)
+        return rows, total, parsed, next_cursor
+
+    def ids(self) -> List[str]:
+        with self._connect() as conn:
+            return [row[0] for row in conn.execute("SELECT id FROM stories")]
+
+    def count(self) -> int:
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM stories").fetchone()[0]
@@ -0,0 +1,101 @@
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+
+class IdempotencyConflict(Exception):
+    """Raised when an Idempotency-Key is reused with a different request payload."""
+
+
+class RequestCoalescer:
+    """
+    Shares one asyncio task between duplicate requests.
+
+    - Requests with the same fingerprint that arrive while the first one is still running
+      attach to its task instead of calling Gemini again.
+    - Requests carrying an Idempotency-Key also get the completed result replayed
+      for `ttl_seconds` after it finished. Failures are never retained.
+    """
+
+    def __init__(self, ttl_seconds: int = 600, max_entries: int = 1024):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._in_flight: Dict[str, Tuple[str, asyncio.Task]] = {}
+        self._completed: "OrderedDict[str, Tuple[float, str, Any]]" = OrderedDict()
+
+        self.executed = 0
+        self.joined = 0
+        self.replayed = 0
+
+    @staticmethod
+    def fingerprint(endpoint: str, fields: Dict[str, Any]) -> str:
+        payload = json.dumps({"endpoint": endpoint, "fields": fields}, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def run(
+        self,
+        endpoint: str,
+        fingerprint: str,
+        factory: Callable[[], Awaitable[Any]],
+        idempotency_key: Optional[str] = None
+    ) -> Tuple[Any, str]:
+        """
+        Runs `factory()` unless an equivalent request is running or was completed under the same key.
+        Returns (result, outcome) where outcome is "executed", "joined" or "replayed".
+        """
+        key = f"{endpoint}:key:{idempotency_key}" if idempotency_key else f"{endpoint}:auto:{fingerprint}"
+
+        self._purge()
+        completed = self._completed.get(key)
+        if completed is not None:
+            _, stored_fingerprint, result = completed
+            self._check_fingerprint(stored_fingerprint, fingerprint)
+            self.replayed += 1
+            return result, "replayed"
+
+        running = self._in_flight.get(key)
+        if running is not None:
+            stored_fingerprint, task = running
+            self._check_fingerprint(stored_fingerprint, fingerprint)
+            self.joined += 1
+            # shield: a duplicate client disconnecting must not cancel the shared work
+            return await asyncio.shield(task), "joined"
+
+        task = asyncio.ensure_future(factory())
+        self._in_flight[key] = (fingerprint, task)
+        self.executed += 1
+
+        def _done(t: asyncio.Task):
+            self._in_flight.pop(key, None)
+            if idempotency_key and not t.cancelled() and t.exception() is None:
+                self._completed[key] = (time.monotonic() + self.ttl_seconds, fingerprint, t.result())
+                self._completed.move_to_end(key)
+                self._purge()
+
+        task.add_done_callback(_done)
+        return await asyncio.shield(task), "executed"
+
+    @staticmethod
+    def _check_fingerprint(stored: str, current: str):
+        if stored != current:
+            raise IdempotencyConflict("Idempotency-Key reutilizada com um payload diferente.")
+
+    def _purge(self):
+        now = time.monotonic()
+        while self._completed:
+            key, (expires_at, _, _) = next(iter(self._completed.items()))
+            if expires_at > now and len(self._completed) <= self.max_entries:
+                break
+            del self._completed[key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "executed": self.executed,
+            "joined": self.joined,
+            "replayed": self.replayed,
+            "in_flight": len(self._in_flight),
+            "retained": len(self._completed)
+        }
@@ -0,0 +1,127 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+
+from PIL import Image, features
+
+# Longest side of each variant; the original 2K PNG is still served as "full"
+VARIANT_SIZES = {"thumb": 320, "medium": 1024}
+QUALITY = {"webp": 80, "avif": 60}
+
+
+def available_formats() -> List[str]:
+    formats = ["webp"]
+    if features.check("avif"):
+        formats.append("avif")
+    return formats
+
+
+def variant_name(size: str, filename: str, fmt: str) -> str:
+    """
+    `cover_<uuid>.png` -> `thumb_cover_<uuid>.webp` (keeps the UUID at the end of the name,
+    so variants get the same immutable caching as the original).
+    """
+    return f"{size}_{os.path.splitext(filename)[0]}.{fmt}"
+
+
+def make_derivatives(source_path: str, formats: List[str]) -> Dict[str, Dict[str, str]]:
+    """
+    Writes every size/format variant next to `source_path`. Runs in a worker process.
+    Returns {"thumb": {"webp": name, ...}, "medium": {...}}.
+    """
+    directory, filename = os.path.split(source_path)
+    result = {}
+    with Image.open(source_path) as img:
+        img.load()
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGB")
+        for size, max_side in VARIANT_SIZES.items():
+            resized = img.copy()
+            resized.thumbnail((max_side, max_side), Image.LANCZOS)
+            result[size] = {}
+            for fmt in formats:
+                name = variant_name(size, filename, fmt)
+                tmp_path = os.path.join(directory, name + ".tmp")
+                resized.save(tmp_path, format=fmt.upper(), quality=QUALITY[fmt])
+                os.replace(tmp_path, os.path.join(directory, name))
+                result[size][fmt] = name
+    return result
+
+
+def existing_derivatives(source_path: str) -> Optional[Dict[str, Dict[str, str]]]:
+    """
+    Variants already on disk for `source_path`, or None if any is missing.
+    """
+    directory, filename = os.path.split(source_path)
+    result = {}
+    for size in VARIANT_SIZES:
+        result[size] = {}
+        for fmt in available_formats():
+            name = variant_name(size, filename, fmt)
+            if not os.path.exists(os.path.join(directory, name)):
+                return None
+            result[size][fmt] = name
+    return result
+
+
+class DerivativePool:
+    """
+    Produces image variants in a process pool, off the event loop.
+    Concurrent requests for the same image share one job.
+    """
+
+    def __init__(self, workers: int = 2):
+        self.workers = workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._background = set()
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # The pool starts inside a server that already runs threads: forking it could copy
+            # locks held by those threads, so workers come from a fork server (spawned on Windows)
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context(method))
+        return self._executor
+
+    async def ensure(self, source_path: str) -> Dict[str, Dict[str, str]]:
+        """
+        Returns the variants of `source_path`, generating them if needed.
+        """
+        pending = self._pending.get(source_path)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        existing = existing_derivatives(source_path)
+        if existing is not None:
+            return existing
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._pool(), make_derivatives, source_path, available_formats())
+        self._pending[source_path] = future
+        try:
+            return await asyncio.shield(future)
+        finally:
+            self._pending.pop(source_path, None)
+
+    def schedule(self, source_path: str):
+        """
+        Fire-and-forget version of ensure(); errors are only logged.
+        """
+        async def run():
+            try:
+                await self.ensure(source_path)
+            except Exception as e:
+                print(f"Error creating image variants for {source_path}: {e}")
+
+        task = asyncio.create_task(run())
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        return task
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
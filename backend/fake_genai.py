@@ -0,0 +1,261 @@
+import asyncio
+import io
+import json
+import math
+import os
+import random
+import threading
+import time
+import uuid
+from types import SimpleNamespace
+from typing import Any, Dict, Optional, Tuple
+
+from google.genai import errors as genai_errors
+from google.genai import types
+
+# Local stand-in for genai.Client, for load tests and benchmarks that must not spend quota.
+# Enable it in the server with GEMINI_FAKE=1; the FAKE_GENAI_* variables below tune it.
+# Usage: GEMINI_FAKE=1 FAKE_GENAI_IMAGE_LATENCY_MS=8000,0.4 uvicorn backend.main:app
+
+# Usage numbers of a typical call, so the metrics and cost estimates have something to count
+STORY_USAGE = {"prompt": 1800, "output": 1900, "thoughts": 400}
+IMAGE_USAGE = {"prompt": 600, "output": 1120}
+
+DEFAULT_STORY = {
+    "title": "A Grande Aventura de Teste",
+    "cover_prompt": "Uma capa cinematográfica de uma aventura em uma floresta encantada, formato wide.",
+    "parts": [
+        [
+            f"Capítulo {i + 1}. Era uma vez, em uma terra muito distante, uma aventura que ninguém esperava. " * 12,
+            f"Ilustração do capítulo {i + 1}: a heroína atravessa a floresta encantada ao entardecer."
+        ]
+        for i in range(5)
+    ]
+}
+
+
+def make_png(width: int = 1024, height: int = 1536, seed: int = 0) -> bytes:
+    """
+    Noisy PNG of the given size, so encoding and variant generation cost about as much as a real image.
+    """
+    from PIL import Image
+
+    noise = Image.effect_noise((width // 4, height // 4), 64).resize((width, height))
+    image = Image.merge("RGB", (noise, noise.rotate(90, expand=False), Image.new("L", (width, height), 96 + seed % 64)))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def parse_latency(value: Optional[str], default: Tuple[float, float]) -> Tuple[float, float]:
+    """
+    "median_ms[,sigma]" -> (median seconds, sigma of the log-normal distribution).
+    """
+    if not value:
+        return default
+    median, _, sigma = value.partition(",")
+    return float(median) / 1000, float(sigma) if sigma else default[1]
+
+
+class FakeModels:
+    """
+    Implements the generate_content / generate_content_stream calls genai_service makes,
+    with a log-normal latency and random 429 / 503 failures.
+    """
+
+    def __init__(self, client: "FakeClient"):
+        self.client = client
+
+    def _plan(self, model: str) -> Tuple[float, Optional[Exception]]:
+        client = self.client
+        with client.lock:
+            median, sigma = client.image_latency if "image" in model else client.story_latency
+            delay = median * math.exp(client.random.gauss(0, sigma)) if sigma > 0 else median
+            roll = client.random.random()
+            client.calls[model] = client.calls.get(model, 0) + 1
+        if roll < client.rate_limit_rate:
+            error = genai_errors.ClientError(429, {"error": {
+                "code": 429,
+                "message": "Resource has been exhausted (e.g. check quota).",
+                "status": "RESOURCE_EXHAUSTED",
+                "details": [{"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": f"{client.retry_delay:g}s"}]
+            }})
+            # Quota errors come back fast
+            return min(delay, 0.05), error
+        if roll < client.rate_limit_rate + client.error_rate:
+            error = genai_errors.ServerError(503, {"error": {
+                "code": 503, "message": "The model is overloaded. Please try again later.", "status": "UNAVAILABLE"
+            }})
+            return delay, error
+        return delay, None
+
+    def _usage(self, model: str, done: bool = True) -> types.GenerateContentResponseUsageMetadata:
+        if "image" in model:
+            return types.GenerateContentResponseUsageMetadata(
+                prompt_token_count=IMAGE_USAGE["prompt"],
+                candidates_token_count=IMAGE_USAGE["output"],
+                total_token_count=IMAGE_USAGE["prompt"] + IMAGE_USAGE["output"],
+                candidates_tokens_details=[types.ModalityTokenCount(modality=types.MediaModality.IMAGE, token_count=IMAGE_USAGE["output"])]
+            )
+        output = STORY_USAGE["output"] if done else 0
+        return types.GenerateContentResponseUsageMetadata(
+            prompt_token_count=STORY_USAGE["prompt"],
+            candidates_token_count=output,
+            thoughts_token_count=STORY_USAGE["thoughts"],
+            total_token_count=STORY_USAGE["prompt"] + output + STORY_USAGE["thoughts"]
+        )
+
+    def _response(self, model: str, part: types.Part, done: bool = True) -> types.GenerateContentResponse:
+        return types.GenerateContentResponse(
+            candidates=[types.Candidate(content=types.Content(role="model", parts=[part]))],
+            usage_metadata=self._usage(model, done),
+            model_version=model
+        )
+
+    def _build(self, model: str, config: Any = None) -> types.GenerateContentResponse:
+        if "image" in model:
+            return self._response(model, types.Part(inline_data=types.Blob(data=self.client.image, mime_type="image/png")))
+        schema = config.get("response_json_schema") if isinstance(config, dict) else None
+        if schema and schema.get("title") == "Chapter":
+            # Single chapter rewrite: the first chapter of the fake story
+            return self._response(model, types.Part(text=json.dumps({"text": json.loads(self.client.story_json)["parts"][0][0]}, ensure_ascii=False)))
+        return self._response(model, types.Part(text=self.client.story_json))
+
+    def generate_content(self, model: str, contents: Any = None, config: Any = None) -> types.GenerateContentResponse:
+        delay, error = self._plan(model)
+        time.sleep(delay)
+        if error is not None:
+            raise error
+        return self._build(model, config)
+
+
+class FakeAsyncModels(FakeModels):
+    async def generate_content(self, model: str, contents: Any = None, config: Any = None) -> types.GenerateContentResponse:
+        delay, error = self._plan(model)
+        await asyncio.sleep(delay)
+        if error is not None:
+            raise error
+        return self._build(model, config)
+
+    async def generate_content_stream(self, model: str, contents: Any = None, config: Any = None):
+        delay, error = self._plan(model)
+        # The stream opens after the time to first token, then the text arrives in small chunks
+        chunk_count = self.client.stream_chunks
+        await asyncio.sleep(delay / 2)
+        if error is not None:
+            raise error
+
+        text = self.client.story_json
+        size = max(1, math.ceil(len(text) / chunk_count))
+
+        async def chunks():
+            for start in range(0, len(text), size):
+                await asyncio.sleep(delay / 2 / chunk_count)
+                done = start + size >= len(text)
+                yield self._response(model, types.Part(text=text[start:start + size]), done)
+
+        return chunks()
+
+
+class FakeBatches:
+    """
+    Batch jobs (client.batches.create / get) answered `batch_latency` seconds after
+    creation. Jobs live in memory only: a new process does not know them (404).
+    """
+
+    def __init__(self, client: "FakeClient"):
+        self.client = client
+        self.jobs: Dict[str, Dict[str, Any]] = {}
+
+    def create(self, model: str, src: Any = None, config: Any = None) -> types.BatchJob:
+        name = f"batches/fake-{uuid.uuid4().hex[:12]}"
+        with self.client.lock:
+            roll = [self.client.random.random() for _ in src]
+        self.jobs[name] = {"model": model, "created": time.monotonic(), "rolls": roll}
+        return types.BatchJob(name=name, model=model, state=types.JobState.JOB_STATE_PENDING)
+
+    def get(self, name: str, config: Any = None) -> types.BatchJob:
+        job = self.jobs.get(name)
+        if job is None:
+            raise genai_errors.ClientError(404, {"error": {"code": 404, "message": f"Batch {name} not found.", "status": "NOT_FOUND"}})
+        if time.monotonic() - job["created"] < self.client.batch_latency:
+            return types.BatchJob(name=name, model=job["model"], state=types.JobState.JOB_STATE_RUNNING)
+
+        models = self.client.models
+        responses = []
+        for roll in job["rolls"]:
+            # Requests of a batch fail one by one, the job itself succeeds
+            if roll < self.client.error_rate:
+                responses.append(types.InlinedResponse(error=types.JobError(code=500, message="Internal error.")))
+            else:
+                responses.append(types.InlinedResponse(response=models._build(job["model"])))
+        return types.BatchJob(
+            name=name,
+            model=job["model"],
+            state=types.JobState.JOB_STATE_SUCCEEDED,
+            dest=types.BatchJobDestination(inlined_responses=responses)
+        )
+
+
+class FakeClient:
+    """
+    Drop-in for genai.Client (the .models and .aio.models parts genai_service uses).
+
+    story_latency / image_latency: (median seconds, log-normal sigma) per call.
+    error_rate: share of calls failing with 503; rate_limit_rate: share failing with 429.
+    batch_latency: seconds before a batch job completes.
+    """
+
+    def __init__(
+        self,
+        story_latency: Tuple[float, float] = (4.0, 0.3),
+        image_latency: Tuple[float, float] = (12.0, 0.3),
+        error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        retry_delay: float = 1.0,
+        story: Optional[Dict[str, Any]] = None,
+        image: Optional[bytes] = None,
+        stream_chunks: int = 40,
+        batch_latency: float = 60.0,
+        seed: Optional[int] = None
+    ):
+        self.story_latency = story_latency
+        self.image_latency = image_latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_delay = retry_delay
+        self.story_json = json.dumps(story or DEFAULT_STORY, ensure_ascii=False)
+        self.image = image if image is not None else make_png()
+        self.stream_chunks = max(1, stream_chunks)
+        self.batch_latency = batch_latency
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls: Dict[str, int] = {}
+        self.models = FakeModels(self)
+        self.aio = SimpleNamespace(models=FakeAsyncModels(self))
+        self.batches = FakeBatches(self)
+
+    @classmethod
+    def from_env(cls) -> "FakeClient":
+        image = None
+        image_path = os.getenv("FAKE_GENAI_IMAGE_PATH")
+        if image_path:
+            with open(image_path, "rb") as f:
+                image = f.read()
+        story = None
+        story_path = os.getenv("FAKE_GENAI_STORY_PATH")
+        if story_path:
+            with open(story_path, "r", encoding="utf-8") as f:
+                story = json.load(f)
+        seed = os.getenv("FAKE_GENAI_SEED")
+        return cls(
+            story_latency=parse_latency(os.getenv("FAKE_GENAI_STORY_LATENCY_MS"), (4.0, 0.3)),
+            image_latency=parse_latency(os.getenv("FAKE_GENAI_IMAGE_LATENCY_MS"), (12.0, 0.3)),
+            error_rate=float(os.getenv("FAKE_GENAI_ERROR_RATE", "0")),
+            rate_limit_rate=float(os.getenv("FAKE_GENAI_429_RATE", "0")),
+            retry_delay=float(os.getenv("FAKE_GENAI_RETRY_DELAY", "1")),
+            batch_latency=float(os.getenv("FAKE_GENAI_BATCH_LATENCY_MS", "60000")) / 1000,
+            story=story,
+            image=image,
+            seed=int(seed) if seed else None
+        )
@@ -1,76 +1,159 @@
-import os
-import json
-
-# Define paths relative to this script or project root
-# Assuming this script is in backend/ and stories are in story_generated/ (sibling to backend)
-BASE_DIR = os.path.dirname(os.path.abspath(__file__)) # .../test-main/backend
-PROJECT_ROOT = os.path.dirname(BASE_DIR)
-STORIES_DIR = os.path.join(PROJECT_ROOT, "story_generated")
-TEMPLATE_PATH = os.path.join(BASE_DIR, "template_site.html")
-
-def fix_stories():
-    if not os.path.exists(STORIES_DIR):
-        print(f"Stories directory not found at {STORIES_DIR}")
-        return
-
-    if not os.path.exists(TEMPLATE_PATH):
-        print(f"Template not found at {TEMPLATE_PATH}")
-        return
-
-    # Read template once
-    with open(TEMPLATE_PATH, "r", encoding="utf-8") as t:
-        template_content = t.read()
-
-    print(f"Scanning {STORIES_DIR}...")
-    
-    count = 0
-    for folder_name in os.listdir(STORIES_DIR):
-        folder_path = os.path.join(STORIES_DIR, folder_name)
-        json_path = os.path.join(folder_path, "story.json")
-        html_path = os.path.join(folder_path, "index.html")
-
-        if os.path.isdir(folder_path) and os.path.exists(json_path):
-            try:
-                # Read story data
-                with open(json_path, "r", encoding="utf-8") as f:
-                    story_data = json.load(f)
-                
-                # Prepare injection
-                # We need to ensure the image paths are relative for local file opening if they aren't already
-                # But typically main.py saves them as filenames in the same folder, so they are relative.
-                # However, the saved JSON might have /stories/ID/image.png
-                
-                # Let's fix paths for standalone usage just in case
-                # If the image path starts with /stories/FOLDER/, we should strip it to just the filename
-                # because the HTML is in the same folder as the images.
-                
-                fixed_cover = story_data.get("cover_image", "")
-                if "/" in fixed_cover:
-                    fixed_cover = fixed_cover.split("/")[-1]
-                story_data["cover_image"] = fixed_cover
-
-                if "chapters" in story_data:
-                    for chap in story_data["chapters"]:
-                        img = chap.get("image", "")
-                        if "/" in img:
-                            chap["image"] = img.split("/")[-1]
-
-                # Inject
-                json_str = json.dumps(story_data, ensure_ascii=False)
-                injection_code = f"window.embeddedStory = {json_str};"
-                
-                new_html = template_content.replace("// __STORY_DATA_INJECTION__", injection_code)
-                
-                with open(html_path, "w", encoding="utf-8") as f:
-                    f.write(new_html)
-                
-                print(f"Fixed: {folder_name}")
-                count += 1
-
-            except Exception as e:
-                print(f"Error fixing {folder_name}: {e}")
-
-    print(f"Finished. Fixed {count} stories.")
-
-if __name__ == "__main__":
-    fix_stories()
+import argparse
+import os
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+try:
+    from backend.site_renderer import SiteTemplate, read_site_digest
+    from backend.http_cache import write_precompressed
+    from backend.storage import LocalStorage
+except ImportError:
+    from site_renderer import SiteTemplate, read_site_digest
+    from http_cache import write_precompressed
+    from storage import LocalStorage
+
+# Define paths relative to this script or project root
+# Assuming this script is in backend/ and stories are in story_generated/ (sibling to backend)
+BASE_DIR = os.path.dirname(os.path.abspath(__file__)) # .../test-main/backend
+PROJECT_ROOT = os.path.dirname(BASE_DIR)
+STORIES_DIR = os.path.join(PROJECT_ROOT, "story_generated")
+TEMPLATE_PATH = os.path.join(BASE_DIR, "template_site.html")
+
+# Loaded once per worker process
+template = SiteTemplate(TEMPLATE_PATH)
+
+def fix_story(folder_path, dry_run=False, force=False):
+    """
+    Re-renders one story's index.html unless it is already up to date.
+    Returns "fixed", "current" or "error: ...". Runs in a worker process.
+    """
+    json_path = os.path.join(folder_path, "story.json")
+    html_path = os.path.join(folder_path, "index.html")
+
+    try:
+        with open(json_path, "rb") as f:
+            raw = f.read()
+
+        # Same template + same story.json -> the existing site is still valid
+        digest = template.source_digest(raw)
+        if not force and read_site_digest(html_path) == digest:
+            return "current"
+        if dry_run:
+            return "fixed"
+
+        # Read story data
+        story_data = json.loads(raw)
+
+        # Prepare injection
+        # We need to ensure the image paths are relative for local file opening if they aren't already
+        # But typically main.py saves them as filenames in the same folder, so they are relative.
+        # However, the saved JSON might have /stories/ID/image.png
+
+        # Let's fix paths for standalone usage just in case
+        # If the image path starts with /stories/FOLDER/, we should strip it to just the filename
+        # because the HTML is in the same folder as the images.
+
+        fixed_cover = story_data.get("cover_image", "")
+        if "/" in fixed_cover:
+            fixed_cover = fixed_cover.split("/")[-1]
+        story_data["cover_image"] = fixed_cover
+
+        if "chapters" in story_data:
+            for chap in story_data["chapters"]:
+                img = chap.get("image", "")
+                if "/" in img:
+                    chap["image"] = img.split("/")[-1]
+
+        # Inject (written to a temp file and renamed into place)
+        template.render_to(html_path, story_data, digest)
+        write_precompressed(html_path)
+        return "fixed"
+
+    except Exception as e:
+        return f"error: {e}"
+
+def find_stories(since=None):
+    """
+    Story folders with a story.json, optionally only those modified at or after `since` (timestamp).
+    Returns (folders, skipped_by_since).
+    """
+    folders = []
+    skipped = 0
+    # Sharded (story_generated/<2 hex>/<story_id>) and legacy flat folders
+    for entry in LocalStorage(STORIES_DIR).iter_entries():
+        if not entry.is_dir():
+            continue
+        try:
+            mtime = os.stat(os.path.join(entry.path, "story.json")).st_mtime
+        except OSError:
+            continue
+        if since is not None and mtime < since:
+            skipped += 1
+            continue
+        folders.append(entry.path)
+    return folders, skipped
+
+def fix_stories(workers=None, dry_run=False, since=None, force=False, verbose=False):
+    if not os.path.exists(STORIES_DIR):
+        print(f"Stories directory not found at {STORIES_DIR}")
+        return
+
+    if not os.path.exists(TEMPLATE_PATH):
+        print(f"Template not found at {TEMPLATE_PATH}")
+        return
+
+    print(f"Scanning {STORIES_DIR}...")
+    started = time.monotonic()
+    folders, skipped = find_stories(since)
+
+    counts = {"fixed": 0, "current": 0, "error": 0}
+    workers = workers or os.cpu_count() or 1
+    args = ([dry_run] * len(folders), [force] * len(folders))
+
+    if workers == 1:
+        results = map(fix_story, folders, *args)
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = executor.map(fix_story, folders, *args, chunksize=max(1, len(folders) // (workers * 8)))
+
+    try:
+        for folder_path, result in zip(folders, results):
+            folder_name = os.path.basename(folder_path)
+            if result.startswith("error"):
+                counts["error"] += 1
+                print(f"Error fixing {folder_name}: {result[len('error: '):]}")
+            else:
+                counts[result] += 1
+                if result == "fixed" and verbose:
+                    print(f"{'Would fix' if dry_run else 'Fixed'}: {folder_name}")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    elapsed = time.monotonic() - started
+    rate = len(folders) / elapsed if elapsed > 0 else 0
+    print(
+        f"Finished{' (dry run)' if dry_run else ''} in {elapsed:.2f}s with {workers} worker(s): "
+        f"{counts['fixed']} {'to fix' if dry_run else 'fixed'}, {counts['current']} up to date, "
+        f"{counts['error']} errors, {skipped} skipped by --since ({rate:.0f} stories/s)."
+    )
+    return counts
+
+def parse_since(value):
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid date: {value} (expected e.g. 2025-01-31 or 2025-01-31T14:00)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-renders index.html of saved stories whose template or story.json changed.")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would be rewritten")
+    parser.add_argument("--since", type=parse_since, default=None, help="Only stories whose story.json changed at or after this date")
+    parser.add_argument("--force", action="store_true", help="Rewrite even stories that are up to date")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Print every story that is rewritten")
+    cli = parser.parse_args()
+    fix_stories(workers=cli.workers, dry_run=cli.dry_run, since=cli.since, force=cli.force, verbose=cli.verbose)
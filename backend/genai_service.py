@@ -1,162 +1,789 @@
-
-import os
-import asyncio
-from typing import List, Dict, Any, Optional
-from dotenv import load_dotenv
-from google import genai
-from google.genai import types
-from pydantic import BaseModel, Field
-
-# Load environment variables
-# Load environment variables
-load_dotenv(override=True)
-
-# Configure Client
-# Ensure GEMINI_API_KEY is set in your environment
-api_key = os.getenv("GEMINI_API_KEY")
-client = None
-if api_key:
-    client = genai.Client(api_key=api_key)
-else:
-    print("WARNING: GEMINI_API_KEY not found in environment variables.")
-
-class Story(BaseModel):
-    title: str = Field(description="O título épico e chamativo da história.")
-    cover_prompt: str = Field(description="Um prompt detalhado para gerar uma imagem de capa cinematográfica em formato wide (16:9).")
-    parts: List[List[str]] = Field(
-        description="Uma lista de exatamente 5 elementos. Cada elemento é uma lista com 2 strings: [texto_da_historia, prompt_de_imagem]. O texto deve ter aprox 250 palavras.",
-        min_length=5,
-        max_length=5
-    )
-
-def generate_story_with_gemini(
-    nome: str,
-    estilo: str,
-    universo: str,
-    genero: str,
-    images: List[Dict[str, Any]], # [{"data": bytes, "mime_type": str}]
-    descricao: str = None
-) -> Dict[str, Any]:
-    """
-    Generates a structured story using Gemini 1.5 Flash (or 'Gemini 3' per request equivalent).
-    """
-
-    # Handle description logic
-    tema_descricao = f"TEMA/DESCRIÇÃO: {descricao}" if descricao else "TEMA: LIVRE/ALEATÓRIO. Crie uma história surpreendente e criativa baseada no universo e gênero."
-    
-    # Construct the prompt
-    prompt_text = f"""
-    Crie uma história épica e imersiva dividida em EXATAMENTE 5 CAPÍTULOS.
-    
-    INFORMAÇÕES DO PROTAGONISTA:
-    - O protagonista é a pessoa que aparece nas imagens fornecidas. Identifique suas características visuais para manter consistência nos prompts de imagem sugeridos.
-    - Nome: {nome}
-    
-    CONFIGURAÇÃO DA HISTÓRIA:
-    - Universo: {universo} (A história deve se passar neste universo)
-    - Estilo Visual/Artístico: {estilo} (A narrativa e o tom da escrita devem harmonizar com este estilo visual. Ex: Se for 'Noir', a escrita deve ser misteriosa; se for 'Cartoon', mais leve e divertida.)
-    - Gênero: {genero}
-    - {tema_descricao}
-    
-    REQUISITOS DA SAÍDA:
-    Gere um JSON estritamente com a estrutura:
-    - title: Título da história.
-    - cover_prompt: Prompt para a capa (16:9), descrevendo o protagonista ({nome}) no universo {universo} com estilo {estilo}.
-    - parts: Uma lista de 5 listas. Cada lista interna deve conter:
-        1. Texto do capítulo (aprox. 250 palavras). A escrita DEVE refletir o universo {universo}, o gênero {genero} e o tom do estilo {estilo}.
-        2. Prompt de imagem para o capítulo. Deve descrever a cena correspondente, incluindo o protagonista ({nome}) e o ambiente, no estilo {estilo}.
-    
-    IMPORTANTE:
-    - O texto da história deve ser influenciado por: Nome, Universo, Estilo, Gênero e Descrição.
-    - As IMAGENS (fotos enviadas) servem APENAS para saber como é o rosto do protagonista nos prompts de imagem. NÃO use detalhes das fotos (ex: roupas que ele está usando na foto) no texto da história, a menos que faça sentido no universo.
-    """
-
-    contents = []
-    
-    # Add text prompt
-    contents.append(prompt_text)
-    
-    # Add images
-    for img in images:
-        contents.append(types.Part.from_bytes(data=img["data"], mime_type=img["mime_type"]))
-            
-    try:
-        if not client:
-            raise ValueError("GEMINI_API_KEY not found. Please configure .env file.")
-
-        response = client.models.generate_content(
-            model="gemini-3-flash-preview", # As per _modelo/historia.py
-            contents=contents,
-            config={
-                "response_mime_type": "application/json",
-                "response_json_schema": Story.model_json_schema(),
-            },
-        )
-        
-        if not response or not response.text:
-            raise ValueError("Resposta vazia da API")
-
-        story_data = Story.model_validate_json(response.text)
-        
-        return story_data.model_dump()
-
-    except Exception as e:
-        print(f"Error generating story: {e}")
-        raise e
-
-async def generate_image_with_gemini(
-    prompt: str,
-    reference_images: List[Dict[str, Any]],
-    person_name: str,
-    universe_context: str,
-    aspect_ratio: str = "2:3"
-) -> bytes:
-    """
-    Generates a single image using Gemini 3 Pro Image Preview with visual identity consistency.
-    """
-    
-    # Construct the instruction ensuring identity lock and style adherence
-    instruction = f"""
-    {prompt}
-    
-    IMPORTANTE: O personagem principal desta imagem deve ser exatamente a mesma pessoa que aparece nas fotos anexadas ({person_name}). Mantenha as características faciais e adaptações ao universo: {universe_context}.
-    Use the uploaded selfie as identity reference - IDENTITY LOCK (match face/skin/hair/light).
-    """
-    
-    contents = []
-    contents.append(instruction)
-    
-    # Add reference images for identity
-    for img in reference_images:
-        contents.append(types.Part.from_bytes(data=img["data"], mime_type=img["mime_type"]))
-
-    attempts = 3
-    for attempt in range(attempts):
-        try:
-            if not client:
-                raise ValueError("GEMINI_API_KEY not found.")
-            
-            print(f"Generating image (Attempt {attempt+1}/{attempts})...")
-            
-            # Using client.aio for async generation
-            response = await client.aio.models.generate_content(
-                model="gemini-3-pro-image-preview",
-                contents=contents,
-                config=types.GenerateContentConfig(
-                    response_modalities=['IMAGE'],
-                    image_config=types.ImageConfig(aspect_ratio=aspect_ratio, image_size="2K"),
-                )
-            )
-
-            for part in response.parts:
-                if part.inline_data:
-                    return part.inline_data.data
-            
-            raise ValueError("No valid image data in response.")
-
-        except Exception as e:
-            print(f"Error generating image (Attempt {attempt+1}): {e}")
-            if attempt < attempts - 1:
-                await asyncio.sleep(2)
-            else:
-                raise e
+
+import os
+import asyncio
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import List, Dict, Any, Optional, AsyncIterator, Tuple, Callable, Awaitable
+from dotenv import load_dotenv
+from pydantic import BaseModel, Field
+
+try:
+    from backend.story_stream import StoryStreamParser
+    from backend.result_cache import ResultCache
+    from backend import metrics, tracing
+except ImportError:
+    from story_stream import StoryStreamParser
+    from result_cache import ResultCache
+    import metrics
+    import tracing
+
+# Load environment variables (before the settings below are read)
+load_dotenv(override=True)
+
+# Gemini client, created on first use by get_client(). The google.genai import alone takes
+# ~0.5s, so workers that never call Gemini (library, exports) do not pay for it.
+# Tests may assign a client here directly.
+client = None
+_client_ready = False
+_client_lock = threading.Lock()
+
+def create_client():
+    if os.getenv("GEMINI_FAKE", "0").lower() in ("1", "true", "yes"):
+        # Local fake for load tests: no network, no quota (see fake_genai.py)
+        try:
+            from backend.fake_genai import FakeClient
+        except ImportError:
+            from fake_genai import FakeClient
+        print("WARNING: GEMINI_FAKE is set, using the local fake Gemini client.")
+        return FakeClient.from_env()
+
+    # Ensure GEMINI_API_KEY is set in your environment
+    api_key = os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        print("WARNING: GEMINI_API_KEY not found in environment variables.")
+        return None
+    from google import genai
+    return genai.Client(api_key=api_key)
+
+def get_client():
+    """
+    The shared Gemini client (None without GEMINI_API_KEY). One instance per process,
+    so every call reuses its pooled HTTP connections.
+    """
+    global client, _client_ready
+    if _client_ready:
+        return client
+    with _client_lock:
+        if not _client_ready:
+            if client is None:
+                client = create_client()
+            _client_ready = True
+    return client
+
+class Story(BaseModel):
+    title: str = Field(description="O título épico e chamativo da história.")
+    cover_prompt: str = Field(description="Um prompt detalhado para gerar uma imagem de capa cinematográfica em formato wide (16:9).")
+    parts: List[List[str]] = Field(
+        description="Uma lista de exatamente 5 elementos. Cada elemento é uma lista com 2 strings: [texto_da_historia, prompt_de_imagem]. O texto deve ter aprox 250 palavras.",
+        min_length=5,
+        max_length=5
+    )
+
+STORY_MODEL = "gemini-3-flash-preview" # As per _modelo/historia.py
+IMAGE_MODEL = "gemini-3-pro-image-preview"
+IMAGE_SIZE = "2K"
+
+# Opt-in cache of Gemini results, keyed by model + prompt + config + reference image digests
+result_cache = ResultCache(
+    directory=os.getenv("GENAI_CACHE_DIR", ".genai_cache"),
+    max_disk_bytes=int(os.getenv("GENAI_CACHE_MAX_BYTES", str(1024 * 1024 * 1024))),
+    max_memory_bytes=int(os.getenv("GENAI_CACHE_MEMORY_BYTES", str(64 * 1024 * 1024))),
+    enabled=os.getenv("GENAI_CACHE_ENABLED", "0").lower() in ("1", "true", "yes")
+)
+
+class RetryableError(Exception):
+    """Transient failure worth retrying (e.g. the model answered without an image)."""
+
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+def is_retryable(error: Exception) -> bool:
+    from google.genai import errors as genai_errors
+
+    if isinstance(error, RetryableError):
+        return True
+    if isinstance(error, genai_errors.APIError):
+        return error.code in RETRYABLE_STATUS_CODES
+    # Timeouts and dropped connections from the HTTP layer
+    return isinstance(error, (asyncio.TimeoutError, ConnectionError)) or type(error).__module__.startswith("httpx")
+
+def retry_after_hint(error: Exception) -> Optional[float]:
+    """
+    Seconds the API asked us to wait, from a Retry-After header or a google.rpc.RetryInfo detail.
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers and headers.get("retry-after"):
+        try:
+            return float(headers.get("retry-after"))
+        except ValueError:
+            pass
+
+    details = getattr(error, "details", None)
+    if isinstance(details, dict):
+        for detail in details.get("error", {}).get("details", []) or []:
+            delay = detail.get("retryDelay") if isinstance(detail, dict) else None
+            match = re.match(r"^([\d.]+)s$", str(delay or ""))
+            if match:
+                return float(match.group(1))
+    return None
+
+class TokenBucket:
+    """
+    Requests-per-minute limiter allowing bursts of up to `capacity` calls.
+    Waiters are served in arrival order.
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: int):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(1, capacity)
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+        self._lock = None
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class GeminiScheduler:
+    """
+    Shared gate for every Gemini call made by this process.
+
+    Each model gets a concurrency limit and a token-bucket rate limit (`rpm`, with bursts of
+    `burst` calls, by default as many as the concurrency). call() retries
+    transient errors with exponential backoff + full jitter, honoring retry-after hints,
+    and fails fast on fatal ones (bad request, auth, missing key...).
+    """
+
+    def __init__(self, limits: Dict[str, Dict[str, float]], max_attempts: int = 4, base_delay: float = 1.0, max_delay: float = 30.0):
+        self.limits = limits
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._models: Dict[str, Dict[str, Any]] = {}
+
+    def _model(self, model: str) -> Dict[str, Any]:
+        state = self._models.get(model)
+        if state is None:
+            limits = self.limits.get(model, self.limits.get("default", {"concurrency": 4, "rpm": 0}))
+            burst = int(limits.get("burst") or limits["concurrency"])
+            state = {
+                "semaphore": asyncio.Semaphore(int(limits["concurrency"])),
+                "bucket": TokenBucket(limits["rpm"], burst),
+                "concurrency": int(limits["concurrency"]),
+                "rpm": limits["rpm"],
+                "burst": burst,
+                "queued": 0,
+                "in_flight": 0,
+                "calls": 0,
+                "retries": 0,
+                "failures": 0,
+                "wait_seconds_total": 0.0,
+                "wait_seconds_max": 0.0
+            }
+            self._models[model] = state
+        return state
+
+    @asynccontextmanager
+    async def slot(self, model: str):
+        """
+        Waits for a concurrency slot and then a rate-limit token, without any retry logic.
+        The token is taken last, so a waiter cancelled meanwhile does not use one up.
+        """
+        state = self._model(model)
+        queued_at = time.perf_counter()
+        state["queued"] += 1
+        try:
+            await state["semaphore"].acquire()
+            try:
+                await state["bucket"].acquire()
+            except BaseException:
+                state["semaphore"].release()
+                raise
+        finally:
+            state["queued"] -= 1
+
+        waited = time.perf_counter() - queued_at
+        state["wait_seconds_total"] += waited
+        state["wait_seconds_max"] = max(state["wait_seconds_max"], waited)
+        metrics.gemini_queue_seconds.observe(waited, model=model)
+        tracing.record("gemini.queue", queued_at, queued_at + waited, model=model)
+        state["calls"] += 1
+        state["in_flight"] += 1
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            yield
+            outcome = "ok"
+        finally:
+            metrics.gemini_call_seconds.observe(time.perf_counter() - started, model=model, outcome=outcome)
+            state["in_flight"] -= 1
+            state["semaphore"].release()
+
+    def backoff_delay(self, attempt: int, error: Exception) -> float:
+        hint = retry_after_hint(error)
+        if hint is not None:
+            return min(self.max_delay, hint) + random.uniform(0, self.base_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    async def call(self, model: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        state = self._model(model)
+        for attempt in range(self.max_attempts):
+            try:
+                with tracing.span("gemini.attempt", model=model, attempt=attempt + 1):
+                    async with self.slot(model):
+                        return await fn()
+            except Exception as e:
+                if not is_retryable(e) or attempt == self.max_attempts - 1:
+                    state["failures"] += 1
+                    metrics.gemini_failures.inc(model=model)
+                    raise
+                delay = self.backoff_delay(attempt, e)
+                state["retries"] += 1
+                metrics.gemini_retries.inc(model=model)
+                error = f"{type(e).__name__}: {e}"
+            # Sleep outside the slot so other requests can use it meanwhile
+            with tracing.span("gemini.backoff", model=model, delay_s=round(delay, 2), cause=error):
+                await asyncio.sleep(delay)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            model: {
+                "concurrency": state["concurrency"],
+                "rpm": state["rpm"],
+                "burst": state["burst"],
+                "queued": state["queued"],
+                "in_flight": state["in_flight"],
+                "calls": state["calls"],
+                "retries": state["retries"],
+                "failures": state["failures"],
+                "wait_seconds_avg": round(state["wait_seconds_total"] / state["calls"], 4) if state["calls"] else 0.0,
+                "wait_seconds_max": round(state["wait_seconds_max"], 4)
+            }
+            for model, state in self._models.items()
+        }
+
+scheduler = GeminiScheduler(
+    limits={
+        STORY_MODEL: {
+            "concurrency": int(os.getenv("GEMINI_STORY_CONCURRENCY", "8")),
+            "rpm": float(os.getenv("GEMINI_STORY_RPM", "60")),
+            "burst": int(os.getenv("GEMINI_STORY_BURST", "0"))
+        },
+        # Enough for the cover + chapters of one book at once (IMAGE_BATCH_CONCURRENCY in main.py)
+        IMAGE_MODEL: {
+            "concurrency": int(os.getenv("GEMINI_IMAGE_CONCURRENCY", "6")),
+            "rpm": float(os.getenv("GEMINI_IMAGE_RPM", "20")),
+            "burst": int(os.getenv("GEMINI_IMAGE_BURST", "6"))
+        },
+    },
+    max_attempts=int(os.getenv("GEMINI_MAX_ATTEMPTS", "4"))
+)
+
+metrics.registry.callback_gauge(
+    "gemini_in_flight", "Gemini calls currently running.", ("model",),
+    lambda: [((model,), stats["in_flight"]) for model, stats in scheduler.stats().items()]
+)
+metrics.registry.callback_gauge(
+    "gemini_queued", "Gemini calls waiting for a rate limit token or a concurrency slot.", ("model",),
+    lambda: [((model,), stats["queued"]) for model, stats in scheduler.stats().items()]
+)
+
+def image_digests(images: List[Dict[str, Any]]) -> List[str]:
+    return [img.get("sha256") or hashlib.sha256(img["data"]).hexdigest() for img in images]
+
+def story_cache_key(contents: List[Any], images: List[Dict[str, Any]], use_cache: bool) -> Optional[str]:
+    if not result_cache.enabled:
+        return None
+    if not use_cache:
+        result_cache.bypassed += 1
+        return None
+    return ResultCache.make_key(STORY_MODEL, contents[0], story_generation_config(), image_digests(images))
+
+def build_story_contents(
+    nome: str,
+    estilo: str,
+    universo: str,
+    genero: str,
+    images: List[Dict[str, Any]],
+    descricao: str = None
+) -> List[Any]:
+    """
+    Builds the prompt + reference images sent to Gemini for story generation.
+    """
+    from google.genai import types
+
+    # Handle description logic
+    tema_descricao = f"TEMA/DESCRIÇÃO: {descricao}" if descricao else "TEMA: LIVRE/ALEATÓRIO. Crie uma história surpreendente e criativa baseada no universo e gênero."
+    
+    # Construct the prompt
+    prompt_text = f"""
+    Crie uma história épica e imersiva dividida em EXATAMENTE 5 CAPÍTULOS.
+    
+    INFORMAÇÕES DO PROTAGONISTA:
+    - O protagonista é a pessoa que aparece nas imagens fornecidas. Identifique suas características visuais para manter consistência nos prompts de imagem sugeridos.
+    - Nome: {nome}
+    
+    CONFIGURAÇÃO DA HISTÓRIA:
+    - Universo: {universo} (A história deve se passar neste universo)
+    - Estilo Visual/Artístico: {estilo} (A narrativa e o tom da escrita devem harmonizar com este estilo visual. Ex: Se for 'Noir', a escrita deve ser misteriosa; se for 'Cartoon', mais leve e divertida.)
+    - Gênero: {genero}
+    - {tema_descricao}
+    
+    REQUISITOS DA SAÍDA:
+    Gere um JSON estritamente com a estrutura:
+    - title: Título da história.
+    - cover_prompt: Prompt para a capa (16:9), descrevendo o protagonista ({nome}) no universo {universo} com estilo {estilo}.
+    - parts: Uma lista de 5 listas. Cada lista interna deve conter:
+        1. Texto do capítulo (aprox. 250 palavras). A escrita DEVE refletir o universo {universo}, o gênero {genero} e o tom do estilo {estilo}.
+        2. Prompt de imagem para o capítulo. Deve descrever a cena correspondente, incluindo o protagonista ({nome}) e o ambiente, no estilo {estilo}.
+    
+    IMPORTANTE:
+    - O texto da história deve ser influenciado por: Nome, Universo, Estilo, Gênero e Descrição.
+    - As IMAGENS (fotos enviadas) servem APENAS para saber como é o rosto do protagonista nos prompts de imagem. NÃO use detalhes das fotos (ex: roupas que ele está usando na foto) no texto da história, a menos que faça sentido no universo.
+    """
+
+    contents = []
+    
+    # Add text prompt
+    contents.append(prompt_text)
+    
+    # Add images
+    for img in images:
+        contents.append(types.Part.from_bytes(data=img["data"], mime_type=img["mime_type"]))
+
+    return contents
+
+def story_generation_config() -> Dict[str, Any]:
+    return {
+        "response_mime_type": "application/json",
+        "response_json_schema": Story.model_json_schema(),
+    }
+
+def parse_story_response(response) -> Dict[str, Any]:
+    if not response or not response.text:
+        raise ValueError("Resposta vazia da API")
+
+    story_data = Story.model_validate_json(response.text)
+
+    return story_data.model_dump()
+
+def generate_story_with_gemini(
+    nome: str,
+    estilo: str,
+    universo: str,
+    genero: str,
+    images: List[Dict[str, Any]], # [{"data": bytes, "mime_type": str}]
+    descricao: str = None,
+    use_cache: bool = True
+) -> Dict[str, Any]:
+    """
+    Generates a structured story using Gemini 1.5 Flash (or 'Gemini 3' per request equivalent).
+    Blocking version, meant for scripts. Async handlers must use generate_story_with_gemini_async.
+    """
+    with tracing.span("prompt.build", images=len(images)):
+        contents = build_story_contents(nome, estilo, universo, genero, images, descricao)
+
+    cache_key = story_cache_key(contents, images, use_cache)
+    if cache_key:
+        cached = result_cache.get(cache_key)
+        if cached is not None:
+            return json.loads(cached)
+
+    try:
+        client = get_client()
+        if not client:
+            raise ValueError("GEMINI_API_KEY not found. Please configure .env file.")
+
+        response = client.models.generate_content(
+            model=STORY_MODEL,
+            contents=contents,
+            config=story_generation_config(),
+        )
+        metrics.record_usage(STORY_MODEL, response.usage_metadata)
+
+        story_data = parse_story_response(response)
+        if cache_key:
+            result_cache.put(cache_key, json.dumps(story_data, ensure_ascii=False).encode("utf-8"))
+
+        return story_data
+
+    except Exception as e:
+        print(f"Error generating story: {e}")
+        raise e
+
+async def generate_story_with_gemini_async(
+    nome: str,
+    estilo: str,
+    universo: str,
+    genero: str,
+    images: List[Dict[str, Any]], # [{"data": bytes, "mime_type": str}]
+    descricao: str = None,
+    use_cache: bool = True
+) -> Dict[str, Any]:
+    """
+    Same as generate_story_with_gemini, but uses client.aio so the event loop
+    keeps serving other requests while the story is being written.
+    """
+    with tracing.span("prompt.build", images=len(images)):
+        contents = build_story_contents(nome, estilo, universo, genero, images, descricao)
+
+    cache_key = story_cache_key(contents, images, use_cache)
+    if cache_key:
+        with tracing.span("cache.lookup") as lookup:
+            cached = await asyncio.to_thread(result_cache.get, cache_key)
+            lookup.set(hit=cached is not None)
+        if cached is not None:
+            return json.loads(cached)
+
+    try:
+        client = get_client()
+        if not client:
+            raise ValueError("GEMINI_API_KEY not found. Please configure .env file.")
+
+        response = await scheduler.call(STORY_MODEL, lambda: client.aio.models.generate_content(
+            model=STORY_MODEL,
+            contents=contents,
+            config=story_generation_config(),
+        ))
+        metrics.record_usage(STORY_MODEL, response.usage_metadata)
+
+        story_data = parse_story_response(response)
+        if cache_key:
+            await asyncio.to_thread(result_cache.put, cache_key, json.dumps(story_data, ensure_ascii=False).encode("utf-8"))
+
+        return story_data
+
+    except Exception as e:
+        print(f"Error generating story: {e}")
+        raise e
+
+async def generate_story_stream_with_gemini(
+    nome: str,
+    estilo: str,
+    universo: str,
+    genero: str,
+    images: List[Dict[str, Any]], # [{"data": bytes, "mime_type": str}]
+    descricao: str = None,
+    use_cache: bool = True
+) -> AsyncIterator[Tuple[str, Any]]:
+    """
+    Streams the story generation, yielding (event, data) as soon as each field is complete:
+    "title", "cover_prompt", "part" ({"index", "text", "image_prompt"}) and finally "story"
+    with the validated Story dict.
+    """
+    with tracing.span("prompt.build", images=len(images)):
+        contents = build_story_contents(nome, estilo, universo, genero, images, descricao)
+
+    cache_key = story_cache_key(contents, images, use_cache)
+    if cache_key:
+        with tracing.span("cache.lookup") as lookup:
+            cached = await asyncio.to_thread(result_cache.get, cache_key)
+            lookup.set(hit=cached is not None)
+        if cached is not None:
+            story_data = json.loads(cached)
+            yield "title", story_data["title"]
+            yield "cover_prompt", story_data["cover_prompt"]
+            for index, part in enumerate(story_data["parts"]):
+                yield "part", {"index": index, "text": part[0], "image_prompt": part[1]}
+            yield "story", story_data
+            return
+
+    client = get_client()
+    if not client:
+        raise ValueError("GEMINI_API_KEY not found. Please configure .env file.")
+
+    parser = StoryStreamParser()
+    chunks = []
+
+    try:
+        # Already-sent events cannot be taken back, so streams hold a slot but are not retried
+        async with scheduler.slot(STORY_MODEL):
+            # Spans cannot wrap the yields of a generator: the stream is recorded afterwards
+            started = time.perf_counter()
+            first_chunk_at = None
+            stream = await client.aio.models.generate_content_stream(
+                model=STORY_MODEL,
+                contents=contents,
+                config=story_generation_config(),
+            )
+
+            usage = None
+            async for chunk in stream:
+                # Each chunk carries the running totals; the last one has the final counts
+                usage = chunk.usage_metadata or usage
+                first_chunk_at = first_chunk_at or time.perf_counter()
+                if not chunk.text:
+                    continue
+                chunks.append(chunk.text)
+                for event, value in parser.feed(chunk.text):
+                    if event == "part":
+                        index, part = value
+                        if not isinstance(part, list) or len(part) != 2:
+                            continue
+                        yield "part", {"index": index, "text": part[0], "image_prompt": part[1]}
+                    else:
+                        yield event, value
+            metrics.record_usage(STORY_MODEL, usage)
+            tracing.record("gemini.stream", started, time.perf_counter(), model=STORY_MODEL,
+                           first_chunk_ms=round((first_chunk_at - started) * 1000, 2) if first_chunk_at else None)
+
+        full_text = "".join(chunks)
+        if not full_text:
+            raise ValueError("Resposta vazia da API")
+
+        story_data = Story.model_validate_json(full_text).model_dump()
+        if cache_key:
+            await asyncio.to_thread(result_cache.put, cache_key, json.dumps(story_data, ensure_ascii=False).encode("utf-8"))
+
+        yield "story", story_data
+
+    except Exception as e:
+        print(f"Error streaming story: {e}")
+        raise e
+
+class Chapter(BaseModel):
+    text: str = Field(description="O novo texto do capítulo (aprox. 250 palavras).")
+
+def build_chapter_contents(
+    title: str,
+    chapters: List[str],
+    index: int,
+    generation: Dict[str, Any],
+    instructions: str = None
+) -> List[Any]:
+    """
+    Prompt to rewrite chapter `index` (0-based) of a saved story, with the other chapters as context.
+    `generation` holds the original story parameters (nome, estilo, universo, genero, descricao), when known.
+    """
+    context = "\n\n".join(
+        f"CAPÍTULO {i + 1}{' (A REESCREVER)' if i == index else ''}:\n{text}"
+        for i, text in enumerate(chapters)
+    )
+    settings = "\n".join(
+        f"    - {label}: {generation[key]}"
+        for key, label in (("nome", "Protagonista"), ("universo", "Universo"), ("estilo", "Estilo Visual/Artístico"),
+                           ("genero", "Gênero"), ("descricao", "Tema/Descrição"))
+        if generation.get(key)
+    )
+    pedido = f"PEDIDO DO AUTOR: {instructions}" if instructions else "Escreva uma nova versão, mantendo os acontecimentos essenciais."
+
+    prompt_text = f"""
+    Reescreva APENAS o capítulo {index + 1} da história "{title}".
+
+    CONFIGURAÇÃO DA HISTÓRIA:
+{settings}
+
+    HISTÓRIA ATUAL:
+    {context}
+
+    REQUISITOS DA SAÍDA:
+    - Gere um JSON estritamente com a estrutura: text (texto do capítulo, aprox. 250 palavras).
+    - O capítulo deve continuar o anterior e levar ao seguinte sem contradizê-los, com o mesmo tom e narrador.
+    - {pedido}
+    """
+    return [prompt_text]
+
+def chapter_generation_config() -> Dict[str, Any]:
+    return {
+        "response_mime_type": "application/json",
+        "response_json_schema": Chapter.model_json_schema(),
+    }
+
+async def generate_chapter_with_gemini_async(
+    title: str,
+    chapters: List[str],
+    index: int,
+    generation: Dict[str, Any],
+    instructions: str = None
+) -> str:
+    """
+    Rewrites one chapter of a saved story (a single Gemini call) and returns its new text.
+    Never cached: asking again is asking for a different text.
+    """
+    contents = build_chapter_contents(title, chapters, index, generation, instructions)
+
+    try:
+        client = get_client()
+        if not client:
+            raise ValueError("GEMINI_API_KEY not found. Please configure .env file.")
+
+        response = await scheduler.call(STORY_MODEL, lambda: client.aio.models.generate_content(
+            model=STORY_MODEL,
+            contents=contents,
+            config=chapter_generation_config(),
+        ))
+        metrics.record_usage(STORY_MODEL, response.usage_metadata)
+
+        if not response or not response.text:
+            raise ValueError("Resposta vazia da API")
+        return Chapter.model_validate_json(response.text).text
+
+    except Exception as e:
+        print(f"Error generating chapter: {e}")
+        raise e
+
+async def generate_image_with_gemini(
+    prompt: str,
+    reference_images: List[Dict[str, Any]],
+    person_name: str,
+    universe_context: str,
+    aspect_ratio: str = "2:3",
+    use_cache: bool = True
+) -> bytes:
+    """
+    Generates a single image using Gemini 3 Pro Image Preview with visual identity consistency.
+    """
+    from google.genai import types
+    
+    # Construct the instruction ensuring identity lock and style adherence
+    instruction = f"""
+    {prompt}
+    
+    IMPORTANTE: O personagem principal desta imagem deve ser exatamente a mesma pessoa que aparece nas fotos anexadas ({person_name}). Mantenha as características faciais e adaptações ao universo: {universe_context}.
+    Use the uploaded selfie as identity reference - IDENTITY LOCK (match face/skin/hair/light).
+    """
+    
+    contents = []
+    contents.append(instruction)
+    
+    # Add reference images for identity
+    for img in reference_images:
+        contents.append(types.Part.from_bytes(data=img["data"], mime_type=img["mime_type"]))
+
+    cache_key = None
+    if result_cache.enabled:
+        if use_cache:
+            cache_key = ResultCache.make_key(
+                IMAGE_MODEL,
+                instruction,
+                {"response_modalities": ["IMAGE"], "aspect_ratio": aspect_ratio, "image_size": IMAGE_SIZE},
+                image_digests(reference_images)
+            )
+            with tracing.span("cache.lookup") as lookup:
+                cached = await asyncio.to_thread(result_cache.get, cache_key)
+                lookup.set(hit=cached is not None)
+            if cached is not None:
+                return cached
+        else:
+            result_cache.bypassed += 1
+
+    client = get_client()
+    if not client:
+        raise ValueError("GEMINI_API_KEY not found.")
+
+    async def attempt():
+        # Using client.aio for async generation
+        response = await client.aio.models.generate_content(
+            model=IMAGE_MODEL,
+            contents=contents,
+            config=types.GenerateContentConfig(
+                response_modalities=['IMAGE'],
+                image_config=types.ImageConfig(aspect_ratio=aspect_ratio, image_size=IMAGE_SIZE),
+            )
+        )
+        # Billed even when the answer has no image
+        metrics.record_usage(IMAGE_MODEL, response.usage_metadata)
+
+        for part in response.parts or []:
+            if part.inline_data:
+                return part.inline_data.data
+
+        raise RetryableError("No valid image data in response.")
+
+    try:
+        image_bytes = await scheduler.call(IMAGE_MODEL, attempt)
+    except Exception as e:
+        print(f"Error generating image: {e}")
+        raise e
+
+    if cache_key:
+        await asyncio.to_thread(result_cache.put, cache_key, image_bytes)
+
+    return image_bytes
+
+async def generate_images_with_gemini(
+    prompts: List[str],
+    reference_images: List[Dict[str, Any]],
+    person_name: str,
+    universe_context: str,
+    aspect_ratio: str = "2:3",
+    max_concurrency: int = 6,
+    use_cache: bool = True
+) -> List[Any]:
+    """
+    Generates several images concurrently, sharing the same reference images.
+    Returns a list aligned with `prompts`: image bytes on success or the exception raised for that prompt.
+    """
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def _generate(prompt: str) -> bytes:
+        async with semaphore:
+            return await generate_image_with_gemini(
+                prompt=prompt,
+                reference_images=reference_images,
+                person_name=person_name,
+                universe_context=universe_context,
+                aspect_ratio=aspect_ratio,
+                use_cache=use_cache
+            )
+
+    return await asyncio.gather(*(_generate(p) for p in prompts), return_exceptions=True)
+
+# Batch jobs still being processed (anything else is final)
+BATCH_PENDING_STATES = {"JOB_STATE_UNSPECIFIED", "JOB_STATE_QUEUED", "JOB_STATE_PENDING", "JOB_STATE_RUNNING", "JOB_STATE_UPDATING", "JOB_STATE_PAUSED"}
+# Batch mode is billed at half the interactive price
+BATCH_PRICE_FACTOR = 0.5
+
+def submit_story_batch(requests: List[Dict[str, Any]], display_name: Optional[str] = None) -> str:
+    """
+    Submits story generations as one Gemini batch job (cheaper, answered within hours
+    instead of seconds). Each request holds the build_story_contents arguments
+    (nome, estilo, universo, genero, images, descricao). Returns the batch job name. Blocking.
+    """
+    client = get_client()
+    if not client:
+        raise ValueError("GEMINI_API_KEY not found. Please configure .env file.")
+
+    inlined = []
+    for request in requests:
+        with tracing.span("prompt.build", images=len(request["images"])):
+            contents = build_story_contents(**request)
+        inlined.append({"contents": contents, "config": story_generation_config()})
+
+    job = client.batches.create(model=STORY_MODEL, src=inlined, config={"display_name": display_name or f"stories-{int(time.time())}"})
+    print(f"Submitted story batch {job.name} ({len(requests)} requests)")
+    return job.name
+
+def story_batch_results(name: str) -> Optional[List[Any]]:
+    """
+    None while the batch job is still running. Once it is done, a list aligned with the
+    submitted requests: the story dict, or the exception for that request. Blocking.
+    """
+    client = get_client()
+    if not client:
+        raise ValueError("GEMINI_API_KEY not found. Please configure .env file.")
+
+    job = client.batches.get(name=name)
+    state = getattr(job.state, "name", str(job.state))
+    if state in BATCH_PENDING_STATES:
+        return None
+    if state not in ("JOB_STATE_SUCCEEDED", "JOB_STATE_PARTIALLY_SUCCEEDED"):
+        raise RuntimeError(f"Batch {name} ended as {state}: {job.error}")
+
+    results = []
+    for item in (job.dest.inlined_responses if job.dest else None) or []:
+        if item.error:
+            results.append(RuntimeError(f"{item.error.code}: {item.error.message}"))
+            continue
+        metrics.record_usage(STORY_MODEL, item.response.usage_metadata, BATCH_PRICE_FACTOR)
+        try:
+            results.append(parse_story_response(item.response))
+        except Exception as e:
+            results.append(e)
+    return results
@@ -0,0 +1,139 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+from email.utils import formatdate, parsedate
+from typing import Optional
+
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Generated images are named after a UUID and never rewritten, so they can be cached forever
+UUID_NAME = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\.[a-z0-9]+$")
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+# Precompressed variants tried in order of preference: (Accept-Encoding token, file suffix)
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+
+
+def write_precompressed(path: str):
+    """
+    Writes `path.gz` (and `path.br` when the brotli package is installed) next to `path`.
+    Blocking; meant to be called right after the file is saved.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+
+    variants = [(".gz", lambda: gzip.compress(data, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variants.append((".br", lambda: brotli.compress(data, quality=11)))
+
+    for suffix, compress in variants:
+        tmp_path = f"{path}{suffix}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(compress())
+        os.replace(tmp_path, path + suffix)
+
+
+def accepted_encodings(headers: Headers) -> set:
+    accepted = set()
+    for item in headers.get("accept-encoding", "").split(","):
+        token, _, params = item.strip().partition(";")
+        if params.strip().replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        if token:
+            accepted.add(token.strip().lower())
+    return accepted
+
+
+class CachedStaticFiles(StaticFiles):
+    """
+    StaticFiles with cache headers suited to generated content:
+    - UUID-named files (generated images) are served as immutable;
+    - everything else must be revalidated (ETag/Last-Modified -> 304);
+    - when `path.br` / `path.gz` exists and is up to date, it is served instead
+      to clients that accept that encoding.
+    """
+
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200) -> Response:
+        request_headers = Headers(scope=scope)
+        full_path = str(full_path)
+
+        if UUID_NAME.search(os.path.basename(full_path)):
+            response = FileResponse(full_path, status_code=status_code, stat_result=stat_result)
+            response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+        else:
+            response = self._precompressed_response(full_path, stat_result, request_headers, status_code)
+            response.headers["Cache-Control"] = REVALIDATE_CACHE_CONTROL
+
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+    def _precompressed_response(self, full_path, stat_result, request_headers: Headers, status_code: int) -> FileResponse:
+        accepted = accepted_encodings(request_headers)
+        has_variants = False
+
+        for encoding, suffix in ENCODINGS:
+            try:
+                variant_stat = os.stat(full_path + suffix)
+            except OSError:
+                continue
+            # A variant older than the file it was made from is stale
+            if variant_stat.st_mtime < stat_result.st_mtime:
+                continue
+            has_variants = True
+            if encoding in accepted:
+                response = FileResponse(
+                    full_path + suffix,
+                    status_code=status_code,
+                    stat_result=variant_stat,
+                    media_type=mimetypes.guess_type(full_path)[0] or "text/plain"
+                )
+                response.headers["Content-Encoding"] = encoding
+                response.headers["Vary"] = "Accept-Encoding"
+                return response
+
+        response = FileResponse(full_path, status_code=status_code, stat_result=stat_result)
+        if has_variants:
+            response.headers["Vary"] = "Accept-Encoding"
+        return response
+
+
+def file_etag(stat_result: os.stat_result, variant: str = "") -> str:
+    return '"' + hashlib.md5(f"{stat_result.st_mtime_ns}-{stat_result.st_size}-{variant}".encode()).hexdigest() + '"'
+
+
+def content_etag(body: bytes) -> str:
+    return '"' + hashlib.md5(body).hexdigest() + '"'
+
+
+def http_date(timestamp: float) -> str:
+    return formatdate(timestamp, usegmt=True)
+
+
+def is_not_modified(request_headers, etag: str, last_modified: Optional[float] = None) -> bool:
+    """
+    Evaluates If-None-Match (preferred) or If-Modified-Since against the current validators.
+    """
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match:
+        if if_none_match.strip() == "*":
+            return True
+        return etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+
+    if_modified_since = request_headers.get("if-modified-since")
+    if if_modified_since and last_modified is not None:
+        parsed = parsedate(if_modified_since)
+        modified = parsedate(http_date(last_modified))
+        return parsed is not None and modified is not None and parsed >= modified
+
+    return False
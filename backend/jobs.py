@@ -0,0 +1,257 @@
+import asyncio
+import json
+import os
+import shutil
+import sqlite3
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+try:
+    from backend import tracing
+except ImportError:
+    import tracing
+
+# A stage receives (job, artifacts, checkpoint) and fills `artifacts` in place.
+# `checkpoint()` persists the artifacts gathered so far, so a restart does not redo them.
+StageHandler = Callable[[Dict[str, Any], Dict[str, Any], Callable[[], Awaitable[None]]], Awaitable[None]]
+
+MIME_EXTENSIONS = {"image/jpeg": ".jpg", "image/png": ".png", "image/webp": ".webp"}
+
+
+class JobStore:
+    """
+    SQLite persistence for generation jobs. Every method is blocking and opens its own
+    connection, so callers run them through asyncio.to_thread.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+
+    def prepare(self):
+        """
+        Creates the schema. Called before first use rather than on construction,
+        so importing the app has no side effects on disk.
+        """
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    stage TEXT,
+                    params TEXT NOT NULL,
+                    artifacts TEXT NOT NULL,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def insert(self, job_id: str, params: Dict[str, Any]):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, status, stage, params, artifacts, error, created_at, updated_at) VALUES (?, 'queued', NULL, ?, '{}', NULL, ?, ?)",
+                (job_id, json.dumps(params, ensure_ascii=False), now, now)
+            )
+
+    def update(self, job_id: str, **fields):
+        if "artifacts" in fields:
+            fields["artifacts"] = json.dumps(fields["artifacts"], ensure_ascii=False)
+        fields["updated_at"] = time.time()
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._connect() as conn:
+            conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["params"] = json.loads(job["params"])
+        job["artifacts"] = json.loads(job["artifacts"])
+        return job
+
+    def unfinished(self) -> List[str]:
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id FROM jobs WHERE status IN ('queued', 'running') ORDER BY created_at"
+            ).fetchall()
+        return [row["id"] for row in rows]
+
+    def failed_before(self, cutoff: float) -> List[str]:
+        with self._connect() as conn:
+            rows = conn.execute("SELECT id FROM jobs WHERE status = 'failed' AND updated_at < ?", (cutoff,)).fetchall()
+        return [row["id"] for row in rows]
+
+
+class JobManager:
+    """
+    Runs book generation jobs on a pool of asyncio workers.
+
+    Stages run in order; each completed stage is recorded in SQLite together with its
+    artifacts, so after a restart unfinished jobs are re-queued and resume from the
+    first stage that did not complete.
+
+    The reference photos of a job (data_dir/<job_id>) are deleted once it is done. Failed
+    jobs keep them for `failed_retention_seconds`, the time they can still be resumed.
+    """
+
+    def __init__(self, db_path: str, data_dir: str, stages: List[Tuple[str, StageHandler]], workers: int = 2,
+                 failed_retention_seconds: float = 86400):
+        self.data_dir = data_dir
+        self.stages = stages
+        self.workers = workers
+        self.failed_retention_seconds = failed_retention_seconds
+        self.store = JobStore(db_path)
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+    async def start(self):
+        await asyncio.to_thread(self.store.prepare)
+        self._queue = asyncio.Queue()
+        for job_id in await asyncio.to_thread(self.store.unfinished):
+            self._queue.put_nowait(job_id)
+        await asyncio.to_thread(self._expire_failed)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, params: Dict[str, Any], reference_images: List[Dict[str, Any]]) -> str:
+        """
+        Persists the job (params + reference photos on disk) and queues it.
+        """
+        job_id = str(uuid.uuid4())
+
+        def _persist():
+            job_dir = os.path.join(self.data_dir, job_id)
+            os.makedirs(job_dir, exist_ok=True)
+            references = []
+            for idx, img in enumerate(reference_images):
+                filename = f"ref_{idx}{MIME_EXTENSIONS.get(img['mime_type'], '.bin')}"
+                with open(os.path.join(job_dir, filename), "wb") as f:
+                    f.write(img["data"])
+                references.append({"file": filename, "mime_type": img["mime_type"], "sha256": img.get("sha256")})
+            self.store.insert(job_id, {**params, "reference_images": references})
+
+        await asyncio.to_thread(_persist)
+        self._queue.put_nowait(job_id)
+        return job_id
+
+    async def resume(self, job_id: str) -> bool:
+        """
+        Re-queues a failed job; it continues from the stage that failed.
+        """
+        job = await asyncio.to_thread(self.store.get, job_id)
+        if job is None or job["status"] != "failed":
+            return False
+        if job["params"].get("reference_images") and not os.path.isdir(os.path.join(self.data_dir, job_id)):
+            # Failed too long ago: its reference photos are gone
+            return False
+        await asyncio.to_thread(self.store.update, job_id, status="queued", error=None)
+        self._queue.put_nowait(job_id)
+        return True
+
+    def _release_references(self, job_id: str):
+        shutil.rmtree(os.path.join(self.data_dir, job_id), ignore_errors=True)
+
+    def _expire_failed(self):
+        """
+        Deletes the reference photos of jobs failed more than failed_retention_seconds ago. Blocking.
+        """
+        for job_id in self.store.failed_before(time.time() - self.failed_retention_seconds):
+            self._release_references(job_id)
+
+    def _load_references(self, job: Dict[str, Any]) -> List[Dict[str, Any]]:
+        images = []
+        for ref in job["params"].get("reference_images", []):
+            with open(os.path.join(self.data_dir, job["id"], ref["file"]), "rb") as f:
+                images.append({"data": f.read(), "mime_type": ref["mime_type"], "sha256": ref.get("sha256")})
+        return images
+
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await self._run(job_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error running job {job_id}: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job_id: str):
+        job = await asyncio.to_thread(self.store.get, job_id)
+        if job is None or job["status"] not in ("queued", "running"):
+            return
+
+        job["reference_images"] = await asyncio.to_thread(self._load_references, job)
+        artifacts = job["artifacts"]
+        completed = artifacts.setdefault("completed_stages", [])
+        await asyncio.to_thread(self.store.update, job_id, status="running")
+
+        async def checkpoint():
+            await asyncio.to_thread(self.store.update, job_id, artifacts=artifacts)
+
+        # Jobs submitted by a traced request emit their own trace, one span per stage
+        with tracing.trace("job", enabled=bool(job["params"].get("trace")), job_id=job_id):
+            for name, handler in self.stages:
+                if name in completed:
+                    continue
+                await asyncio.to_thread(self.store.update, job_id, stage=name)
+                try:
+                    with tracing.span(f"job.{name}"):
+                        await handler(job, artifacts, checkpoint)
+                except Exception as e:
+                    print(f"Job {job_id} failed at stage '{name}': {e}")
+                    await asyncio.to_thread(self.store.update, job_id, status="failed", error=str(e), artifacts=artifacts)
+                    await asyncio.to_thread(self._expire_failed)
+                    return
+                completed.append(name)
+                await checkpoint()
+
+        await asyncio.to_thread(self.store.update, job_id, status="done", stage=None)
+        await asyncio.to_thread(self._release_references, job_id)
+
+    async def describe(self, job_id: str) -> Optional[Dict[str, Any]]:
+        job = await asyncio.to_thread(self.store.get, job_id)
+        if job is None:
+            return None
+
+        artifacts = job["artifacts"]
+        completed = artifacts.get("completed_stages", [])
+        stages = {}
+        for name, _ in self.stages:
+            if name in completed:
+                stages[name] = "done"
+            elif name == job["stage"] and job["status"] in ("running", "failed"):
+                stages[name] = job["status"]
+            else:
+                stages[name] = "pending"
+
+        params = {k: v for k, v in job["params"].items() if k != "reference_images"}
+        return {
+            "id": job["id"],
+            "status": job["status"],
+            "stage": job["stage"],
+            "stages": stages,
+            "params": params,
+            "artifacts": {k: v for k, v in artifacts.items() if k != "completed_stages"},
+            "error": job["error"],
+            "created_at": job["created_at"],
+            "updated_at": job["updated_at"]
+        }
@@ -1,309 +1,1178 @@
-
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
-from fastapi.middleware.cors import CORSMiddleware
-from typing import List
-from pydantic import BaseModel
-import uvicorn
-
-# Import the service
-try:
-    from backend.genai_service import generate_story_with_gemini, generate_image_with_gemini
-except ImportError:
-    from genai_service import generate_story_with_gemini, generate_image_with_gemini
-import shutil
-import uuid
-import os
-import base64
-import json
-import re
-from pathlib import Path
-
-app = FastAPI()
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["http://localhost:5173", "http://127.0.0.1:5173", "http://localhost:5174", "http://127.0.0.1:5174"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-# Ensure temp directory for images exists
-IMG_DIR = "generated_images_temp"
-if not os.path.exists(IMG_DIR):
-    os.makedirs(IMG_DIR)
-
-# Ensure saved stories directory exists
-STORIES_DIR = "story_generated"
-if not os.path.exists(STORIES_DIR):
-    os.makedirs(STORIES_DIR)
-
-# Mount the static directory to serve images
-from fastapi.staticfiles import StaticFiles
-app.mount("/images", StaticFiles(directory=IMG_DIR), name="images")
-app.mount("/stories", StaticFiles(directory=STORIES_DIR), name="stories")
-
-class InputResponse(BaseModel):
-    status: str
-    mensagem: str
-    dados: dict
-
-# Existing endpoint kept for reference or legacy
-@app.post("/teste-inputs", response_model=InputResponse)
-async def teste_inputs(
-    nome: str = Form(..., description="Nome do usuário"),
-    estilo: str = Form(..., description="Estilo de ilustração"),
-    universo: str = Form(..., description="Universo escolhido"),
-    genero: str = Form(..., description="Gênero da história"),
-    imagens: List[UploadFile] = File(..., description="Imagens de referência")
-):
-    """
-    Endpoint para testar o recebimento dos inputs do usuário.
-    """
-    
-    # Processar informações das imagens (sem salvar por enquanto)
-    detalhes_imagens = []
-    for img in imagens:
-        detalhes_imagens.append({
-            "filename": img.filename,
-            "content_type": img.content_type
-        })
-    
-    return {
-        "status": "sucesso",
-        "mensagem": "Inputs recebidos e validados com sucesso!",
-        "dados": {
-            "nome": nome,
-            "estilo": estilo,
-            "universo": universo,
-            "genero": genero,
-            "imagens_recebidas": len(imagens),
-            "detalhes_imagens": detalhes_imagens
-        }
-    }
-
-@app.post("/api/generate-story")
-async def generate_story_endpoint(
-    nome: str = Form(...),
-    estilo: str = Form(...),
-    universo: str = Form(...),
-    genero: str = Form(...),
-    descricao: str = Form(None),
-    imagens: List[UploadFile] = File(...)
-):
-    try:
-        # Process images
-        processed_images = []
-        for img in imagens:
-            content = await img.read()
-            processed_images.append({
-                "data": content,
-                "mime_type": img.content_type
-            })
-
-        # Generate story
-        story_data = generate_story_with_gemini(
-            nome=nome,
-            estilo=estilo,
-            universo=universo,
-            genero=genero,
-            images=processed_images,
-            descricao=descricao
-        )
-        
-        return {
-            "status": "success",
-            "data": story_data
-        }
-
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
-
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
-
-@app.post("/api/generate-image")
-async def generate_image_endpoint(
-    prompt: str = Form(...),
-    person_name: str = Form(...),
-    universe_context: str = Form(...),
-    reference_images: List[UploadFile] = File(...),
-):
-    try:
-        # Process reference images
-        processed_images = []
-        for img in reference_images:
-            content = await img.read()
-            processed_images.append({
-                "data": content,
-                "mime_type": img.content_type
-            })
-
-        # Generate image
-        image_bytes = await generate_image_with_gemini(
-            prompt=prompt,
-            reference_images=processed_images,
-            person_name=person_name,
-            universe_context=universe_context
-        )
-        
-        # Save to file
-        filename = f"{uuid.uuid4()}.png"
-        filepath = os.path.join(IMG_DIR, filename)
-        
-        with open(filepath, "wb") as f:
-            f.write(image_bytes)
-            
-        # Construct URL (assuming local dev)
-        # In production this should be a proper URL
-        image_url = f"/images/{filename}"
-        
-        return {
-            "status": "success",
-            "image_url": image_url,
-            "filepath": filepath
-        }
-
-    except Exception as e:
-        print(f"Error generating image: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
-
-def sanitize_filename(name):
-    return re.sub(r'[<>:"/\\|?*]', '', name).strip()
-
-class SaveStoryRequest(BaseModel):
-    title: str
-    cover_image_url: str
-    chapters: List[dict] # {text: str, image_url: str}
-
-@app.post("/api/save-story")
-async def save_story_endpoint(story: SaveStoryRequest):
-    try:
-        # Create a safe folder name
-        safe_title = sanitize_filename(story.title)
-        # Add a UUID suffix to avoid collisions if titles are same
-        unique_id = str(uuid.uuid4())[:8]
-        folder_name = f"{safe_title}_{unique_id}"
-        story_path = os.path.join(STORIES_DIR, folder_name)
-        
-        os.makedirs(story_path, exist_ok=True)
-
-        # 1. Download/Copy images
-        # Helper to handle image moving
-        def process_image(url, prefix):
-            # Extract filename from URL (assuming /images/filename.png)
-            if "/images/" in url:
-                original_filename = url.split("/images/")[-1]
-                source_path = os.path.join(IMG_DIR, original_filename)
-                
-                new_filename = f"{prefix}_{original_filename}"
-                dest_path = os.path.join(story_path, new_filename)
-                
-                if os.path.exists(source_path):
-                    shutil.copy2(source_path, dest_path)
-                    return new_filename
-                else:
-                    print(f"Warning: Image source not found: {source_path}")
-                    return url
-            return url
-
-        # Process Cover
-        saved_cover = process_image(story.cover_image_url, "cover")
-        
-        # Process Chapters
-        saved_chapters = []
-        for idx, chap in enumerate(story.chapters):
-            saved_img = process_image(chap['image_url'], f"chap_{idx+1}")
-            saved_chapters.append({
-                "text": chap['text'],
-                "image": saved_img
-            })
-
-        # 2. Save story.json
-        final_story_data = {
-            "title": story.title,
-            "cover_image": saved_cover,
-            "chapters": saved_chapters,
-            "id": folder_name
-        }
-        
-        with open(os.path.join(story_path, "story.json"), "w", encoding="utf-8") as f:
-            json.dump(final_story_data, f, ensure_ascii=False, indent=2)
-
-        # 3. Generate index.html (Standalone Site)
-        template_path = os.path.join("backend", "template_site.html")
-        if os.path.exists(template_path):
-            with open(template_path, "r", encoding="utf-8") as t:
-                html_content = t.read()
-            
-            # Inject data
-            json_str = json.dumps(final_story_data, ensure_ascii=False)
-            injection_code = f"window.embeddedStory = {json_str};"
-            html_content = html_content.replace("// __STORY_DATA_INJECTION__", injection_code)
-            
-            with open(os.path.join(story_path, "index.html"), "w", encoding="utf-8") as f:
-                f.write(html_content)
-
-        return {
-            "status": "success",
-            "message": "História salva com sucesso!",
-            "story_id": folder_name,
-            "path": os.path.abspath(story_path)
-        }
-
-    except Exception as e:
-        print(f"Error saving story: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
-
-@app.get("/api/stories")
-async def get_stories():
-    try:
-        stories = []
-        if os.path.exists(STORIES_DIR):
-            for folder in os.listdir(STORIES_DIR):
-                folder_path = os.path.join(STORIES_DIR, folder)
-                json_path = os.path.join(folder_path, "story.json")
-                
-                if os.path.isdir(folder_path) and os.path.exists(json_path):
-                    try:
-                        with open(json_path, "r", encoding="utf-8") as f:
-                            data = json.load(f)
-                            # Fix image URLs for serving
-                            data["cover_image"] = f"/stories/{folder}/{data['cover_image']}"
-                            # We don't need all chapters for the list, just metadata
-                            stories.append({
-                                "id": folder,
-                                "title": data["title"],
-                                "cover": data["cover_image"]
-                            })
-                    except Exception:
-                        continue
-        return stories
-    except Exception as e:
-        print(f"Error listing stories: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
-
-@app.get("/api/stories/{story_id}")
-async def get_story_details(story_id: str):
-    try:
-        folder_path = os.path.join(STORIES_DIR, story_id)
-        json_path = os.path.join(folder_path, "story.json")
-        
-        if not os.path.exists(json_path):
-            raise HTTPException(status_code=404, detail="Story not found")
-            
-        with open(json_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            
-        # Fix image URLs to be absolute server paths for the frontend
-        data["cover_image"] = f"/stories/{story_id}/{data['cover_image']}"
-        for chap in data["chapters"]:
-            chap["image"] = f"/stories/{story_id}/{chap['image']}"
-            
-        return data
-    except Exception as e:
-        print(f"Error loading story: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
-
-if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+
+from fastapi import FastAPI, UploadFile, File, Form, Header, Query, HTTPException, Request, Response
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.concurrency import run_in_threadpool
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+from pydantic import BaseModel
+
+# Import the service
+try:
+    from backend.reference_store import ReferenceImageStore
+    from backend.coalescing import RequestCoalescer, IdempotencyConflict
+    from backend.jobs import JobManager
+    from backend.catalog import StoryCatalog
+    from backend.blob_store import BlobStore
+    from backend.derivatives import DerivativePool, existing_derivatives, variant_name, available_formats
+    from backend.site_renderer import site_template, atomic_write_json
+    from backend.uploads import BodySizeLimitMiddleware, stream_uploads
+    from backend.temp_retention import TempImageRetention
+    from backend.storage import LocalStorage, S3Storage
+    from backend.story_export import VendorCache, cdn_urls, iter_story_zip
+    from backend.metrics import MetricsMiddleware, registry as metrics_registry, CONTENT_TYPE as METRICS_CONTENT_TYPE
+    from backend.tracing import TracingMiddleware
+    from backend import tracing
+    from backend.http_cache import write_precompressed, file_etag, content_etag, http_date, is_not_modified
+    from backend.genai_service import Story, result_cache, scheduler, get_client, image_digests, generate_story_with_gemini_async, generate_story_stream_with_gemini, generate_chapter_with_gemini_async, generate_image_with_gemini, generate_images_with_gemini
+except ImportError:
+    from reference_store import ReferenceImageStore
+    from coalescing import RequestCoalescer, IdempotencyConflict
+    from jobs import JobManager
+    from catalog import StoryCatalog
+    from blob_store import BlobStore
+    from derivatives import DerivativePool, existing_derivatives, variant_name, available_formats
+    from site_renderer import site_template, atomic_write_json
+    from uploads import BodySizeLimitMiddleware, stream_uploads
+    from temp_retention import TempImageRetention
+    from storage import LocalStorage, S3Storage
+    from story_export import VendorCache, cdn_urls, iter_story_zip
+    from metrics import MetricsMiddleware, registry as metrics_registry, CONTENT_TYPE as METRICS_CONTENT_TYPE
+    from tracing import TracingMiddleware
+    import tracing
+    from http_cache import write_precompressed, file_etag, content_etag, http_date, is_not_modified
+    from genai_service import Story, result_cache, scheduler, get_client, image_digests, generate_story_with_gemini_async, generate_story_stream_with_gemini, generate_chapter_with_gemini_async, generate_image_with_gemini, generate_images_with_gemini
+import shutil
+import threading
+import uuid
+import os
+import base64
+import json
+import re
+import asyncio
+import time
+import mimetypes
+from pathlib import Path
+from urllib.parse import quote
+
+@asynccontextmanager
+async def lifespan(app):
+    # Create the data directories / databases and move files of the old flat layout into their shard directories
+    await run_in_threadpool(prepare_data)
+    for storage in (temp_storage, story_storage):
+        moved = await run_in_threadpool(storage.migrate_legacy)
+        if moved:
+            print(f"Moved {moved} entries into shard directories")
+    # Pick up story folders added/removed while the server was down
+    print(f"Story catalog sync: {await run_in_threadpool(catalog.sync)}")
+    live_stories = set(await run_in_threadpool(catalog.ids))
+    print(f"Image blob cleanup: {await run_in_threadpool(blob_store.collect_garbage, live_stories)}")
+    # Background book generation workers (resume unfinished jobs from the last run)
+    await job_manager.start()
+    # Deletes expired / over-cap images from IMG_DIR
+    temp_retention.start()
+    # Creates the Gemini client (and imports the SDK) in the background, so the first
+    # generation does not pay for it and startup does not wait for it
+    if GEMINI_CLIENT_PREWARM:
+        asyncio.get_running_loop().run_in_executor(None, get_client)
+    yield
+    await temp_retention.stop()
+    await job_manager.stop()
+    derivative_pool.shutdown()
+
+app = FastAPI(lifespan=lifespan)
+
+# Set to 1 on workers that run generations: the client (and the SDK import) is then created in
+# the background at startup instead of on the first generation. Off by default, so workers that
+# only serve the library never import the SDK.
+GEMINI_CLIENT_PREWARM = os.getenv("GEMINI_CLIENT_PREWARM", "0").lower() in ("1", "true", "yes")
+
+# Reference photo upload limits (per file, per request, number of files)
+UPLOAD_MAX_FILE_BYTES = int(os.getenv("UPLOAD_MAX_FILE_BYTES", str(15 * 1024 * 1024)))
+UPLOAD_MAX_REQUEST_BYTES = int(os.getenv("UPLOAD_MAX_REQUEST_BYTES", str(40 * 1024 * 1024)))
+UPLOAD_MAX_FILES = int(os.getenv("UPLOAD_MAX_FILES", "8"))
+
+# Bodies above the request cap (plus room for the form fields) are refused before being parsed.
+# Added before CORS so the 413 still carries the CORS headers.
+app.add_middleware(BodySizeLimitMiddleware, max_bytes=UPLOAD_MAX_REQUEST_BYTES + 1024 * 1024)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["http://localhost:5173", "http://127.0.0.1:5173", "http://localhost:5174", "http://127.0.0.1:5174"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+    # Pagination cursor of /api/stories, readable by cross-origin pages too
+    expose_headers=["X-Next-Cursor"],
+)
+
+# Per-request timelines (JSON log lines), for a TRACE_SAMPLE_RATE share of requests and for
+# requests sent with "X-Trace: 1". With PROFILE_DIR set, "X-Profile: 1" also samples stacks.
+app.add_middleware(
+    TracingMiddleware,
+    sample_rate=float(os.getenv("TRACE_SAMPLE_RATE", "0")),
+    profile_dir=os.getenv("PROFILE_DIR") or None,
+    profile_interval=float(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000
+)
+# Traced saves keep a per-stage timing summary in story.json under "trace"
+TRACE_STORY_SUMMARY = os.getenv("TRACE_STORY_SUMMARY", "0").lower() in ("1", "true", "yes")
+
+# Outermost: request count / latency / in-flight per route, exposed on /metrics
+app.add_middleware(MetricsMiddleware)
+
+# Blocking file/object I/O of the storages runs in their own thread pools
+STORAGE_IO_WORKERS = int(os.getenv("STORAGE_IO_WORKERS", "8"))
+
+# Temp directory for generated images, sharded as IMG_DIR/<2 hex>/<uuid>.png
+IMG_DIR = "generated_images_temp"
+temp_storage = LocalStorage(IMG_DIR, io_workers=STORAGE_IO_WORKERS)
+
+# Generated images not saved into a story are dropped after TEMP_IMAGE_TTL_SECONDS, and the
+# directory is kept under TEMP_IMAGE_MAX_BYTES (least recently used images go first)
+temp_retention = TempImageRetention(
+    temp_storage,
+    ttl_seconds=int(os.getenv("TEMP_IMAGE_TTL_SECONDS", "86400")),
+    max_bytes=int(os.getenv("TEMP_IMAGE_MAX_BYTES", str(2 * 1024 ** 3))),
+    promoted_ttl_seconds=int(os.getenv("TEMP_IMAGE_PROMOTED_TTL_SECONDS", "600")),
+    interval_seconds=int(os.getenv("TEMP_IMAGE_SWEEP_SECONDS", "300"))
+)
+
+# Saved stories: STORIES_DIR/<2 hex>/<story_id>/ locally, or an S3-compatible bucket
+# (STORAGE_BACKEND=s3; S3_ENDPOINT_URL points at MinIO or any other S3 stand-in)
+STORIES_DIR = "story_generated"
+if os.getenv("STORAGE_BACKEND", "local") == "s3":
+    story_storage = S3Storage(
+        bucket=os.environ["S3_BUCKET"],
+        prefix=os.getenv("S3_PREFIX", ""),
+        endpoint_url=os.getenv("S3_ENDPOINT_URL"),
+        region=os.getenv("S3_REGION"),
+        io_workers=STORAGE_IO_WORKERS
+    )
+else:
+    story_storage = LocalStorage(STORIES_DIR, io_workers=STORAGE_IO_WORKERS)
+
+# Index of saved stories, so listing the library does not open every story.json
+catalog = StoryCatalog(os.getenv("CATALOG_DB", "catalog.sqlite3"), story_storage)
+
+# Saved story images are stored once by content hash and hardlinked into story folders
+blob_store = BlobStore(os.getenv("BLOB_DIR", "story_blobs"))
+
+# Thumbnail / mid-size WebP (+ AVIF) variants are produced in worker processes
+derivative_pool = DerivativePool(workers=int(os.getenv("DERIVATIVE_WORKERS", "2")))
+
+# Max number of Gemini image calls running at once for a single batch request
+IMAGE_BATCH_CONCURRENCY = int(os.getenv("IMAGE_BATCH_CONCURRENCY", "6"))
+
+# Normalized reference photos, reused by handle across story and image calls.
+# Gemini tiles images in 768px blocks, so anything above 2x2 tiles is wasted payload.
+reference_store = ReferenceImageStore(
+    ttl_seconds=int(os.getenv("REFERENCE_TTL_SECONDS", "3600")),
+    max_side=int(os.getenv("REFERENCE_MAX_SIDE", "1536"))
+)
+
+# Duplicate generation requests (double clicks, client retries) share a single Gemini call.
+# Results of requests sent with an Idempotency-Key are replayed for IDEMPOTENCY_TTL_SECONDS.
+coalescer = RequestCoalescer(ttl_seconds=int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "600")))
+
+# Local copies of the CDN assets of the story site, bundled into exported ZIPs
+vendor_cache = VendorCache(os.getenv("VENDOR_CACHE_DIR", "vendor_cache"))
+
+def prepare_data():
+    """
+    Creates the storage roots, the story catalog schema and the blob store. Called at startup
+    (and by the offline scripts) rather than on import, so importing the app touches no files. Blocking.
+    """
+    for storage in (temp_storage, story_storage):
+        storage.prepare()
+    catalog.prepare()
+    blob_store.prepare()
+
+# Mount the storages to serve images and saved stories
+app.mount("/images", temp_storage.static_files(), name="images")
+app.mount("/stories", story_storage.static_files(), name="stories")
+
+class InputResponse(BaseModel):
+    status: str
+    mensagem: str
+    dados: dict
+
+# Existing endpoint kept for reference or legacy
+@app.post("/teste-inputs", response_model=InputResponse)
+async def teste_inputs(
+    nome: str = Form(..., description="Nome do usuário"),
+    estilo: str = Form(..., description="Estilo de ilustração"),
+    universo: str = Form(..., description="Universo escolhido"),
+    genero: str = Form(..., description="Gênero da história"),
+    imagens: List[UploadFile] = File(..., description="Imagens de referência")
+):
+    """
+    Endpoint para testar o recebimento dos inputs do usuário.
+    """
+    
+    # Processar informações das imagens (sem salvar por enquanto)
+    detalhes_imagens = []
+    for img in imagens:
+        detalhes_imagens.append({
+            "filename": img.filename,
+            "content_type": img.content_type
+        })
+    
+    return {
+        "status": "sucesso",
+        "mensagem": "Inputs recebidos e validados com sucesso!",
+        "dados": {
+            "nome": nome,
+            "estilo": estilo,
+            "universo": universo,
+            "genero": genero,
+            "imagens_recebidas": len(imagens),
+            "detalhes_imagens": detalhes_imagens
+        }
+    }
+
+async def collect_reference_images(uploads: List[UploadFile], reference_ids: List[str]):
+    """
+    Resolves reference photos from previously ingested handles and/or new uploads.
+    New uploads go through the reference store too, so Gemini always receives the normalized version.
+    Oversized uploads are rejected with 413, non-images with 415.
+    """
+    processed_images = []
+    for handle in reference_ids or []:
+        entry = reference_store.get(handle)
+        if entry is None:
+            raise HTTPException(status_code=404, detail=f"Imagem de referência não encontrada ou expirada: {handle}")
+        processed_images.append(entry)
+
+    # Streamed in chunks: size limits and type are checked before anything is decoded
+    with tracing.span("uploads.read", files=len(uploads or [])):
+        uploads = await stream_uploads(uploads or [], UPLOAD_MAX_FILES, UPLOAD_MAX_FILE_BYTES, UPLOAD_MAX_REQUEST_BYTES)
+    for upload in uploads:
+        try:
+            with tracing.span("uploads.normalize", bytes=upload["size"]):
+                entry = await run_in_threadpool(
+                    reference_store.ingest_file, upload["file"], upload["sha256"], upload["size"], upload["mime_type"]
+                )
+        except ValueError as e:
+            raise HTTPException(status_code=415, detail=f"{e}: {upload['filename']}")
+        processed_images.append(entry)
+
+    if not processed_images:
+        raise HTTPException(status_code=422, detail="Envie imagens de referência ou reference_ids.")
+
+    return processed_images
+
+async def run_coalesced(endpoint, fields, images, idempotency_key, response: Response, factory):
+    """
+    Runs `factory` through the coalescer, keyed by the request fields and reference image digests.
+    """
+    fingerprint = RequestCoalescer.fingerprint(endpoint, {**fields, "images": image_digests(images)})
+    try:
+        result, outcome = await coalescer.run(endpoint, fingerprint, factory, idempotency_key)
+    except IdempotencyConflict as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    if outcome != "executed":
+        response.headers["X-Coalesced"] = outcome
+    return result
+
+@app.post("/api/reference-images")
+async def ingest_reference_images(
+    imagens: List[UploadFile] = File(..., description="Fotos de referência do protagonista")
+):
+    """
+    Normalizes reference photos once and returns handles accepted by the generation endpoints
+    (`reference_ids`) in place of re-uploading the files.
+    """
+    entries = await collect_reference_images(imagens, None)
+
+    return {
+        "status": "success",
+        "reference_ids": [entry["id"] for entry in entries],
+        "images": [
+            {
+                "id": entry["id"],
+                "mime_type": entry["mime_type"],
+                "width": entry["width"],
+                "height": entry["height"],
+                "original_bytes": entry["original_bytes"],
+                "bytes": len(entry["data"])
+            }
+            for entry in entries
+        ],
+        "expires_in": reference_store.ttl_seconds
+    }
+
+@app.post("/api/generate-story")
+async def generate_story_endpoint(
+    response: Response,
+    nome: str = Form(...),
+    estilo: str = Form(...),
+    universo: str = Form(...),
+    genero: str = Form(...),
+    descricao: str = Form(None),
+    imagens: List[UploadFile] = File(None),
+    reference_ids: List[str] = Form(None),
+    no_cache: bool = Form(False),
+    idempotency_key: str = Header(None)
+):
+    processed_images = await collect_reference_images(imagens, reference_ids)
+
+    async def generate():
+        try:
+            # Generate story
+            story_data = await generate_story_with_gemini_async(
+                nome=nome,
+                estilo=estilo,
+                universo=universo,
+                genero=genero,
+                images=processed_images,
+                descricao=descricao,
+                use_cache=not no_cache
+            )
+
+            return {
+                "status": "success",
+                "data": story_data
+            }
+
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+    fields = {"nome": nome, "estilo": estilo, "universo": universo, "genero": genero, "descricao": descricao, "no_cache": no_cache}
+    return await run_coalesced("generate-story", fields, processed_images, idempotency_key, response, generate)
+
+def sse_event(event: str, data) -> str:
+    payload = json.dumps(data, ensure_ascii=False)
+    return f"event: {event}\ndata: {payload}\n\n"
+
+@app.post("/api/generate-story/stream")
+async def generate_story_stream_endpoint(
+    nome: str = Form(...),
+    estilo: str = Form(...),
+    universo: str = Form(...),
+    genero: str = Form(...),
+    descricao: str = Form(None),
+    imagens: List[UploadFile] = File(None),
+    reference_ids: List[str] = Form(None),
+    no_cache: bool = Form(False)
+):
+    """
+    Server-Sent Events version of /api/generate-story.
+    Emits `title`, `cover_prompt` and one `part` per chapter as soon as they are written,
+    then a final `story` event with the validated story (or an `error` event).
+    """
+    processed_images = await collect_reference_images(imagens, reference_ids)
+
+    async def event_stream():
+        try:
+            async for event, data in generate_story_stream_with_gemini(
+                nome=nome,
+                estilo=estilo,
+                universo=universo,
+                genero=genero,
+                images=processed_images,
+                descricao=descricao,
+                use_cache=not no_cache
+            ):
+                yield sse_event(event, data)
+        except Exception as e:
+            yield sse_event("error", {"detail": str(e)})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.post("/api/generate-image")
+async def generate_image_endpoint(
+    response: Response,
+    prompt: str = Form(...),
+    person_name: str = Form(...),
+    universe_context: str = Form(...),
+    reference_images: List[UploadFile] = File(None),
+    reference_ids: List[str] = Form(None),
+    no_cache: bool = Form(False),
+    idempotency_key: str = Header(None),
+):
+    processed_images = await collect_reference_images(reference_images, reference_ids)
+
+    async def generate():
+        try:
+            # Generate image
+            image_bytes = await generate_image_with_gemini(
+                prompt=prompt,
+                reference_images=processed_images,
+                person_name=person_name,
+                universe_context=universe_context,
+                use_cache=not no_cache
+            )
+
+            image_url, filepath = await save_generated_image(image_bytes)
+            schedule_derivatives(filepath)
+
+            return {
+                "status": "success",
+                "image_url": image_url,
+                "filepath": filepath
+            }
+
+        except Exception as e:
+            print(f"Error generating image: {e}")
+            raise HTTPException(status_code=500, detail=str(e))
+
+    fields = {"prompt": prompt, "person_name": person_name, "universe_context": universe_context, "no_cache": no_cache}
+    return await run_coalesced("generate-image", fields, processed_images, idempotency_key, response, generate)
+
+async def save_generated_image(image_bytes):
+    """
+    Saves generated image bytes into the temp storage (off the event loop) and returns (image_url, filepath).
+    """
+    filename = f"{uuid.uuid4()}.png"
+    with tracing.span("image.write", bytes=len(image_bytes)):
+        filepath = await temp_storage.write(filename, image_bytes)
+    temp_retention.touch(filename, len(image_bytes))
+
+    # Construct URL (assuming local dev)
+    # In production this should be a proper URL
+    return f"/images/{filename}", filepath
+
+def schedule_derivatives(filepath):
+    """
+    Starts the variants of a new temp image in the background; the image is kept
+    by the temp sweeper until they are written.
+    """
+    temp_retention.pin_until_done(derivative_pool.schedule(filepath), os.path.basename(filepath))
+
+def temp_image_names(urls):
+    """
+    IMG_DIR file names behind `/images/...` URLs.
+    """
+    return [url.split("/images/")[-1] for url in urls if url and "/images/" in url]
+
+@app.post("/api/generate-images")
+async def generate_images_endpoint(
+    response: Response,
+    story: str = Form(..., description="JSON retornado por /api/generate-story (cover_prompt + parts)"),
+    person_name: str = Form(...),
+    universe_context: str = Form(...),
+    reference_images: List[UploadFile] = File(None),
+    reference_ids: List[str] = Form(None),
+    max_concurrency: int = Form(None),
+    no_cache: bool = Form(False),
+    idempotency_key: str = Header(None),
+):
+    """
+    Generates the cover and every chapter illustration of a story concurrently.
+    Reference images are uploaded once and shared by all generations.
+    """
+    try:
+        story_data = Story.model_validate_json(story)
+    except Exception as e:
+        raise HTTPException(status_code=422, detail=f"Invalid story payload: {e}")
+
+    processed_images = await collect_reference_images(reference_images, reference_ids)
+
+    async def generate():
+        try:
+            prompts = [story_data.cover_prompt] + [part[1] for part in story_data.parts]
+            results = await generate_images_with_gemini(
+                prompts=prompts,
+                reference_images=processed_images,
+                person_name=person_name,
+                universe_context=universe_context,
+                max_concurrency=max_concurrency or IMAGE_BATCH_CONCURRENCY,
+                use_cache=not no_cache
+            )
+
+            images = []
+            for result in results:
+                if isinstance(result, Exception):
+                    print(f"Error generating image: {result}")
+                    images.append({"image_url": None, "error": str(result)})
+                else:
+                    image_url, filepath = await save_generated_image(result)
+                    schedule_derivatives(filepath)
+                    images.append({"image_url": image_url, "error": None})
+
+            return {
+                "status": "success" if all(img["error"] is None for img in images) else "partial",
+                "cover": images[0],
+                "chapters": images[1:]
+            }
+
+        except Exception as e:
+            print(f"Error generating images: {e}")
+            raise HTTPException(status_code=500, detail=str(e))
+
+    fields = {"story": story_data.model_dump(), "person_name": person_name, "universe_context": universe_context, "no_cache": no_cache}
+    return await run_coalesced("generate-images", fields, processed_images, idempotency_key, response, generate)
+
+def sanitize_filename(name):
+    return re.sub(r'[<>:"/\\|?*]', '', name).strip()
+
+class SaveStoryRequest(BaseModel):
+    title: str
+    cover_image_url: str
+    chapters: List[dict] # {text: str, image_url: str, image_prompt: str (optional)}
+    # Kept in story.json so single chapters can be regenerated later
+    cover_prompt: Optional[str] = None
+    generation: Optional[dict] = None # {nome, estilo, universo, genero, descricao}
+
+# Story parameters stored with a saved story (see SaveStoryRequest.generation)
+GENERATION_FIELDS = ("nome", "estilo", "universo", "genero", "descricao")
+
+def link_story_image(story_path, url, prefix, assets, image_variants):
+    """
+    Links a temp image (a `/images/...` URL) and its variants into a story folder as
+    `<prefix>_<name>`, through the blob store, recording them in `assets` / `image_variants`.
+    Returns the file name in the story, or `url` itself when it is not a temp image. Blocking.
+    """
+    def link_asset(source_path, dest_filename):
+        if not story_storage.is_local:
+            # Uploaded by publish(); nothing local to deduplicate
+            shutil.copyfile(source_path, os.path.join(story_path, dest_filename))
+            assets[dest_filename] = BlobStore.digest_file(source_path) + os.path.splitext(source_path)[1].lower()
+            return
+        blob = blob_store.put_file(source_path)
+        blob_store.link_to(blob, os.path.join(story_path, dest_filename))
+        assets[dest_filename] = blob
+
+    # Extract filename from URL (assuming /images/filename.png)
+    if "/images/" in url:
+        original_filename = url.split("/images/")[-1]
+        source_path = temp_storage.resolve(original_filename)
+        
+        new_filename = f"{prefix}_{original_filename}"
+        
+        if source_path is not None:
+            link_asset(source_path, new_filename)
+
+            linked = {}
+            for size, formats in (existing_derivatives(source_path) or {}).items():
+                for fmt, name in formats.items():
+                    dest_name = variant_name(size, new_filename, fmt)
+                    link_asset(os.path.join(os.path.dirname(source_path), name), dest_name)
+                    linked.setdefault(size, {})[fmt] = dest_name
+            if linked:
+                image_variants[new_filename] = linked
+            return new_filename
+        else:
+            print(f"Warning: Image source not found: {original_filename}")
+            return url
+    return url
+
+def write_story_files(folder_name, story_path, story_data):
+    """
+    Writes story.json + the standalone index.html of a story into `story_path`, publishes
+    the folder to the story storage (only the files in `story_path`: a no-op for local
+    storage) and refreshes its catalog entry. Blocking.
+    """
+    json_path = os.path.join(story_path, "story.json")
+    with tracing.span("save.write_json"):
+        story_json = atomic_write_json(json_path, story_data)
+
+    # Standalone site
+    html_path = os.path.join(story_path, "index.html")
+    with tracing.span("save.render_html"):
+        rendered = site_template.render_to(html_path, story_data, site_template.source_digest(story_json))
+
+    if story_storage.is_local:
+        with tracing.span("save.precompress"):
+            if rendered:
+                write_precompressed(html_path)
+            write_precompressed(json_path)
+            blob_store.replace_refs(folder_name, story_data.get("assets", {}).values())
+    with tracing.span("save.publish", local=story_storage.is_local):
+        story_storage.publish(folder_name, story_path)
+
+    cover = story_data["cover_image"]
+    with tracing.span("save.catalog"):
+        catalog.upsert(folder_name, story_data["title"], cover, story_data.get("created_at", time.time()),
+                       story_storage.stat(f"{folder_name}/story.json").st_mtime, story_data.get("variants", {}).get(cover),
+                       [chap["text"] for chap in story_data["chapters"]])
+
+def story_folder_name(title):
+    # A safe folder name, with a UUID suffix to avoid collisions if titles are same
+    return f"{sanitize_filename(title)}_{str(uuid.uuid4())[:8]}"
+
+def save_story(title, cover_image_url, chapters, cover_prompt=None, generation=None, folder_name=None):
+    """
+    Links the story images from the temp storage (through the blob store) into a new story
+    folder and writes story.json + the standalone index.html, then publishes the folder
+    to the story storage (a no-op for local storage). Blocking.
+    With `folder_name`, a story already saved under that name is overwritten.
+    """
+    folder_name = folder_name or story_folder_name(title)
+    story_path = story_storage.staging_folder(folder_name)
+
+    # 1. Link images (and their variants) from the blob store
+    assets = {}
+    image_variants = {}
+
+    # Process Cover
+    with tracing.span("save.link_images", chapters=len(chapters)):
+        saved_cover = link_story_image(story_path, cover_image_url, "cover", assets, image_variants)
+    
+        # Process Chapters
+        saved_chapters = []
+        for idx, chap in enumerate(chapters):
+            saved_img = link_story_image(story_path, chap['image_url'], f"chap_{idx+1}", assets, image_variants)
+            saved_chapters.append({
+                "text": chap['text'],
+                "image": saved_img,
+                "image_prompt": chap.get('image_prompt')
+            })
+
+    # 2. Save story.json and index.html
+    final_story_data = {
+        "title": title,
+        "cover_image": saved_cover,
+        "chapters": saved_chapters,
+        "id": folder_name,
+        "created_at": time.time(),
+        "assets": assets,
+        "variants": image_variants,
+        "cover_prompt": cover_prompt,
+        "generation": {key: generation.get(key) for key in GENERATION_FIELDS} if generation else None
+    }
+    current_trace = tracing.current()
+    if TRACE_STORY_SUMMARY and current_trace is not None:
+        # Timings of the traced request / job up to this point
+        final_story_data["trace"] = current_trace.summary()
+
+    write_story_files(folder_name, story_path, final_story_data)
+
+    return {
+        "status": "success",
+        "message": "História salva com sucesso!",
+        "story_id": folder_name,
+        "path": os.path.abspath(story_path) if story_storage.is_local else story_storage.object_key(folder_name)
+    }
+
+# Serializes in-place story updates, so two edits of a story do not overwrite each other
+story_update_lock = threading.Lock()
+
+def update_story(story_id, changes):
+    """
+    Applies `changes` (the fields of StoryPatch) to a saved story in place: only replaced
+    images are linked into its folder, then story.json and index.html are rewritten and the
+    catalog entry refreshed. Files of replaced images are deleted afterwards. Blocking.
+    Raises KeyError for an unknown story, IndexError for an unknown chapter and
+    ValueError for an image URL that is not a temp image.
+    """
+    chapter_changes = changes.get("chapters") or {}
+    new_images = [changes.get("cover_image_url")] + [chap.get("image_url") for chap in chapter_changes.values()]
+    for url in filter(None, new_images):
+        if "/images/" not in url or temp_storage.resolve(url.split("/images/")[-1]) is None:
+            raise ValueError(f"Image not found: {url}")
+
+    with story_update_lock:
+        try:
+            raw = story_storage.read_bytes(f"{story_id}/story.json")
+        except (FileNotFoundError, ValueError):
+            raise KeyError(story_id)
+        story_data = json.loads(raw)
+        chapters = story_data["chapters"]
+        for number in chapter_changes:
+            if not 1 <= number <= len(chapters):
+                raise IndexError(f"Chapter {number} not found")
+
+        story_path = story_storage.staging_folder(story_id)
+        assets = story_data.setdefault("assets", {})
+        image_variants = story_data.setdefault("variants", {})
+        replaced = []
+
+        def replace_image(old_name, url, prefix):
+            new_name = link_story_image(story_path, url, prefix, assets, image_variants)
+            if old_name != new_name and old_name in assets:
+                replaced.append(old_name)
+                for formats in image_variants.pop(old_name, {}).values():
+                    replaced.extend(formats.values())
+                for name in replaced:
+                    assets.pop(name, None)
+            return new_name
+
+        with tracing.span("save.link_images", chapters=len(chapter_changes)):
+            if changes.get("title"):
+                story_data["title"] = changes["title"]
+            if changes.get("cover_prompt"):
+                story_data["cover_prompt"] = changes["cover_prompt"]
+            if changes.get("cover_image_url"):
+                story_data["cover_image"] = replace_image(story_data["cover_image"], changes["cover_image_url"], "cover")
+            for number, chap_changes in chapter_changes.items():
+                chapter = chapters[number - 1]
+                for field in ("text", "image_prompt"):
+                    if chap_changes.get(field):
+                        chapter[field] = chap_changes[field]
+                if chap_changes.get("image_url"):
+                    chapter["image"] = replace_image(chapter["image"], chap_changes["image_url"], f"chap_{number}")
+        story_data["updated_at"] = time.time()
+
+        write_story_files(story_id, story_path, story_data)
+        # Only now: readers of the previous story.json may still be loading these
+        for name in replaced:
+            story_storage.delete(f"{story_id}/{name}")
+    return story_data
+
+async def prepare_image_variants(urls):
+    """
+    Makes sure the temp images about to be saved have their variants on disk
+    (waiting for the background job started by the generation endpoint if needed).
+    """
+    paths = [temp_storage.resolve(name) for name in temp_image_names(urls)]
+    results = await asyncio.gather(
+        *(derivative_pool.ensure(path) for path in paths if path is not None),
+        return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            print(f"Warning: could not create image variants: {result}")
+
+def pick_image(story_id, filename, variants, size, fmt):
+    """
+    URL of `filename` at the requested size ("thumb", "medium" or "full"), falling back to the original.
+    """
+    if size != "full":
+        formats = (variants or {}).get(filename, {}).get(size, {})
+        name = formats.get(fmt) or formats.get("webp")
+        if name:
+            return f"/stories/{story_id}/{name}"
+    return f"/stories/{story_id}/{filename}"
+
+def preferred_image_format(request: Request):
+    return "avif" if "image/avif" in request.headers.get("accept", "") and "avif" in available_formats() else "webp"
+
+@app.post("/api/save-story")
+async def save_story_endpoint(story: SaveStoryRequest):
+    urls = [story.cover_image_url] + [chap.get("image_url") for chap in story.chapters]
+    try:
+        with temp_retention.pinned(temp_image_names(urls)):
+            with tracing.span("save.prepare_variants"):
+                await prepare_image_variants(urls)
+            saved = await run_in_threadpool(save_story, story.title, story.cover_image_url, story.chapters,
+                                            story.cover_prompt, story.generation)
+        temp_retention.mark_promoted(temp_image_names(urls))
+        return saved
+
+    except Exception as e:
+        print(f"Error saving story: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+def conditional_json(request: Request, payload, headers=None):
+    """
+    JSON response with a content ETag; answers 304 when the client already has it.
+    """
+    response = JSONResponse(payload, headers=headers)
+    response.headers["ETag"] = content_etag(response.body)
+    if is_not_modified(request.headers, response.headers["ETag"]):
+        return Response(status_code=304, headers={k: v for k, v in response.headers.items() if k.lower() not in ("content-length", "content-type")})
+    return response
+
+@app.get("/api/stories")
+async def get_stories(
+    request: Request,
+    limit: int = Query(50, ge=1, le=500),
+    cursor: str = Query(None, description="Valor de X-Next-Cursor da página anterior"),
+    order: str = Query("desc", pattern="^(asc|desc)$"),
+    size: str = Query("thumb", pattern="^(thumb|medium|full)$")
+):
+    """
+    Lists saved stories from the catalog, newest first by default.
+    Covers are returned as `size` variants (thumbnail by default, AVIF when the client accepts it).
+    The next page cursor is returned in the X-Next-Cursor header.
+    """
+    try:
+        rows, next_cursor = await run_in_threadpool(catalog.page, limit, cursor, order)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        print(f"Error listing stories: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    fmt = preferred_image_format(request)
+    stories = [
+        {
+            "id": row["id"],
+            "title": row["title"],
+            # Fix image URLs for serving
+            "cover": pick_image(row["id"], row["cover"], {row["cover"]: row["cover_variants"]}, size, fmt),
+            "created_at": row["created_at"]
+        }
+        for row in rows
+    ]
+
+    headers = {"Cache-Control": "no-cache", "Vary": "Accept"}
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+    return conditional_json(request, stories, headers)
+
+# Declared before /api/stories/{story_id} so "search" is not taken for a story id
+@app.get("/api/stories/search")
+async def search_stories(
+    request: Request,
+    q: str = Query(..., min_length=1, max_length=200, description="Palavras buscadas no título e nos capítulos"),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0, le=10000),
+    cursor: str = Query(None, description="Valor de next_cursor da página anterior"),
+    size: str = Query("thumb", pattern="^(thumb|medium|full)$")
+):
+    """
+    Full-text search over titles and chapter texts (accents and Portuguese plurals are ignored,
+    the last word matches as a prefix). Results are ranked by relevance; each one carries a
+    snippet of its best matching chapter, with highlight offsets into the snippet text.
+    At most the best 100 matches are returned (`total` stops there); the next page
+    cursor is returned as `next_cursor` and in the X-Next-Cursor header.
+    """
+    try:
+        rows, total, _, next_cursor = await run_in_threadpool(catalog.search, q, limit, offset, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        print(f"Error searching stories: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    fmt = preferred_image_format(request)
+    results = [
+        {
+            "id": row["id"],
+            "title": row["title"],
+            "cover": pick_image(row["id"], row["cover"], {row["cover"]: row["cover_variants"]}, size, fmt),
+            "created_at": row["created_at"],
+            "score": row["score"],
+            "snippet": row["snippet"]
+        }
+        for row in rows
+    ]
+    payload = {"query": q, "total": total, "offset": offset, "limit": limit, "next_cursor": next_cursor, "results": results}
+    headers = {"Cache-Control": "no-cache", "Vary": "Accept"}
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+    return conditional_json(request, payload, headers)
+
+def with_image_urls(story_id, data, size="full", fmt="webp"):
+    """
+    Fixes the image file names of a story.json to be absolute server paths for the frontend.
+    """
+    variants = data.get("variants")
+    data["cover_image"] = pick_image(story_id, data["cover_image"], variants, size, fmt)
+    for chap in data["chapters"]:
+        chap["image"] = pick_image(story_id, chap["image"], variants, size, fmt)
+    return data
+
+@app.get("/api/stories/{story_id}")
+async def get_story_details(
+    story_id: str,
+    request: Request,
+    size: str = Query("full", pattern="^(thumb|medium|full)$")
+):
+    try:
+        json_key = f"{story_id}/story.json"
+        try:
+            stat_result = await story_storage.stat_async(json_key)
+        except ValueError:
+            stat_result = None
+        if stat_result is None:
+            raise HTTPException(status_code=404, detail="Story not found")
+
+        # Validators come from story.json itself, so a revalidation costs one stat()
+        fmt = preferred_image_format(request)
+        headers = {
+            "ETag": file_etag(stat_result, f"{size}-{fmt}"),
+            "Vary": "Accept",
+            "Last-Modified": http_date(stat_result.st_mtime),
+            "Cache-Control": "no-cache"
+        }
+        if is_not_modified(request.headers, headers["ETag"], stat_result.st_mtime):
+            return Response(status_code=304, headers=headers)
+
+        data = json.loads(await story_storage.read(json_key))
+        return JSONResponse(with_image_urls(story_id, data, size, fmt), headers=headers)
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error loading story: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/stories/{story_id}/export")
+async def export_story(story_id: str):
+    """
+    Downloads a saved story as a ZIP that works offline (story.json, index.html, images and
+    the vendored page-flip script, fonts and textures). The archive is streamed while it is built.
+    """
+    try:
+        stat_result = await story_storage.stat_async(f"{story_id}/story.json")
+    except ValueError:
+        stat_result = None
+    if stat_result is None:
+        raise HTTPException(status_code=404, detail="Story not found")
+
+    parts = site_template.parts()
+    urls = cdn_urls((parts[0] + parts[1]).decode("utf-8")) if parts else []
+    manifest = await vendor_cache.ensure(urls)
+
+    filename = quote(f"{story_id}.zip")
+    return StreamingResponse(
+        iter_story_zip(story_storage, story_id, manifest, stat_result.st_mtime),
+        media_type="application/zip",
+        headers={"Content-Disposition": f"attachment; filename=\"story.zip\"; filename*=UTF-8''{filename}"}
+    )
+
+class ChapterPatch(BaseModel):
+    text: Optional[str] = None
+    image_prompt: Optional[str] = None
+    image_url: Optional[str] = None # /images/... URL returned by a generation endpoint
+
+class StoryPatch(BaseModel):
+    title: Optional[str] = None
+    cover_prompt: Optional[str] = None
+    cover_image_url: Optional[str] = None
+    chapters: Dict[int, ChapterPatch] = {} # by chapter number, starting at 1
+
+async def apply_story_update(story_id, changes):
+    """
+    Runs update_story with the new temp images pinned and their variants ready.
+    """
+    urls = [changes.get("cover_image_url")] + [chap.get("image_url") for chap in (changes.get("chapters") or {}).values()]
+    try:
+        with temp_retention.pinned(temp_image_names(urls)):
+            with tracing.span("save.prepare_variants"):
+                await prepare_image_variants(urls)
+            story_data = await run_in_threadpool(update_story, story_id, changes)
+        temp_retention.mark_promoted(temp_image_names(urls))
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Story not found")
+    except IndexError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except Exception as e:
+        print(f"Error updating story: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    return {"status": "success", "story_id": story_id, "story": with_image_urls(story_id, story_data)}
+
+@app.patch("/api/stories/{story_id}")
+async def patch_story(story_id: str, patch: StoryPatch):
+    """
+    Edits a saved story in place: title, chapter texts, the stored image prompts, and
+    illustrations replaced by images from the generation endpoints (`/images/...` URLs).
+    Only the replaced images are written; story.json and index.html are updated.
+    """
+    return await apply_story_update(story_id, patch.model_dump(exclude_none=True))
+
+@app.post("/api/stories/{story_id}/chapters/{number}/regenerate")
+async def regenerate_chapter(
+    story_id: str,
+    number: int,
+    target: str = Form("image", pattern="^(text|image)$"),
+    instrucoes: str = Form(None),
+    prompt: str = Form(None),
+    reference_images: List[UploadFile] = File(None),
+    reference_ids: List[str] = Form(None)
+):
+    """
+    Regenerates one chapter of a saved story with a single Gemini call and updates the story
+    in place: its text (`target=text`, optionally guided by `instrucoes`) or its illustration
+    (`target=image`; chapter 0 is the cover). Illustrations use the prompt stored at save time
+    unless `prompt` is sent, and the reference photos sent (the cover when there are none).
+    """
+    try:
+        story_data = json.loads(await story_storage.read(f"{story_id}/story.json"))
+    except (FileNotFoundError, ValueError):
+        raise HTTPException(status_code=404, detail="Story not found")
+    chapters = story_data["chapters"]
+    if not 0 <= number <= len(chapters) or (number == 0 and target == "text"):
+        raise HTTPException(status_code=404, detail=f"Chapter {number} not found")
+    generation = story_data.get("generation") or {}
+
+    if target == "text":
+        try:
+            text = await generate_chapter_with_gemini_async(
+                title=story_data["title"],
+                chapters=[chap["text"] for chap in chapters],
+                index=number - 1,
+                generation=generation,
+                instructions=instrucoes
+            )
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+        return await apply_story_update(story_id, {"chapters": {number: {"text": text}}})
+
+    image_prompt = prompt or (story_data.get("cover_prompt") if number == 0 else chapters[number - 1].get("image_prompt"))
+    if not image_prompt:
+        raise HTTPException(status_code=409, detail="No image prompt stored for this chapter; send `prompt`.")
+
+    if reference_images or reference_ids:
+        processed_images = await collect_reference_images(reference_images, reference_ids)
+    else:
+        # The protagonist as already illustrated on the cover
+        cover = story_data["cover_image"]
+        try:
+            cover_bytes = await story_storage.read(f"{story_id}/{cover}")
+        except (FileNotFoundError, ValueError):
+            raise HTTPException(status_code=422, detail="Envie imagens de referência ou reference_ids.")
+        processed_images = [await run_in_threadpool(reference_store.ingest, cover_bytes, mimetypes.guess_type(cover)[0])]
+
+    try:
+        image_bytes = await generate_image_with_gemini(
+            prompt=image_prompt,
+            reference_images=processed_images,
+            person_name=generation.get("nome") or "",
+            universe_context=generation.get("universo") or "",
+            use_cache=False
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    image_url, filepath = await save_generated_image(image_bytes)
+    schedule_derivatives(filepath)
+
+    if number == 0:
+        changes = {"cover_image_url": image_url, "cover_prompt": prompt}
+    else:
+        changes = {"chapters": {number: {"image_url": image_url, "image_prompt": prompt}}}
+    return await apply_story_update(story_id, changes)
+
+async def job_story_stage(job, artifacts, checkpoint):
+    params = job["params"]
+    artifacts["story"] = await generate_story_with_gemini_async(
+        nome=params["nome"],
+        estilo=params["estilo"],
+        universo=params["universo"],
+        genero=params["genero"],
+        images=job["reference_images"],
+        descricao=params.get("descricao")
+    )
+
+async def job_images_stage(job, artifacts, checkpoint):
+    params = job["params"]
+    story_data = artifacts["story"]
+    prompts = [story_data["cover_prompt"]] + [part[1] for part in story_data["parts"]]
+
+    images = artifacts.setdefault("images", [None] * len(prompts))
+    # Images generated before a restart are kept as long as their file still exists
+    for idx, url in enumerate(images):
+        if url and not temp_storage.exists(url.split("/images/")[-1]):
+            images[idx] = None
+
+    semaphore = asyncio.Semaphore(IMAGE_BATCH_CONCURRENCY)
+
+    async def generate(idx, pin):
+        async with semaphore:
+            image_bytes = await generate_image_with_gemini(
+                prompt=prompts[idx],
+                reference_images=job["reference_images"],
+                person_name=params["nome"],
+                universe_context=params["universo"]
+            )
+        image_url, filepath = await save_generated_image(image_bytes)
+        pin(os.path.basename(filepath))
+        schedule_derivatives(filepath)
+        images[idx] = image_url
+        await checkpoint()
+
+    pending = [idx for idx, url in enumerate(images) if not url]
+    # Images of this job are kept by the temp sweeper until the stage is over
+    with temp_retention.pinned(temp_image_names(images)) as pin:
+        results = await asyncio.gather(*(generate(idx, pin) for idx in pending), return_exceptions=True)
+    errors = [r for r in results if isinstance(r, Exception)]
+    if errors:
+        raise RuntimeError(f"{len(errors)} ilustração(ões) falharam: {errors[0]}")
+
+async def job_save_stage(job, artifacts, checkpoint):
+    story_data = artifacts["story"]
+    images = artifacts["images"]
+    # The folder name is recorded before anything is written: a job resumed after a crash
+    # mid-save overwrites that story instead of saving a second copy
+    if "story_id" not in artifacts:
+        artifacts["story_id"] = story_folder_name(story_data["title"])
+        await checkpoint()
+    chapters = [
+        {"text": part[0], "image_url": images[idx + 1], "image_prompt": part[1]}
+        for idx, part in enumerate(story_data["parts"])
+    ]
+    with temp_retention.pinned(temp_image_names(images)):
+        with tracing.span("save.prepare_variants"):
+            await prepare_image_variants(images)
+        saved = await run_in_threadpool(save_story, story_data["title"], images[0], chapters,
+                                        story_data["cover_prompt"], job["params"], artifacts["story_id"])
+    temp_retention.mark_promoted(temp_image_names(images))
+    artifacts["saved"] = {"story_id": saved["story_id"]}
+
+job_manager = JobManager(
+    db_path=os.getenv("JOBS_DB", "jobs.sqlite3"),
+    data_dir=os.getenv("JOBS_DIR", "jobs_data"),
+    stages=[("story", job_story_stage), ("images", job_images_stage), ("save", job_save_stage)],
+    workers=int(os.getenv("JOB_WORKERS", "2")),
+    # Failed jobs keep their reference photos (and can be resumed) for this long
+    failed_retention_seconds=int(os.getenv("JOB_FAILED_RETENTION_SECONDS", "86400"))
+)
+
+@app.post("/api/jobs", status_code=202)
+async def create_job(
+    nome: str = Form(...),
+    estilo: str = Form(...),
+    universo: str = Form(...),
+    genero: str = Form(...),
+    descricao: str = Form(None),
+    imagens: List[UploadFile] = File(None),
+    reference_ids: List[str] = Form(None)
+):
+    """
+    Queues the generation of a whole book (story, illustrations and save) in the background.
+    Poll GET /api/jobs/{job_id} for progress.
+    """
+    processed_images = await collect_reference_images(imagens, reference_ids)
+
+    params = {"nome": nome, "estilo": estilo, "universo": universo, "genero": genero, "descricao": descricao}
+    if tracing.current() is not None:
+        # A traced request gets a traced job
+        params["trace"] = True
+    job_id = await job_manager.submit(params, processed_images)
+
+    return {
+        "status": "queued",
+        "job_id": job_id
+    }
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await job_manager.describe(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.post("/api/jobs/{job_id}/resume")
+async def resume_job(job_id: str):
+    """
+    Re-queues a failed job from the stage where it stopped.
+    Jobs failed more than JOB_FAILED_RETENTION_SECONDS ago no longer have their reference photos.
+    """
+    if not await job_manager.resume(job_id):
+        raise HTTPException(status_code=409, detail="Only failed jobs can be resumed (within JOB_FAILED_RETENTION_SECONDS)")
+    return {"status": "queued", "job_id": job_id}
+
+@app.get("/api/stats")
+async def get_stats():
+    """
+    Runtime counters (Gemini result cache, coalesced requests, per-model queue/retry stats,
+    temp image retention).
+    """
+    return {
+        "cache": result_cache.stats(),
+        "coalescing": coalescer.stats(),
+        "scheduler": scheduler.stats(),
+        "temp_images": temp_retention.stats()
+    }
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """
+    Prometheus text format: HTTP latency per route, Gemini latency / retries / in-flight
+    calls / tokens / estimated cost per model, reference photo upload bytes.
+    """
+    return Response(content=metrics_registry.render(), media_type=METRICS_CONTENT_TYPE)
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,273 @@
+import bisect
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds. Story generation and image batches take minutes, hence the long tail.
+HTTP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+GEMINI_BUCKETS = (0.25, 0.5, 1, 2, 5, 10, 20, 30, 45, 60, 90, 120, 300)
+# Bytes
+UPLOAD_BUCKETS = (16 * 1024, 64 * 1024, 256 * 1024, 1024 ** 2, 2 * 1024 ** 2, 5 * 1024 ** 2, 10 * 1024 ** 2, 20 * 1024 ** 2)
+
+# USD per 1M tokens, from Documentacao_gemini/modelos/precos_modelos.md (<= 200k token prompt tier).
+# "image_output" prices the image tokens of a response (1 2K image ~ 1120 tokens ~ $0.134 on 3 Pro Image).
+PRICES: Dict[str, Dict[str, float]] = {
+    "gemini-3-pro-preview": {"input": 2.00, "output": 12.00, "cached": 0.20},
+    "gemini-3-flash-preview": {"input": 0.50, "output": 3.00, "cached": 0.05},
+    "gemini-3-pro-image-preview": {"input": 2.00, "output": 12.00, "image_output": 120.00},
+    "gemini-2.5-pro": {"input": 1.25, "output": 10.00, "cached": 0.125},
+    "gemini-2.5-flash": {"input": 0.30, "output": 2.50, "cached": 0.03},
+    "gemini-2.5-flash-lite": {"input": 0.10, "output": 0.40, "cached": 0.01},
+    "gemini-2.5-flash-image": {"input": 0.30, "output": 30.00, "image_output": 30.00},
+    "gemini-2.0-flash": {"input": 0.10, "output": 0.40, "cached": 0.025},
+    "gemini-2.0-flash-lite": {"input": 0.075, "output": 0.30},
+}
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], Any] = {}
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in values]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class CallbackGauge(Metric):
+    """
+    Gauge read at scrape time from `fn`, which returns [(label values, value), ...].
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str], fn: Callable[[], Iterable[Tuple[Sequence[str], float]]]):
+        super().__init__(name, documentation, labelnames)
+        self.fn = fn
+
+    def samples(self) -> List[str]:
+        try:
+            values = sorted((tuple(map(str, key)), value) for key, value in self.fn())
+        except Exception as e:
+            print(f"Warning: could not collect {self.name}: {e}")
+            return []
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in values]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = HTTP_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket counts (the last one is +Inf), sum, count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = sorted((key, ([*state[0]], state[1], state[2])) for key, state in self._values.items())
+        lines = []
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Registry:
+    """
+    Minimal Prometheus registry: metrics are updated in place (thread-safe) and
+    rendered in the text exposition format on scrape.
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric already registered: {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = HTTP_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def callback_gauge(self, name: str, documentation: str, labelnames: Sequence[str], fn) -> CallbackGauge:
+        return self.register(CallbackGauge(name, documentation, labelnames, fn))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines += metric.header()
+            lines += metric.samples()
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_requests = registry.counter("http_requests_total", "HTTP requests by route and status code.", ("method", "route", "status"))
+http_request_seconds = registry.histogram("http_request_duration_seconds", "HTTP request latency, until the response body is fully sent.", ("method", "route"))
+http_in_flight = registry.gauge("http_requests_in_flight", "HTTP requests being served.")
+
+gemini_call_seconds = registry.histogram("gemini_call_duration_seconds", "Latency of single Gemini API calls (one attempt).", ("model", "outcome"), GEMINI_BUCKETS)
+gemini_queue_seconds = registry.histogram("gemini_queue_wait_seconds", "Time spent waiting for a rate limit token and a concurrency slot.", ("model",), GEMINI_BUCKETS)
+gemini_retries = registry.counter("gemini_retries_total", "Gemini calls retried after a transient error.", ("model",))
+gemini_failures = registry.counter("gemini_failures_total", "Gemini calls that failed for good (fatal error or attempts exhausted).", ("model",))
+gemini_tokens = registry.counter("gemini_tokens_total", "Tokens reported in usage_metadata (prompt includes cached; output includes image).", ("model", "type"))
+gemini_cost = registry.counter("gemini_estimated_cost_usd_total", "Estimated Gemini spend from token counts and list prices.", ("model",))
+
+upload_bytes = registry.counter("upload_bytes_total", "Bytes of reference photos accepted.")
+upload_file_bytes = registry.histogram("upload_file_size_bytes", "Size of accepted reference photos.", (), UPLOAD_BUCKETS)
+uploads_rejected = registry.counter("uploads_rejected_total", "Reference photos refused.", ("reason",))
+
+
+def _count(details, modality: str) -> int:
+    for detail in details or []:
+        detail_modality = getattr(detail, "modality", None)
+        name = getattr(detail_modality, "value", detail_modality)
+        if str(name).upper() == modality:
+            return getattr(detail, "token_count", None) or 0
+    return 0
+
+
+def record_usage(model: str, usage, price_factor: float = 1.0) -> Optional[float]:
+    """
+    Accounts the usage_metadata of a Gemini response (or stream's last chunk).
+    `price_factor` scales the list prices (0.5 for batch jobs).
+    Returns the estimated cost in USD, None when there is no usage or no price for the model.
+    """
+    if usage is None:
+        return None
+    prompt = getattr(usage, "prompt_token_count", None) or 0
+    cached = getattr(usage, "cached_content_token_count", None) or 0
+    output = getattr(usage, "candidates_token_count", None) or 0
+    thoughts = getattr(usage, "thoughts_token_count", None) or 0
+    image_output = _count(getattr(usage, "candidates_tokens_details", None), "IMAGE")
+
+    for kind, count in (("prompt", prompt), ("cached", cached), ("output", output), ("thoughts", thoughts), ("image_output", image_output)):
+        if count:
+            gemini_tokens.inc(count, model=model, type=kind)
+
+    prices = PRICES.get(model)
+    if prices is None:
+        return None
+    cost = (
+        (prompt - cached) * prices["input"]
+        + cached * prices.get("cached", prices["input"])
+        # Thinking tokens are billed as output
+        + (output - image_output + thoughts) * prices["output"]
+        + image_output * prices.get("image_output", prices["output"])
+    ) / 1_000_000 * price_factor
+    gemini_cost.inc(cost, model=model)
+    return cost
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording count, latency and in-flight requests per route template
+    (so /api/stories/{story_id} is a single series whatever the id).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = 500
+
+        async def tracking_send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        http_in_flight.inc()
+        try:
+            await self.app(scope, receive, tracking_send)
+        finally:
+            http_in_flight.dec()
+            # Set by the router once matched; unmatched paths share one series
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            http_requests.inc(method=scope["method"], route=route, status=status)
+            http_request_seconds.observe(time.perf_counter() - started, method=scope["method"], route=route)
@@ -0,0 +1,113 @@
+import hashlib
+import io
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from PIL import Image, ImageOps
+
+
+class ReferenceImageStore:
+    """
+    In-memory store of normalized reference photos, keyed by the SHA-256 of the original upload.
+
+    Photos are downsized and re-encoded once on ingest, then reused by handle for every
+    story/illustration call until they expire (TTL refreshed on each access).
+    """
+
+    def __init__(self, ttl_seconds: int = 3600, max_side: int = 1536, max_entries: int = 512, quality: int = 90):
+        self.ttl_seconds = ttl_seconds
+        self.max_side = max_side
+        self.max_entries = max_entries
+        self.quality = quality
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def normalize(self, data, mime_type: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Downsizes the photo so its longest side is at most max_side and re-encodes it as JPEG.
+        Keeps the original bytes when they are already smaller than the re-encoded version.
+        `data` is either bytes or a binary file object (read from the start).
+        """
+        source = io.BytesIO(data) if isinstance(data, (bytes, bytearray)) else data
+        source.seek(0, io.SEEK_END)
+        original_size = source.tell()
+        source.seek(0)
+
+        try:
+            with Image.open(source) as img:
+                # JPEGs are decoded at a reduced scale when possible, so a 12 MP phone photo
+                # never needs a full-resolution pixel buffer
+                img.draft("RGB", (self.max_side, self.max_side))
+                img = ImageOps.exif_transpose(img)
+                if img.mode != "RGB":
+                    img = img.convert("RGB")
+                img.thumbnail((self.max_side, self.max_side), Image.LANCZOS)
+
+                out = io.BytesIO()
+                img.save(out, format="JPEG", quality=self.quality, optimize=True)
+                width, height = img.size
+        except Exception:
+            raise ValueError("Invalid image file")
+
+        normalized = out.getvalue()
+        if mime_type in ("image/jpeg", "image/png", "image/webp") and original_size <= len(normalized) \
+                and max(width, height) < self.max_side:
+            source.seek(0)
+            return {"data": source.read(), "mime_type": mime_type, "width": width, "height": height}
+
+        return {"data": normalized, "mime_type": "image/jpeg", "width": width, "height": height}
+
+    def ingest(self, data: bytes, mime_type: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Stores an uploaded photo and returns its entry ({"id", "data", "mime_type", "sha256", ...}).
+        Uploading the same bytes again reuses the already-normalized version.
+        """
+        return self.ingest_file(io.BytesIO(data), hashlib.sha256(data).hexdigest(), len(data), mime_type)
+
+    def ingest_file(self, file, digest: str, size: int, mime_type: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Same as ingest() for an upload already hashed while it was streamed:
+        the file is only decoded when `digest` is not in the store yet.
+        """
+        entry = self.get(digest)
+        if entry is not None:
+            return entry
+
+        normalized = self.normalize(file, mime_type)
+        entry = {
+            "id": digest,
+            "sha256": hashlib.sha256(normalized["data"]).hexdigest(),
+            "original_bytes": size,
+            **normalized,
+        }
+
+        with self._lock:
+            self._entries[digest] = {"entry": entry, "expires_at": time.monotonic() + self.ttl_seconds}
+            self._entries.move_to_end(digest)
+            self._evict()
+
+        return entry
+
+    def get(self, handle: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            self._evict()
+            item = self._entries.get(handle)
+            if item is None:
+                return None
+            item["expires_at"] = time.monotonic() + self.ttl_seconds
+            self._entries.move_to_end(handle)
+            return item["entry"]
+
+    def _evict(self):
+        # Entries are kept in access order, so expired ones are always at the front
+        now = time.monotonic()
+        while self._entries:
+            handle, item = next(iter(self._entries.items()))
+            if item["expires_at"] > now and len(self._entries) <= self.max_entries:
+                break
+            del self._entries[handle]
+
+    def __len__(self):
+        return len(self._entries)
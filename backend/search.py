@@ -0,0 +1,203 @@
+import re
+import unicodedata
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Set
+
+# Bump when the analyzer changes: the catalog then rebuilds its search index from storage
+ANALYZER_VERSION = 3
+
+WORD = re.compile(r"\w+")
+
+# Most frequent Portuguese function words (accent-folded), not worth indexing. Titles keep
+# them (a few bytes per story), so a query made only of them ("a", "de um") still finds titles.
+STOPWORDS = frozenset("""
+a o as os um uma uns umas de do da dos das em no na nos nas num numa ao aos pelo pela pelos pelas
+por para pra com sem sob sobre ate e ou mas nem que se como quando onde porque pois entao tambem
+ja nao sim mais menos muito muita muitos muitas so ela ele elas eles eu tu voce voces vos me te
+lhe lhes seu sua seus suas meu minha meus minhas teu tua teus tuas nosso nossa isso isto aquilo
+esse essa esses essas este esta estes estas aquele aquela aqueles aquelas foi era eram ser sao
+estava estavam tem tinha ter ha havia the and of
+""".split())
+
+# Light stemming: plural forms first, then diminutives, then the final gender vowel.
+# (suffix, replacement, minimum word length)
+PLURAL_RULES = [
+    ("oes", "ao", 5), ("aes", "ao", 5), ("ais", "al", 5), ("eis", "el", 5), ("ois", "ol", 5),
+    ("ns", "m", 4), ("res", "r", 5), ("zes", "z", 5), ("ses", "s", 5), ("s", "", 4),
+]
+DIMINUTIVES = ("zinho", "zinha", "inho", "inha")
+VOWELS = set("aeiou")
+
+
+def _fold_slow(text: str) -> str:
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+
+
+# Accented Latin letters -> base letter, one character each (str.translate runs in C)
+FOLD_TABLE = {
+    code: _fold_slow(chr(code)) for code in range(0xC0, 0x250)
+    if len(_fold_slow(chr(code))) == 1 and _fold_slow(chr(code)) != chr(code)
+}
+
+
+# Base letter -> every character folding to it, for accent-insensitive regexes
+FOLD_VARIANTS: Dict[str, Set[str]] = {}
+for _code, _base in FOLD_TABLE.items():
+    FOLD_VARIANTS.setdefault(_base, set()).add(chr(_code))
+
+
+def fold(text: str) -> str:
+    """
+    Lowercase without accents ("Coração" -> "coracao").
+    """
+    text = text.lower().translate(FOLD_TABLE)
+    return text if text.isascii() else _fold_slow(text)
+
+
+def stem(word: str) -> str:
+    if len(word) <= 3 or word.isdigit():
+        return word
+    for suffix, replacement, min_length in PLURAL_RULES:
+        if word.endswith(suffix) and len(word) >= min_length:
+            word = word[:-len(suffix)] + replacement
+            break
+    for suffix in DIMINUTIVES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            word = word[:-len(suffix)]
+            break
+    # gato/gata/gatinho -> gat, but dragão (dragao) keeps its ending
+    if len(word) >= 4 and word[-1] in "aoe" and word[-2] not in VOWELS:
+        word = word[:-1]
+    return word
+
+
+@lru_cache(maxsize=65536)
+def term(word: str, keep_stopwords: bool = False) -> Optional[str]:
+    """
+    Index term of a single word as it appears in a text, None for stopwords
+    (and single letters) unless `keep_stopwords`.
+    """
+    folded = fold(word)
+    if not keep_stopwords and (folded in STOPWORDS or len(folded) < 2):
+        return None
+    return stem(folded)
+
+
+def analyze(text: str, keep_stopwords: bool = False) -> List[str]:
+    """
+    Terms of a text: folded, stopwords dropped (unless `keep_stopwords`), stemmed.
+    """
+    return [t for t in (term(word, keep_stopwords) for word in WORD.findall(text)) if t is not None]
+
+
+def parse_query(query: str) -> Optional[Dict[str, Any]]:
+    """
+    Terms of a search box query, or None when nothing searchable is left.
+    Stopwords are ignored, unless the query is made only of them: then only titles are searched.
+    The last word is matched as a prefix while it is still being typed.
+    Returns {"terms": [...], "prefix": bool, "stopwords": bool, "match": FTS5 MATCH expression,
+    "title_match": the same, with every term in the title}.
+    """
+    stopwords = False
+    terms = list(dict.fromkeys(analyze(query)))
+    if not terms:
+        stopwords = True
+        terms = list(dict.fromkeys(analyze(query, keep_stopwords=True)))
+    if not terms:
+        return None
+    prefix = not query[-1:].isspace() and len(terms[-1]) >= 2
+    phrases = [f'"{word}"' for word in terms]
+    if prefix:
+        phrases[-1] += "*"
+    match = " ".join(phrases)
+    title_match = "{title} : (" + match + ")"
+    if stopwords:
+        match = title_match
+    return {"terms": terms, "prefix": prefix, "stopwords": stopwords, "match": match, "title_match": title_match}
+
+
+def _matches(word_term: Optional[str], terms: Set[str], prefix: Optional[str]) -> bool:
+    return word_term is not None and (word_term in terms or (prefix is not None and word_term.startswith(prefix)))
+
+
+def _candidates(parsed: Dict[str, Any]) -> "re.Pattern":
+    """
+    Words that may analyze to one of the query terms, matched on the original text. Stemming
+    only rewrites the last two characters of a word (dragões -> dragao), so a word starts
+    with its term minus those, give or take case and accents.
+    """
+    return _heads_pattern(frozenset(word[:max(1, len(word) - 2)] for word in parsed["terms"]))
+
+
+@lru_cache(maxsize=1024)
+def _heads_pattern(heads: frozenset) -> "re.Pattern":
+    def char_class(ch):
+        variants = {ch, ch.upper()} | FOLD_VARIANTS.get(ch, set()) | FOLD_VARIANTS.get(ch.upper(), set())
+        return "[" + "".join(sorted(re.escape(v) for v in variants)) + "]"
+
+    alternatives = sorted("".join(map(char_class, head)) for head in heads)
+    return re.compile(r"\b(?:" + "|".join(alternatives) + r")\w*")
+
+
+def best_chapter(analyzed: str, parsed: Dict[str, Any]) -> Optional[int]:
+    """
+    Index of the chapter with the most query hits, from the analyzed texts of the chapters
+    (one line of space separated terms each). Only counts substrings, no regex.
+    """
+    terms = parsed["terms"]
+    needles = [f" {word} " for word in terms]
+    if parsed["prefix"]:
+        needles[-1] = f" {terms[-1]}"
+    best, best_count = None, 0
+    for index, line in enumerate(analyzed.split("\n")):
+        # A term repeated back to back counts once (the hits share a space): close enough to pick a chapter
+        padded = f" {line} "
+        count = sum(padded.count(needle) for needle in needles)
+        if count > best_count:
+            best, best_count = index, count
+    return best
+
+
+def snippet(texts: List[str], parsed: Dict[str, Any], width: int = 180, analyzed: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """
+    Excerpt of the text (chapter) with the most query hits, centered on its first hit.
+    With `analyzed` (see best_chapter) only the best chapter is scanned for hits.
+    Returns {"chapter": index, "text": excerpt, "highlights": [[start, end], ...]} with
+    highlight offsets relative to the excerpt, or None when no text matches.
+    """
+    terms = set(parsed["terms"])
+    prefix = parsed["terms"][-1] if parsed["prefix"] else None
+    candidates = _candidates(parsed)
+    keep_stopwords = parsed.get("stopwords", False)
+
+    chapters = enumerate(texts)
+    if analyzed is not None:
+        index = best_chapter(analyzed, parsed)
+        chapters = [(index, texts[index])] if index is not None and index < len(texts) else []
+
+    best = None
+    for index, text in chapters:
+        hits = [match.span() for match in candidates.finditer(text) if _matches(term(match.group(0), keep_stopwords), terms, prefix)]
+        if hits and (best is None or len(hits) > len(best[2])):
+            best = (index, text, hits)
+    if best is None:
+        return None
+
+    index, text, hits = best
+    start = max(0, hits[0][0] - width // 3)
+    if start > 0:
+        # Do not cut a word in half
+        space = text.find(" ", start)
+        start = space + 1 if 0 <= space < hits[0][0] else hits[0][0]
+    end = min(len(text), start + width)
+    if end < len(text):
+        space = text.rfind(" ", start, end)
+        if space > hits[0][1]:
+            end = space
+
+    prefix_text = "…" if start > 0 else ""
+    excerpt = prefix_text + text[start:end].strip() + ("…" if end < len(text) else "")
+    shift = len(prefix_text) - start - (len(text[start:end]) - len(text[start:end].lstrip()))
+    highlights = [[s + shift, e + shift] for s, e in hits if s >= start and e <= end]
+    return {"chapter": index, "text": excerpt, "highlights": highlights}
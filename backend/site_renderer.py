@@ -0,0 +1,129 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Optional, Tuple
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_PATH = os.path.join(BASE_DIR, "template_site.html")
+INJECTION_MARKER = "// __STORY_DATA_INJECTION__"
+
+# Appended to every rendered site: digest of the template + the story.json it was built from
+DIGEST_COMMENT = "\n<!-- site-digest: {} -->\n"
+DIGEST_PATTERN = re.compile(rb"<!-- site-digest: ([0-9a-f]{64}) -->\s*$")
+
+
+@contextmanager
+def atomic_open(path: str, mode: str = "wb", **kwargs):
+    """
+    Opens a temp file next to `path` and renames it over `path` only once the block
+    finished without errors, so readers never see a half-written file.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode, **kwargs) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def atomic_write_json(path: str, data: Any, indent: Optional[int] = 2) -> bytes:
+    """
+    Returns the bytes written.
+    """
+    # dumps() goes through the C encoder in one shot; dump() iterates chunk by chunk in Python
+    body = json.dumps(data, ensure_ascii=False, indent=indent).encode("utf-8")
+    with atomic_open(path, "wb") as f:
+        f.write(body)
+    return body
+
+
+def read_site_digest(html_path: str) -> Optional[str]:
+    """
+    The digest stamped at the end of a rendered index.html, if any.
+    """
+    try:
+        with open(html_path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - 256))
+            tail = f.read()
+    except OSError:
+        return None
+    match = DIGEST_PATTERN.search(tail)
+    return match.group(1).decode("ascii") if match else None
+
+
+class SiteTemplate:
+    """
+    The standalone story site template, loaded once and split at the injection marker.
+    The file is re-read only when its mtime changes.
+    """
+
+    def __init__(self, path: str = TEMPLATE_PATH):
+        self.path = path
+        self._mtime = None
+        self._parts: Optional[Tuple[bytes, bytes]] = None
+        self._digest: Optional[bytes] = None
+        self._lock = threading.Lock()
+
+    def parts(self) -> Optional[Tuple[bytes, bytes]]:
+        """
+        (prefix, suffix) around the marker, or None if the template does not exist.
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+        if mtime != self._mtime:
+            with self._lock:
+                if mtime != self._mtime:
+                    with open(self.path, "r", encoding="utf-8") as t:
+                        content = t.read()
+                    prefix, marker, suffix = content.partition(INJECTION_MARKER)
+                    if not marker:
+                        raise ValueError(f"Injection marker not found in {self.path}")
+                    self._parts = (prefix.encode("utf-8"), suffix.encode("utf-8"))
+                    self._digest = hashlib.sha256(content.encode("utf-8")).digest()
+                    self._mtime = mtime
+        return self._parts
+
+    def source_digest(self, story_json: bytes) -> Optional[str]:
+        """
+        Digest of the current template + the raw story.json a site is rendered from.
+        A site stamped with the same digest is up to date.
+        """
+        if self.parts() is None:
+            return None
+        return hashlib.sha256(self._digest + story_json).hexdigest()
+
+    def render_to(self, dest_path: str, story_data: Dict[str, Any], digest: Optional[str] = None) -> bool:
+        """
+        Writes the site for `story_data` to `dest_path` atomically: the template parts and
+        the JSON are written straight to the file, never joined into one big string.
+        `digest` (see source_digest) is stamped at the end of the file.
+        Returns False when there is no template.
+        """
+        parts = self.parts()
+        if parts is None:
+            return False
+
+        prefix, suffix = parts
+        with atomic_open(dest_path, "wb") as f:
+            f.write(prefix)
+            f.write(b"window.embeddedStory = ")
+            f.write(json.dumps(story_data, ensure_ascii=False).encode("utf-8"))
+            f.write(b";")
+            f.write(suffix)
+            if digest:
+                f.write(DIGEST_COMMENT.format(digest).encode("ascii"))
+        return True
+
+
+site_template = SiteTemplate()
@@ -0,0 +1,398 @@
+import asyncio
+import hashlib
+import mimetypes
+import os
+import re
+import shutil
+import tempfile
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional, Tuple
+
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+from starlette.exceptions import HTTPException
+from starlette.responses import Response, StreamingResponse
+from starlette.staticfiles import StaticFiles
+
+try:
+    from backend.http_cache import CachedStaticFiles, UUID_NAME, IMMUTABLE_CACHE_CONTROL, REVALIDATE_CACHE_CONTROL, http_date, is_not_modified
+    from backend.site_renderer import atomic_open
+except ImportError:
+    from http_cache import CachedStaticFiles, UUID_NAME, IMMUTABLE_CACHE_CONTROL, REVALIDATE_CACHE_CONTROL, http_date, is_not_modified
+    from site_renderer import atomic_open
+
+UUID_PATTERN = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+SHARD_NAME = re.compile(r"^[0-9a-f]{2}$")
+CHUNK_SIZE = 1024 * 1024
+
+# What stat() returns for stored objects (os.stat_result has the same fields)
+ObjectStat = namedtuple("ObjectStat", "st_size st_mtime st_mtime_ns")
+
+
+def shard_of(name: str) -> str:
+    """
+    Two-hex-digit shard of a top-level name. Names containing a UUID (generated images
+    and their variants) use the UUID's first byte, so an image and its variants share a shard.
+    """
+    match = UUID_PATTERN.search(name)
+    if match:
+        return match.group(0)[:2]
+    return hashlib.md5(name.encode("utf-8")).hexdigest()[:2]
+
+
+def split_key(key: str) -> Tuple[str, str]:
+    """
+    "story_id/story.json" -> ("story_id", "story.json"). Keys escaping the root are refused.
+    """
+    parts = key.replace("\\", "/").strip("/").split("/")
+    if any(part in ("", ".", "..") for part in parts):
+        raise ValueError(f"Invalid storage key: {key}")
+    return parts[0], "/".join(parts[1:])
+
+
+class LocalStorage:
+    """
+    Files under `root/<shard>/<name>`, where `name` is the first component of the key
+    (an image file name or a story folder), so no directory grows past a few thousand
+    entries. Files from the old flat layout (`root/<name>`) are still found and can be
+    moved into their shard with migrate_legacy().
+    Async methods run the blocking I/O in a dedicated thread pool.
+    """
+
+    is_local = True
+
+    def __init__(self, root: str, io_workers: int = 8):
+        self.root = root
+        self._executor = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix="storage")
+
+    def prepare(self):
+        """
+        Creates the root directory. Called at app startup rather than on construction,
+        so importing the app has no side effects on disk.
+        """
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        """
+        Sharded location of `key` (where it is written).
+        """
+        top, rest = split_key(key)
+        return os.path.join(self.root, shard_of(top), top, *filter(None, rest.split("/")))
+
+    def resolve(self, key: str) -> Optional[str]:
+        """
+        Existing location of `key`: sharded layout first, then the legacy flat one.
+        """
+        path = self.path(key)
+        if os.path.exists(path):
+            return path
+        legacy = os.path.join(self.root, *key.strip("/").split("/"))
+        if os.path.exists(legacy):
+            return legacy
+        return None
+
+    def folder(self, name: str) -> str:
+        """
+        Local directory of a top-level folder (created if needed).
+        """
+        path = self.resolve(name) or self.path(name)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def write_bytes(self, key: str, data: bytes) -> str:
+        path = self.resolve(key) or self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with atomic_open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def read_bytes(self, key: str) -> bytes:
+        path = self.resolve(key)
+        if path is None:
+            raise FileNotFoundError(key)
+        with open(path, "rb") as f:
+            return f.read()
+
+    def stat(self, key: str) -> Optional[os.stat_result]:
+        path = self.resolve(key)
+        if path is None:
+            return None
+        return os.stat(path)
+
+    def exists(self, key: str) -> bool:
+        return self.resolve(key) is not None
+
+    def delete(self, key: str):
+        path = self.resolve(key)
+        if path is None:
+            return
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+    def iter_entries(self) -> Iterator[os.DirEntry]:
+        """
+        Top-level entries (image files / story folders) of both layouts.
+        """
+        if not os.path.isdir(self.root):
+            return
+        for entry in os.scandir(self.root):
+            if entry.is_dir() and SHARD_NAME.match(entry.name):
+                yield from os.scandir(entry.path)
+            else:
+                yield entry
+
+    def scan(self, filename: str) -> Iterator[Tuple[str, float]]:
+        """
+        (folder name, mtime) of every top-level folder containing `filename`.
+        """
+        for entry in self.iter_entries():
+            try:
+                yield entry.name, os.stat(os.path.join(entry.path, filename)).st_mtime
+            except OSError:
+                continue
+
+    def list_folder(self, name: str) -> List[str]:
+        """
+        File names in a top-level folder.
+        """
+        path = self.resolve(name)
+        if path is None or not os.path.isdir(path):
+            return []
+        return sorted(entry.name for entry in os.scandir(path) if entry.is_file())
+
+    def iter_chunks(self, key: str) -> Iterator[bytes]:
+        path = self.resolve(key)
+        if path is None:
+            raise FileNotFoundError(key)
+        with open(path, "rb") as f:
+            yield from iter(lambda: f.read(CHUNK_SIZE), b"")
+
+    def staging_folder(self, name: str) -> str:
+        """
+        Local directory to build a folder in before publish(); the final folder itself.
+        """
+        return self.folder(name)
+
+    def publish(self, name: str, local_dir: str):
+        pass
+
+    def migrate_legacy(self) -> int:
+        """
+        Moves entries of the flat layout into their shard (a rename, no copying).
+        """
+        moved = 0
+        if not os.path.isdir(self.root):
+            return moved
+        for entry in list(os.scandir(self.root)):
+            if entry.is_dir() and SHARD_NAME.match(entry.name):
+                continue
+            if entry.name.startswith(".") or entry.name.endswith(".tmp"):
+                continue
+            dest = self.path(entry.name)
+            if os.path.exists(dest):
+                continue
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            os.rename(entry.path, dest)
+            moved += 1
+        return moved
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def write(self, key: str, data: bytes) -> str:
+        return await self._run(self.write_bytes, key, data)
+
+    async def read(self, key: str) -> bytes:
+        return await self._run(self.read_bytes, key)
+
+    async def stat_async(self, key: str):
+        return await self._run(self.stat, key)
+
+    def static_files(self) -> StaticFiles:
+        return ShardedStaticFiles(self)
+
+
+class S3Storage:
+    """
+    Same interface on an S3-compatible bucket (AWS, MinIO, or a local moto server
+    through `endpoint_url`). Objects are stored as `<prefix><shard>/<key>`.
+    Folders are built in a local staging directory and uploaded by publish().
+    """
+
+    is_local = False
+
+    def __init__(self, bucket: str, prefix: str = "", endpoint_url: Optional[str] = None,
+                 region: Optional[str] = None, io_workers: int = 8):
+        # Imported here: boto3 alone adds ~0.2s to the app's import time
+        try:
+            import boto3
+        except ImportError:
+            raise RuntimeError("S3 storage requires the boto3 package (pip install boto3)")
+        self.bucket = bucket
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+        self.client = boto3.client("s3", endpoint_url=endpoint_url, region_name=region)
+        self._executor = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix="storage")
+
+    def object_key(self, key: str) -> str:
+        top, rest = split_key(key)
+        return f"{self.prefix}{shard_of(top)}/{top}" + (f"/{rest}" if rest else "")
+
+    def write_bytes(self, key: str, data: bytes) -> str:
+        object_key = self.object_key(key)
+        content_type = mimetypes.guess_type(key)[0] or "application/octet-stream"
+        self.client.put_object(Bucket=self.bucket, Key=object_key, Body=data, ContentType=content_type)
+        return object_key
+
+    def read_bytes(self, key: str) -> bytes:
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self.object_key(key))["Body"].read()
+        except self.client.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                raise FileNotFoundError(key)
+            raise
+
+    def head(self, key: str) -> Optional[dict]:
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.object_key(key))
+        except self.client.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return None
+            raise
+
+    def stat(self, key: str) -> Optional[ObjectStat]:
+        head = self.head(key)
+        if head is None:
+            return None
+        mtime = head["LastModified"].timestamp()
+        return ObjectStat(head["ContentLength"], mtime, int(mtime * 1e9))
+
+    def exists(self, key: str) -> bool:
+        return self.head(key) is not None
+
+    def delete(self, key: str):
+        object_key = self.object_key(key)
+        self.client.delete_object(Bucket=self.bucket, Key=object_key)
+        # A folder: delete everything under it
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=object_key + "/"):
+            objects = [{"Key": obj["Key"]} for obj in page.get("Contents", [])]
+            if objects:
+                self.client.delete_objects(Bucket=self.bucket, Delete={"Objects": objects})
+
+    def scan(self, filename: str) -> Iterator[Tuple[str, float]]:
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for obj in page.get("Contents", []):
+                parts = obj["Key"][len(self.prefix):].split("/")
+                if len(parts) == 3 and parts[2] == filename:
+                    yield parts[1], obj["LastModified"].timestamp()
+
+    def list_folder(self, name: str) -> List[str]:
+        folder_key = self.object_key(name) + "/"
+        names = []
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=folder_key):
+            names += [obj["Key"][len(folder_key):] for obj in page.get("Contents", [])]
+        return sorted(name for name in names if name and "/" not in name)
+
+    def iter_chunks(self, key: str) -> Iterator[bytes]:
+        body = self.client.get_object(Bucket=self.bucket, Key=self.object_key(key))["Body"]
+        try:
+            yield from body.iter_chunks(CHUNK_SIZE)
+        finally:
+            body.close()
+
+    def staging_folder(self, name: str) -> str:
+        return tempfile.mkdtemp(prefix=f"{name}_")
+
+    def publish(self, name: str, local_dir: str):
+        """
+        Uploads a folder built by staging_folder() and removes the local copy.
+        """
+        try:
+            for filename in os.listdir(local_dir):
+                path = os.path.join(local_dir, filename)
+                content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+                self.client.upload_file(path, self.bucket, self.object_key(f"{name}/{filename}"),
+                                        ExtraArgs={"ContentType": content_type})
+        finally:
+            shutil.rmtree(local_dir, ignore_errors=True)
+
+    def prepare(self):
+        pass
+
+    def migrate_legacy(self) -> int:
+        return 0
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def write(self, key: str, data: bytes) -> str:
+        return await self._run(self.write_bytes, key, data)
+
+    async def read(self, key: str) -> bytes:
+        return await self._run(self.read_bytes, key)
+
+    async def stat_async(self, key: str):
+        return await self._run(self.stat, key)
+
+    def static_files(self) -> StaticFiles:
+        return ObjectStaticFiles(self)
+
+
+class ShardedStaticFiles(CachedStaticFiles):
+    """
+    CachedStaticFiles over a LocalStorage: `/<name>/...` is looked up in the name's shard,
+    then in the legacy flat layout.
+    """
+
+    def __init__(self, storage: LocalStorage):
+        # The root is created at startup, after the app is mounted
+        super().__init__(directory=storage.root, check_dir=False)
+        self.storage = storage
+
+    def lookup_path(self, path: str):
+        top, _ = split_key(path)
+        if top and not SHARD_NAME.match(top):
+            full_path, stat_result = super().lookup_path(os.path.join(shard_of(top), path))
+            if stat_result is not None:
+                return full_path, stat_result
+        return super().lookup_path(path)
+
+
+class ObjectStaticFiles(StaticFiles):
+    """
+    Serves objects of an S3Storage through the app (streamed, never buffered whole),
+    with the same cache headers as CachedStaticFiles.
+    """
+
+    def __init__(self, storage: S3Storage):
+        super().__init__(directory=None, check_dir=False)
+        self.storage = storage
+
+    async def get_response(self, path: str, scope) -> Response:
+        if scope["method"] not in ("GET", "HEAD"):
+            raise HTTPException(status_code=405, headers={"Allow": "GET, HEAD"})
+
+        key = path.replace(os.sep, "/")
+        head = await run_in_threadpool(self.storage.head, key)
+        if head is None:
+            raise HTTPException(status_code=404)
+
+        last_modified = head["LastModified"].timestamp()
+        headers = {
+            "ETag": head["ETag"],
+            "Last-Modified": http_date(last_modified),
+            "Cache-Control": IMMUTABLE_CACHE_CONTROL if UUID_NAME.search(os.path.basename(key)) else REVALIDATE_CACHE_CONTROL
+        }
+        request_headers = {k.decode("latin-1"): v.decode("latin-1") for k, v in scope["headers"]}
+        if is_not_modified(request_headers, head["ETag"], last_modified):
+            return Response(status_code=304, headers=headers)
+
+        headers["Content-Length"] = str(head["ContentLength"])
+        media_type = head.get("ContentType") or mimetypes.guess_type(key)[0] or "application/octet-stream"
+        if scope["method"] == "HEAD":
+            return Response(status_code=200, headers=headers, media_type=media_type)
+        return StreamingResponse(iterate_in_threadpool(self.storage.iter_chunks(key)), headers=headers, media_type=media_type)
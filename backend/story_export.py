@@ -0,0 +1,199 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+import zipfile
+from typing import Dict, Iterable, Iterator, List, Optional
+
+try:
+    from backend.site_renderer import atomic_open
+except ImportError:
+    from site_renderer import atomic_open
+
+# Already-compressed formats are stored as-is; deflating them again only burns CPU
+STORED_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp", ".avif", ".gif", ".woff", ".woff2", ".zip"}
+SKIPPED_SUFFIXES = (".gz", ".br", ".tmp")
+
+CDN_URL = re.compile(r"""https://[^\s"'()<>]+""")
+FONT_URL = re.compile(r"url\((https://[^)]+)\)")
+# Google Fonts only serves woff2 to user agents it recognizes as modern browsers
+BROWSER_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36"
+
+
+class ZipSink:
+    """
+    Write-only, non-seekable file object for zipfile: everything written is kept
+    only until the next drain(), so an archive can be streamed while it is built.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._offset = 0
+
+    def write(self, data) -> int:
+        self._buffer += data
+        self._offset += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._offset
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+
+def cdn_urls(html: str) -> List[str]:
+    """
+    External URLs (fonts, scripts, textures) a story site loads.
+    """
+    return sorted(set(CDN_URL.findall(html)))
+
+
+class VendorCache:
+    """
+    Local copies of the CDN assets used by the story site (page-flip, Google Fonts
+    and their font files, background textures), fetched once and kept in `directory`.
+    """
+
+    def __init__(self, directory: str, timeout: float = 15, retry_after_seconds: float = 300):
+        self.directory = directory
+        self.timeout = timeout
+        self.retry_after_seconds = retry_after_seconds
+        self._lock = asyncio.Lock()
+        self._manifest: Optional[Dict] = None
+        self._failed_at = 0.0
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.directory, "manifest.json")
+
+    def load(self) -> Dict:
+        """
+        {"urls": {cdn_url: archive_path}, "files": {archive_path: local_path}}
+        """
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"urls": {}, "files": {}}
+
+    def _download(self, url: str, headers: Optional[Dict[str, str]] = None) -> bytes:
+        import requests
+
+        response = requests.get(url, headers=headers, timeout=self.timeout)
+        response.raise_for_status()
+        return response.content
+
+    def _store(self, manifest: Dict, archive_path: str, data: bytes):
+        local_path = os.path.join(self.directory, *archive_path.split("/"))
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        with atomic_open(local_path, "wb") as f:
+            f.write(data)
+        manifest["files"][archive_path] = local_path
+
+    def fetch(self, urls: Iterable[str]) -> Dict:
+        """
+        Downloads the URLs missing from the cache. Blocking. URLs that fail are left out
+        of the manifest (the exported site then keeps loading them from the CDN).
+        """
+        manifest = self.load()
+        os.makedirs(self.directory, exist_ok=True)
+
+        for url in urls:
+            if url in manifest["urls"]:
+                continue
+            try:
+                if "fonts.googleapis.com/css" in url:
+                    css = self._download(url, {"User-Agent": BROWSER_USER_AGENT}).decode("utf-8")
+                    for font_url in sorted(set(FONT_URL.findall(css))):
+                        name = hashlib.sha1(font_url.encode("utf-8")).hexdigest()[:16] + os.path.splitext(font_url)[1]
+                        self._store(manifest, f"vendor/fonts/{name}", self._download(font_url))
+                        css = css.replace(font_url, f"fonts/{name}")
+                    archive_path = "vendor/fonts.css"
+                    self._store(manifest, archive_path, css.encode("utf-8"))
+                else:
+                    archive_path = "vendor/" + os.path.basename(url.split("?")[0])
+                    self._store(manifest, archive_path, self._download(url))
+                manifest["urls"][url] = archive_path
+            except Exception as e:
+                print(f"Warning: could not vendor {url}: {e}")
+
+        with atomic_open(self.manifest_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+        return manifest
+
+    async def ensure(self, urls: List[str]) -> Dict:
+        """
+        Manifest covering `urls`, fetching what is missing (at most once at a time,
+        and not again for a while after a failed attempt).
+        """
+        async with self._lock:
+            if self._manifest is None:
+                self._manifest = await asyncio.to_thread(self.load)
+            missing = [url for url in urls if url not in self._manifest["urls"]]
+            if missing and time.monotonic() - self._failed_at > self.retry_after_seconds:
+                self._manifest = await asyncio.to_thread(self.fetch, missing)
+                if any(url not in self._manifest["urls"] for url in missing):
+                    self._failed_at = time.monotonic()
+            return self._manifest
+
+
+def offline_html(html: str, manifest: Dict) -> str:
+    for url, archive_path in manifest["urls"].items():
+        html = html.replace(url, archive_path)
+    return html
+
+
+def iter_story_zip(storage, story_id: str, manifest: Dict, mtime: float, chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+    """
+    Builds the ZIP of a saved story while it is being sent: files are copied into the
+    archive chunk by chunk and the output is yielded as it is produced, so memory stays
+    at roughly one chunk whatever the size of the book. Blocking (run in a thread).
+    """
+    sink = ZipSink()
+    date_time = time.localtime(mtime)[:6]
+
+    def entry(name: str) -> zipfile.ZipInfo:
+        info = zipfile.ZipInfo(name, date_time=date_time)
+        stored = os.path.splitext(name)[1].lower() in STORED_EXTENSIONS
+        info.compress_type = zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED
+        info.external_attr = 0o644 << 16
+        return info
+
+    def copy(info: zipfile.ZipInfo, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        with archive.open(info, "w") as dest:
+            for chunk in chunks:
+                for start in range(0, len(chunk), chunk_size):
+                    dest.write(chunk[start:start + chunk_size])
+                    data = sink.drain()
+                    if data:
+                        yield data
+        data = sink.drain()
+        if data:
+            yield data
+
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=6) as archive:
+        for name in storage.list_folder(story_id):
+            if name.endswith(SKIPPED_SUFFIXES):
+                continue
+            key = f"{story_id}/{name}"
+            if name == "index.html":
+                # Small: rewritten in memory to point at the vendored assets
+                html = storage.read_bytes(key).decode("utf-8")
+                yield from copy(entry(name), [offline_html(html, manifest).encode("utf-8")])
+            else:
+                yield from copy(entry(name), storage.iter_chunks(key))
+
+        for archive_path, local_path in sorted(manifest["files"].items()):
+            with open(local_path, "rb") as f:
+                yield from copy(entry(archive_path), iter(lambda: f.read(chunk_size), b""))
+
+    # Central directory
+    yield sink.drain()
@@ -0,0 +1,116 @@
+import json
+from typing import Any, List, Tuple
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\r\n"
+
+
+class StoryStreamParser:
+    """
+    Incremental parser for the Story JSON while Gemini is still streaming it.
+
+    feed() receives raw text chunks and returns the events that became complete:
+    ("title", str), ("cover_prompt", str) and ("part", (index, [texto, prompt])).
+    Only the top-level object is walked by hand; each value is decoded with
+    json's raw_decode once all of its characters have arrived.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.pos = 0
+        self.state = "start"  # start -> key -> colon -> value -> comma ... -> done
+        self.key = None
+        self.part_index = 0
+
+    def feed(self, chunk: str) -> List[Tuple[str, Any]]:
+        self.buffer += chunk
+        events = []
+        while self._step(events):
+            pass
+        return events
+
+    def _skip_whitespace(self) -> bool:
+        while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+            self.pos += 1
+        return self.pos < len(self.buffer)
+
+    def _decode(self):
+        try:
+            value, end = _decoder.raw_decode(self.buffer, self.pos)
+        except json.JSONDecodeError:
+            # Value not fully streamed yet
+            return False, None
+        self.pos = end
+        return True, value
+
+    def _step(self, events) -> bool:
+        if self.state == "done" or not self._skip_whitespace():
+            return False
+
+        char = self.buffer[self.pos]
+
+        if self.state == "start":
+            if char != "{":
+                raise ValueError("Story JSON must be an object")
+            self.pos += 1
+            self.state = "key"
+            return True
+
+        if self.state == "key":
+            if char == "}":
+                self.pos += 1
+                self.state = "done"
+                return True
+            ok, key = self._decode()
+            if not ok:
+                return False
+            self.key = key
+            self.state = "colon"
+            return True
+
+        if self.state == "colon":
+            if char != ":":
+                raise ValueError("Malformed story JSON")
+            self.pos += 1
+            self.state = "parts_start" if self.key == "parts" else "value"
+            return True
+
+        if self.state == "value":
+            ok, value = self._decode()
+            if not ok:
+                return False
+            if self.key in ("title", "cover_prompt"):
+                events.append((self.key, value))
+            self.state = "comma"
+            return True
+
+        if self.state == "parts_start":
+            if char != "[":
+                # Not an array: let the final validation report it
+                self.state = "value"
+                return True
+            self.pos += 1
+            self.state = "part"
+            return True
+
+        if self.state == "part":
+            if char == "]":
+                self.pos += 1
+                self.state = "comma"
+                return True
+            if char == ",":
+                self.pos += 1
+                return True
+            ok, value = self._decode()
+            if not ok:
+                return False
+            events.append(("part", (self.part_index, value)))
+            self.part_index += 1
+            return True
+
+        if self.state == "comma":
+            self.pos += 1
+            self.state = "key" if char == "," else "done"
+            return True
+
+        return False
@@ -0,0 +1,223 @@
+import asyncio
+import os
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Optional
+
+# A generated image and its variants (thumb_/medium_ prefixes, .tmp files) share the same UUID
+UUID_PATTERN = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+
+
+def group_key(filename: str) -> str:
+    match = UUID_PATTERN.search(filename)
+    return match.group(0) if match else filename
+
+
+class TempImageRetention:
+    """
+    Keeps the temp image storage (a LocalStorage) bounded.
+
+    A background sweep deletes generated images (with their variants) that are older
+    than `ttl_seconds`, and evicts the least recently used ones while the directory is
+    over `max_bytes`. Images promoted into a saved story (already hardlinked into the
+    blob store) only survive `promoted_ttl_seconds`. Images pinned by an in-progress
+    generation or save are never deleted.
+    """
+
+    def __init__(self, storage, ttl_seconds: int = 86400, max_bytes: int = 2 * 1024 ** 3,
+                 promoted_ttl_seconds: int = 600, interval_seconds: int = 300):
+        self.storage = storage
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.promoted_ttl_seconds = promoted_ttl_seconds
+        self.interval_seconds = interval_seconds
+
+        self._lock = threading.Lock()
+        self._pins: Counter = Counter()
+        self._last_used: Dict[str, float] = {}
+        self._promoted: Dict[str, float] = {}
+        self._added_bytes = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+
+        self.totals = {"sweeps": 0, "removed_images": 0, "removed_files": 0, "reclaimed_bytes": 0}
+        self.last_sweep: Dict[str, Any] = {}
+
+    def touch(self, filename: str, size: int = 0):
+        """
+        Records a use of an image (generation, save). Newly written images pass their size,
+        so the sweeper can be woken up early when the cap is crossed between two sweeps.
+        """
+        with self._lock:
+            self._last_used[group_key(filename)] = time.time()
+            self._added_bytes += size
+            over_cap = self.last_sweep.get("bytes", 0) + self._added_bytes > self.max_bytes
+        if over_cap and self._wakeup is not None:
+            # touch() may be called from the thread pool
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    @contextmanager
+    def pinned(self, filenames: Iterable[str] = ()):
+        """
+        Protects images from the sweeper for the duration of the block.
+        Yields a function to pin more images (e.g. as they get generated).
+        """
+        keys = []
+
+        def add(filename: str):
+            key = group_key(filename)
+            with self._lock:
+                self._pins[key] += 1
+                self._last_used[key] = time.time()
+            keys.append(key)
+
+        for filename in filenames:
+            add(filename)
+        try:
+            yield add
+        finally:
+            with self._lock:
+                for key in keys:
+                    self._pins[key] -= 1
+                    if self._pins[key] <= 0:
+                        del self._pins[key]
+
+    def pin_until_done(self, future: "asyncio.Future", filename: str):
+        """
+        Keeps an image pinned until `future` (e.g. its variant generation) is done.
+        """
+        pin = self.pinned([filename])
+        pin.__enter__()
+        future.add_done_callback(lambda _: pin.__exit__(None, None, None))
+
+    def mark_promoted(self, filenames: Iterable[str]):
+        """
+        Marks images that a save copied into a story folder: they can go much sooner.
+        """
+        now = time.time()
+        with self._lock:
+            for filename in filenames:
+                self._promoted[group_key(filename)] = now
+
+    def sweep(self) -> Dict[str, Any]:
+        """
+        One retention pass over the directory. Blocking.
+        """
+        started = time.monotonic()
+        now = time.time()
+
+        groups: Dict[str, Dict[str, Any]] = {}
+        with self._lock:
+            self._added_bytes = 0
+        # Every image file, whether in its shard or in the legacy flat layout
+        for entry in self.storage.iter_entries():
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            group = groups.setdefault(group_key(entry.name), {"files": [], "bytes": 0, "mtime": 0})
+            group["files"].append((entry.path, stat.st_size))
+            group["bytes"] += stat.st_size
+            group["mtime"] = max(group["mtime"], stat.st_mtime)
+
+        with self._lock:
+            last_used = {key: max(group["mtime"], self._last_used.get(key, 0)) for key, group in groups.items()}
+            promoted = dict(self._promoted)
+
+        def expired(key):
+            promoted_at = promoted.get(key)
+            if promoted_at is not None and now - max(promoted_at, last_used[key]) > self.promoted_ttl_seconds:
+                return True
+            return now - last_used[key] > self.ttl_seconds
+
+        total = sum(group["bytes"] for group in groups.values())
+        # Promoted images first, then least recently used
+        order = sorted(groups, key=lambda key: (key not in promoted, last_used[key]))
+
+        removed_images = removed_files = reclaimed = 0
+        skipped_pinned = 0
+        for key in order:
+            if not expired(key) and total <= self.max_bytes:
+                continue
+            with self._lock:
+                if self._pins.get(key):
+                    skipped_pinned += 1
+                    continue
+                for path, size in groups[key]["files"]:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                    removed_files += 1
+                    reclaimed += size
+                self._last_used.pop(key, None)
+                self._promoted.pop(key, None)
+            removed_images += 1
+            total -= groups[key]["bytes"]
+
+        with self._lock:
+            # Forget bookkeeping of images that disappeared by other means
+            for tracked in (self._last_used, self._promoted):
+                for key in [key for key in tracked if key not in groups]:
+                    del tracked[key]
+
+        result = {
+            "images": len(groups) - removed_images,
+            "bytes": total,
+            "removed_images": removed_images,
+            "removed_files": removed_files,
+            "reclaimed_bytes": reclaimed,
+            "skipped_pinned": skipped_pinned,
+            "elapsed_ms": round((time.monotonic() - started) * 1000, 1)
+        }
+        self.totals["sweeps"] += 1
+        self.totals["removed_images"] += removed_images
+        self.totals["removed_files"] += removed_files
+        self.totals["reclaimed_bytes"] += reclaimed
+        self.last_sweep = result
+        return result
+
+    async def _run(self):
+        while True:
+            try:
+                result = await asyncio.to_thread(self.sweep)
+                if result["removed_images"]:
+                    print(f"Temp image sweep: {result}")
+            except Exception as e:
+                print(f"Error sweeping temp images: {e}")
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            pinned = len(self._pins)
+            promoted = len(self._promoted)
+        return {
+            **self.totals,
+            "pinned": pinned,
+            "promoted": promoted,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl_seconds,
+            "last_sweep": self.last_sweep
+        }
@@ -0,0 +1,64 @@
+import asyncio
+import importlib
+import io
+import time
+
+import httpx
+import pytest
+from PIL import Image
+
+from backend import genai_service
+from backend.fake_genai import FakeClient
+
+# A story call slow enough that a blocked event loop would show in the listing latency
+STORY_SECONDS = 1.5
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    # The app keeps its data files relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(genai_service, "client", FakeClient(story_latency=(STORY_SECONDS, 0), image=b""))
+    monkeypatch.setattr(genai_service, "_client_ready", True)
+    monkeypatch.setattr(genai_service.result_cache, "enabled", False)
+    return importlib.import_module("backend.main")
+
+
+def reference_photo() -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 64), (200, 150, 120)).save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+def test_slow_story_does_not_delay_story_listing(app):
+    async def scenario():
+        async with app.lifespan(app.app):
+            transport = httpx.ASGITransport(app=app.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=30) as client:
+                async def generate():
+                    response = await client.post(
+                        "/api/generate-story",
+                        data={"nome": "Bia", "estilo": "Aquarela", "universo": "Floresta", "genero": "Aventura"},
+                        files=[("imagens", ("ref.jpg", reference_photo(), "image/jpeg"))]
+                    )
+                    return response, time.perf_counter()
+
+                async def list_stories():
+                    # Sent once the story call is in flight
+                    await asyncio.sleep(0.2)
+                    response = await client.get("/api/stories")
+                    return response, time.perf_counter()
+
+                started = time.perf_counter()
+                (story, story_done), (listing, listing_done) = await asyncio.gather(generate(), list_stories())
+                return started, story, story_done, listing, listing_done
+
+    started, story, story_done, listing, listing_done = asyncio.run(scenario())
+
+    assert story.status_code == 200, story.text
+    assert story.json()["data"]["title"]
+    assert listing.status_code == 200
+    assert story_done - started >= STORY_SECONDS
+    # The listing is answered while the story is still being written
+    assert listing_done - started < STORY_SECONDS / 2
+    assert listing_done < story_done
@@ -0,0 +1,384 @@
+import atexit
+import itertools
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+# Active trace and span of the current request / job. Copied into asyncio tasks and
+# into run_in_threadpool / asyncio.to_thread workers, so spans nest across both.
+_current_trace: ContextVar[Optional["Trace"]] = ContextVar("trace", default=None)
+_current_span: ContextVar[Optional[int]] = ContextVar("trace_span", default=None)
+
+
+class Trace:
+    """
+    Timeline of one request or job: a flat list of spans with parent ids,
+    offsets relative to the start of the trace.
+    """
+
+    def __init__(self, name: str, attrs: Optional[Dict[str, Any]] = None, trace_id: Optional[str] = None):
+        self.id = trace_id or uuid.uuid4().hex[:16]
+        self.name = name
+        self.attrs = dict(attrs or {})
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.ended: Optional[float] = None
+        self.spans: List[Dict[str, Any]] = []
+        self.profile: Optional[Dict[str, Any]] = None
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def next_id(self) -> int:
+        with self._lock:
+            return next(self._ids)
+
+    def add(self, span_id: int, name: str, start: float, end: float, parent: Optional[int],
+            attrs: Dict[str, Any], error: Optional[str] = None):
+        span = {
+            "id": span_id,
+            "parent": parent,
+            "name": name,
+            "start_ms": round((start - self.started) * 1000, 2),
+            "duration_ms": round((end - start) * 1000, 2)
+        }
+        if attrs:
+            span["attrs"] = attrs
+        if error:
+            span["error"] = error
+        with self._lock:
+            self.spans.append(span)
+
+    def duration_ms(self) -> float:
+        return round(((self.ended or time.perf_counter()) - self.started) * 1000, 2)
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span["start_ms"])
+        data = {
+            "type": "trace",
+            "trace_id": self.id,
+            "name": self.name,
+            "started_at": self.started_at,
+            "duration_ms": self.duration_ms(),
+            "attrs": self.attrs,
+            "spans": spans
+        }
+        if self.profile is not None:
+            data["profile"] = self.profile
+        return data
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        Time per span name (count, total and max), small enough to keep next to a story.
+        """
+        totals: Dict[str, Dict[str, float]] = {}
+        with self._lock:
+            spans = list(self.spans)
+        for span in spans:
+            entry = totals.setdefault(span["name"], {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+            entry["count"] += 1
+            entry["total_ms"] = round(entry["total_ms"] + span["duration_ms"], 2)
+            entry["max_ms"] = max(entry["max_ms"], span["duration_ms"])
+        return {"trace_id": self.id, "duration_ms": self.duration_ms(), "spans": totals}
+
+
+class Span:
+    def __init__(self, trace: Trace, name: str, attrs: Dict[str, Any]):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self.id = self.trace.next_id()
+        self.parent = _current_span.get()
+        self._token = _current_span.set(self.id)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        _current_span.reset(self._token)
+        error = f"{exc_type.__name__}: {exc}" if exc_type is not None else None
+        self.trace.add(self.id, self.name, self.start, end, self.parent, self.attrs, error)
+        return False
+
+
+class NoopSpan:
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NOOP_SPAN = NoopSpan()
+
+
+def current() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+def span(name: str, **attrs):
+    """
+    Context manager timing a block as a span of the current trace.
+    A shared no-op when nothing is being traced.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        return NOOP_SPAN
+    return Span(trace, name, attrs)
+
+
+def record(name: str, start: float, end: float, **attrs):
+    """
+    Adds an already measured interval (time.perf_counter() values) as a span.
+    """
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(trace.next_id(), name, start, end, _current_span.get(), attrs)
+
+
+class BackgroundWriter:
+    """
+    Runs output calls (trace lines, profiles) in order on one daemon thread, so the
+    event loop never waits on a file or on stdout. Started on first use; pending
+    writes are flushed at interpreter exit.
+    """
+
+    def __init__(self):
+        self._queue: queue.Queue = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="trace-writer", daemon=True)
+                    self._thread.start()
+                    atexit.register(self.flush)
+        self._queue.put((fn, args))
+
+    def flush(self):
+        """
+        Blocks until everything submitted so far is written.
+        """
+        if self._thread is not None:
+            self._queue.join()
+
+    def _run(self):
+        while True:
+            fn, args = self._queue.get()
+            try:
+                fn(*args)
+            except Exception as e:
+                print(f"Warning: could not write trace output: {e}")
+            finally:
+                self._queue.task_done()
+
+
+writer = BackgroundWriter()
+
+
+def _write_line(data: Dict[str, Any], path: Optional[str]):
+    line = json.dumps(data, ensure_ascii=False, default=str)
+    if path:
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+    else:
+        print(line, flush=True)
+
+
+def _write_file(directory: str, name: str, text: str):
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, name), "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+def emit(trace: Trace):
+    """
+    Queues the trace as one JSON line: to TRACE_LOG_FILE when set, otherwise stdout.
+    The write itself happens on the background writer thread.
+    """
+    writer.submit(_write_line, trace.to_dict(), os.getenv("TRACE_LOG_FILE"))
+
+
+@contextmanager
+def trace(name: str, enabled: bool = True, **attrs):
+    """
+    Runs the block under a new trace (yielded, None when disabled) and emits it at the end.
+    """
+    if not enabled:
+        yield None
+        return
+    current_trace = Trace(name, attrs)
+    trace_token = _current_trace.set(current_trace)
+    span_token = _current_span.set(None)
+    try:
+        yield current_trace
+    except BaseException as e:
+        current_trace.attrs["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current_span.reset(span_token)
+        _current_trace.reset(trace_token)
+        current_trace.ended = time.perf_counter()
+        emit(current_trace)
+
+
+# Innermost frames of threads that are just waiting (idle pool workers, the event loop in select)
+IDLE_FRAMES = {
+    ("threading.py", "wait"), ("threading.py", "_wait_for_tstate_lock"), ("queue.py", "get"),
+    ("selectors.py", "select"), ("thread.py", "_worker")
+}
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of every thread of the process every `interval` seconds from a
+    background thread (no tracing hooks, so the profiled code runs at full speed).
+    Stacks are aggregated in the folded format flame graph tools read.
+    Note that the whole process is sampled: concurrent requests show up too.
+    """
+
+    def __init__(self, interval: float = 0.005, max_depth: int = 64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @staticmethod
+    def _label(frame) -> str:
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+    def _sample(self):
+        own = threading.get_ident()
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own:
+                continue
+            if (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in IDLE_FRAMES:
+                continue
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                stack.append(self._label(frame))
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+        self.samples += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def report(self, top: int = 25) -> Dict[str, Any]:
+        """
+        Functions with the most samples on top of the stack (self) and anywhere in it (total).
+        """
+        own: Counter = Counter()
+        total: Counter = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            own[frames[-1]] += count
+            for frame in set(frames):
+                total[frame] += count
+        return {
+            "samples": self.samples,
+            "interval_ms": round(self.interval * 1000, 2),
+            "self": [[frame, count] for frame, count in own.most_common(top)],
+            "total": [[frame, count] for frame, count in total.most_common(top)]
+        }
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware tracing a request when it is sampled (`sample_rate`) or sends
+    `X-Trace: 1`; the trace id is returned in X-Trace-Id. With `profile_dir` set,
+    `X-Profile: 1` also samples stacks while the request runs (one profile at a time)
+    and writes <profile_dir>/<trace_id>.folded. Untraced requests only pay for the
+    header check.
+    """
+
+    def __init__(self, app, sample_rate: float = 0.0, profile_dir: Optional[str] = None, profile_interval: float = 0.005):
+        self.app = app
+        self.sample_rate = sample_rate
+        self.profile_dir = profile_dir
+        self.profile_interval = profile_interval
+        self._profiling = threading.Lock()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope["headers"])
+        wants_profile = self.profile_dir is not None and headers.get(b"x-profile") == b"1"
+        traced = wants_profile or headers.get(b"x-trace") == b"1" or (self.sample_rate > 0 and random.random() < self.sample_rate)
+        if not traced:
+            await self.app(scope, receive, send)
+            return
+
+        profiler = None
+        if wants_profile and self._profiling.acquire(blocking=False):
+            profiler = SamplingProfiler(self.profile_interval)
+
+        with trace("http", method=scope["method"], path=scope["path"]) as current_trace:
+            body = {"first": None, "last": None, "bytes": 0}
+
+            async def traced_receive():
+                message = await receive()
+                if message["type"] == "http.request":
+                    now = time.perf_counter()
+                    body["first"] = body["first"] or now
+                    body["last"] = now
+                    body["bytes"] += len(message.get("body", b""))
+                return message
+
+            async def traced_send(message):
+                if message["type"] == "http.response.start":
+                    current_trace.attrs["status"] = message["status"]
+                    message = {**message, "headers": [*message.get("headers", []), (b"x-trace-id", current_trace.id.encode())]}
+                await send(message)
+
+            if profiler is not None:
+                profiler.start()
+            try:
+                await self.app(scope, traced_receive, traced_send)
+            finally:
+                if body["first"] is not None:
+                    # Upload of the request body (multipart forms are parsed as it arrives)
+                    current_trace.add(current_trace.next_id(), "http.receive_body", body["first"], body["last"], None, {"bytes": body["bytes"]})
+                current_trace.attrs["route"] = getattr(scope.get("route"), "path", None)
+                if profiler is not None:
+                    profiler.stop()
+                    self._profiling.release()
+                    current_trace.profile = profiler.report()
+                    writer.submit(_write_file, self.profile_dir, f"{current_trace.id}.folded", profiler.folded())
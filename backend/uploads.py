@@ -0,0 +1,155 @@
+import hashlib
+import json
+from typing import Any, Dict, List, Optional
+
+from starlette.datastructures import UploadFile
+from starlette.exceptions import HTTPException
+
+try:
+    from backend import metrics
+except ImportError:
+    import metrics
+
+CHUNK_SIZE = 64 * 1024
+
+# Magic bytes of the image formats the reference store can decode
+SIGNATURES = [
+    (0, b"\xff\xd8\xff", "image/jpeg"),
+    (0, b"\x89PNG\r\n\x1a\n", "image/png"),
+    (0, b"GIF87a", "image/gif"),
+    (0, b"GIF89a", "image/gif"),
+    (0, b"BM", "image/bmp"),
+    (0, b"II*\x00", "image/tiff"),
+    (0, b"MM\x00*", "image/tiff"),
+]
+
+
+class UploadTooLarge(HTTPException):
+    def __init__(self, detail: str):
+        super().__init__(status_code=413, detail=detail)
+        metrics.uploads_rejected.inc(reason="too_large")
+
+
+class UnsupportedUpload(HTTPException):
+    def __init__(self, detail: str):
+        super().__init__(status_code=415, detail=detail)
+        metrics.uploads_rejected.inc(reason="unsupported_type")
+
+
+def sniff_image_type(head: bytes) -> Optional[str]:
+    """
+    MIME type from the first bytes of a file, or None when it is not a supported image.
+    The client-supplied Content-Type is never trusted.
+    """
+    for offset, magic, mime_type in SIGNATURES:
+        if head[offset:offset + len(magic)] == magic:
+            return mime_type
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[4:8] == b"ftyp" and head[8:12] in (b"avif", b"avis"):
+        return "image/avif"
+    return None
+
+
+async def stream_upload(upload: UploadFile, max_bytes: int, budget: Optional[Dict[str, int]] = None) -> Dict[str, Any]:
+    """
+    Reads an upload chunk by chunk (it is already spooled to a temp file by the form parser),
+    hashing it and sniffing its type on the way, and rewinds it.
+    Raises UploadTooLarge / UnsupportedUpload as soon as a limit is crossed.
+    `budget` ({"remaining": bytes}) is shared by all the files of one request.
+    Returns {"file", "sha256", "size", "mime_type", "filename"}.
+    """
+    sha = hashlib.sha256()
+    size = 0
+    mime_type = None
+
+    while True:
+        chunk = await upload.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        if mime_type is None:
+            mime_type = sniff_image_type(chunk)
+            if mime_type is None:
+                raise UnsupportedUpload(f"Formato de imagem não suportado: {upload.filename}")
+
+        size += len(chunk)
+        if size > max_bytes:
+            raise UploadTooLarge(f"Imagem maior que o limite de {max_bytes // (1024 * 1024)} MB: {upload.filename}")
+        if budget is not None:
+            budget["remaining"] -= len(chunk)
+            if budget["remaining"] < 0:
+                raise UploadTooLarge("O total de imagens enviadas excede o limite da requisição")
+        sha.update(chunk)
+
+    if mime_type is None:
+        raise UnsupportedUpload(f"Arquivo vazio: {upload.filename}")
+
+    await upload.seek(0)
+    metrics.upload_bytes.inc(size)
+    metrics.upload_file_bytes.observe(size)
+    return {"file": upload.file, "sha256": sha.hexdigest(), "size": size, "mime_type": mime_type, "filename": upload.filename}
+
+
+async def stream_uploads(uploads: List[UploadFile], max_files: int, max_file_bytes: int, max_request_bytes: int) -> List[Dict[str, Any]]:
+    if len(uploads) > max_files:
+        raise UploadTooLarge(f"Envie no máximo {max_files} imagens por requisição")
+    budget = {"remaining": max_request_bytes}
+    return [await stream_upload(upload, max_file_bytes, budget) for upload in uploads]
+
+
+class BodySizeLimitMiddleware:
+    """
+    ASGI middleware rejecting request bodies larger than `max_bytes` with 413 before
+    they are parsed: from Content-Length when present, otherwise as soon as the
+    streamed body crosses the limit.
+    """
+
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] in ("GET", "HEAD", "OPTIONS"):
+            await self.app(scope, receive, send)
+            return
+
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_bytes:
+            metrics.uploads_rejected.inc(reason="too_large")
+            await self._reject(send)
+            return
+
+        received = 0
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    raise UploadTooLarge("Requisição maior que o limite permitido")
+            return message
+
+        async def tracking_send(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, tracking_send)
+        except UploadTooLarge:
+            # Raised outside of a route (e.g. while another middleware read the body)
+            if response_started:
+                raise
+            await self._reject(send)
+
+    async def _reject(self, send):
+        body = json.dumps({"detail": "Requisição maior que o limite permitido"}).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()), (b"connection", b"close")]
+        })
+        await send({"type": "http.response.body", "body": body})